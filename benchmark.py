@@ -0,0 +1,569 @@
+"""
+This script contains an offline benchmark of the ETL pipeline that does not need a Redshift cluster.
+
+A synthetic dataset shaped like data_sample/log-events.json and data_sample/song-data.json is generated with a
+configurable number of users, songs, days and events per day, and each stage of the pipeline is timed against
+a local PostgreSQL database that stands in for the cluster:
+
+    generate:   the song files and the daily event logs (log_data/YYYY/MM/YYYY-MM-DD-events.json)
+    validate:   the event logs go through validate.py, as before a load
+    load:       the clean events and the songs are bulk-loaded into the staging tables (COPY FROM STDIN)
+    transforms: every query of sql_queries.insert_table_queries, timed one by one
+    export:     songplays is written to Parquet with cur.fetchall() and streamed by export.py, each in a
+                fresh process so the rows/s and the peak RSS of the two methods can be compared (--skip-export)
+
+The tables are created with schema.create_table(spec, dialect="postgres"). The results are written as JSON
+together with the parameters and the git revision, so runs of different versions can be compared with --baseline:
+
+    $ createdb sparkify_bench
+    $ python benchmark.py --dsn "dbname=sparkify_bench" --days 7 --events-per-day 20000 --output results/run.json
+    $ python benchmark.py --dsn "dbname=sparkify_bench" --days 7 --events-per-day 20000 --baseline results/run.json
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import resource
+import random
+import subprocess
+import tempfile
+import time
+from datetime import date, datetime, timedelta, timezone
+
+import psycopg2
+
+from convert import stream_json_records, column_caster
+from export import EXPORT_TABLES, export_schema, export_table
+from instrument import recorder, instrumented_cursor, summary_exporter
+from local_etl import NULL_MARKER, json_files
+from schema import create_table, drop_table
+from schema import staging_events_table, staging_songs_table, song_lookup_table
+from schema import songplay_table, user_table, song_table, artist_table, time_table
+from sql_queries import insert_table_queries, stdin_csv_copy, table_select
+from validate import event_casters, load_jsonpaths, validate_records, write_batches
+
+BENCHMARK_TABLES = [staging_events_table, staging_songs_table, song_lookup_table, songplay_table,\
+                    user_table, song_table, artist_table, time_table]
+
+# Share of the events of each page. NextSong events are the ones the songplays are built from
+PAGES = [("NextSong", 0.80), ("Home", 0.08), ("Logout", 0.04), ("Login", 0.02), ("Settings", 0.02),\
+         ("Downgrade", 0.02), ("Upgrade", 0.01), ("Help", 0.01)]
+
+# Share of the plays whose song is not in the song dataset, like in the real logs
+UNKNOWN_SONG_SHARE = 0.1
+
+# Methods of the export stage
+EXPORT_METHODS = ["fetchall", "stream"]
+
+# Stages slower than the baseline by more than this ratio are reported as regressions
+REGRESSION_TOLERANCE = 0.2
+
+FIRST_NAMES = ["Walter", "Kaylee", "Ryan", "Lily", "Jacob", "Chloe", "Tegan", "Aleena", "Jayden", "Mohammad"]
+LAST_NAMES = ["Frye", "Summers", "Smith", "Koch", "Klein", "Cuevas", "Levine", "Kirby", "Graves", "Rodriguez"]
+LOCATIONS = ["San Francisco-Oakland-Hayward, CA", "Phoenix-Mesa-Scottsdale, AZ", "Chicago-Naperville-Elgin, IL-IN-WI",\
+             "Portland-South Portland, ME", "New York-Newark-Jersey City, NY-NJ-PA", "Atlanta-Sandy Springs-Roswell, GA"]
+USER_AGENTS = ["\"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36\"",\
+               "\"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/35.0.1916.153 Safari/537.36\"",\
+               "Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0"]
+
+
+def random_id(rng, prefix):
+    """
+    This method generates an identifier like the song_id and artist_id of the song dataset (SOBLFFE12AF72AA5BA).
+
+    Args:
+        rng (random.Random): random generator
+        prefix (str): SO or AR
+
+    Returns:
+        identifier (str)
+    """
+
+    return prefix + "".join(rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789") for _ in range(16))
+
+
+def generate_songs(rng, n_songs):
+    """
+    This method generates the records of the song dataset. There are about three songs per artist
+    and half of the artists have no known location.
+
+    Args:
+        rng (random.Random): random generator
+        n_songs (int): number of songs
+
+    Returns:
+        songs (list): song records
+    """
+
+    artists = []
+    for i in range(max(1, n_songs // 3)):
+        located = rng.random() < 0.5
+        artists.append({
+            "artist_id": random_id(rng, "AR"),
+            "artist_latitude": round(rng.uniform(-60, 70), 5) if located else None,
+            "artist_location": rng.choice(LOCATIONS) if located else "",
+            "artist_longitude": round(rng.uniform(-170, 170), 5) if located else None,
+            "artist_name": "Artist {}".format(i),
+        })
+
+    songs = []
+    for i in range(n_songs):
+        song = dict(rng.choice(artists))
+        song.update({
+            "duration": round(rng.uniform(90, 480), 5),
+            "num_songs": 1,
+            "song_id": random_id(rng, "SO"),
+            "title": "Song {}".format(i),
+            "year": rng.choice([0] + list(range(1960, 2019))),
+        })
+        songs.append(song)
+
+    return songs
+
+
+def generate_users(rng, n_users, first_day):
+    """
+    This method generates the users that appear in the event logs.
+
+    Args:
+        rng (random.Random): random generator
+        n_users (int): number of users
+        first_day (datetime.date): first day of the event logs
+
+    Returns:
+        users (list): user attributes
+    """
+
+    registration_start = datetime(first_day.year, first_day.month, first_day.day, tzinfo=timezone.utc).timestamp() - 30 * 86400
+
+    return [{
+        "userId": str(i + 1),
+        "firstName": rng.choice(FIRST_NAMES),
+        "lastName": rng.choice(LAST_NAMES),
+        "gender": rng.choice("MF"),
+        "level": rng.choice(["free", "paid"]),
+        "location": rng.choice(LOCATIONS),
+        "userAgent": rng.choice(USER_AGENTS),
+        "registration": float(int((registration_start + rng.uniform(0, 30 * 86400)) * 1000)),
+    } for i in range(n_users)]
+
+
+def generate_day(rng, day, users, songs, events_per_day):
+    """
+    This method generates the events of a day. The users play songs in sessions, the plays of each
+    session are sequential and the level of a user can change when it upgrades or downgrades.
+
+    Args:
+        rng (random.Random): random generator
+        day (datetime.date): day of the events
+        users (list): user attributes, as returned by generate_users. The levels are updated
+        songs (list): song records, as returned by generate_songs
+        events_per_day (int): number of events of the day
+
+    Yields:
+        event (dict)
+    """
+
+    day_start = int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp() * 1000)
+    pages, weights = zip(*PAGES)
+    timestamps = sorted(day_start + rng.randrange(86400 * 1000) for _ in range(events_per_day))
+    sessions = {}
+    n_sessions = 0
+
+    for ts in timestamps:
+        user = rng.choice(users)
+        if user["userId"] not in sessions:
+            n_sessions += 1
+            sessions[user["userId"]] = (day.toordinal() % 1000 * 1000000 + n_sessions, -1)
+        session_id, item = sessions[user["userId"]]
+        page = rng.choices(pages, weights)[0]
+
+        event = {"artist": None, "auth": "Logged In", "firstName": user["firstName"], "gender": user["gender"],\
+                 "itemInSession": item + 1, "lastName": user["lastName"], "length": None, "level": user["level"],\
+                 "location": user["location"], "method": "GET", "page": page, "registration": user["registration"],\
+                 "sessionId": session_id, "song": None, "status": 200, "ts": ts, "userAgent": user["userAgent"],\
+                 "userId": user["userId"]}
+
+        if page == "NextSong":
+            song = rng.choice(songs)
+            event.update(method="PUT", artist=song["artist_name"], song=song["title"], length=song["duration"])
+            if rng.random() < UNKNOWN_SONG_SHARE:
+                event["song"] = "Unknown song {}".format(rng.randrange(1000000))
+        elif page == "Upgrade":
+            user["level"] = "paid"
+        elif page == "Downgrade":
+            user["level"] = "free"
+
+        sessions[user["userId"]] = (session_id, item + 1)
+        if page == "Logout":
+            del sessions[user["userId"]]
+
+        yield event
+
+
+def generate_dataset(folder, n_users, n_songs, days, events_per_day, first_day=date(2018, 11, 1), seed=0):
+    """
+    This method writes a synthetic dataset with the layout of the S3 prefixes:
+
+        song_data/A/B/C/<song_id>.json, one song per file
+        log_data/YYYY/MM/YYYY-MM-DD-events.json, one file per day with one JSON event per line
+
+    Args:
+        folder (str): folder where the dataset is written
+        n_users (int): number of users
+        n_songs (int): number of songs
+        days (int): number of days of event logs
+        events_per_day (int): number of events of each day
+        first_day (datetime.date): first day of the event logs
+        seed (int): seed of the random generator, the same seed generates the same dataset
+
+    Returns:
+        summary (dict): number of songs, events and files written
+    """
+
+    rng = random.Random(seed)
+    songs = generate_songs(rng, n_songs)
+    users = generate_users(rng, n_users, first_day)
+
+    for song in songs:
+        song_folder = os.path.join(folder, "song_data", *song["song_id"][2:5])
+        os.makedirs(song_folder, exist_ok=True)
+        with open(os.path.join(song_folder, "{}.json".format(song["song_id"])), "w") as f:
+            json.dump(song, f)
+
+    n_events = 0
+    for i in range(days):
+        day = first_day + timedelta(days=i)
+        log_folder = os.path.join(folder, "log_data", "{:04d}".format(day.year), "{:02d}".format(day.month))
+        os.makedirs(log_folder, exist_ok=True)
+        with open(os.path.join(log_folder, "{}-events.json".format(day.isoformat())), "w") as f:
+            for event in generate_day(rng, day, users, songs, events_per_day):
+                f.write(json.dumps(event) + "\n")
+                n_events += 1
+
+    return {"songs": len(songs), "events": n_events, "song_files": len(songs), "log_files": days}
+
+
+def validate_logs(log_folder, output_folder):
+    """
+    This method validates the event logs with validate.py and writes the clean records as JSON-lines batches.
+
+    Args:
+        log_folder (str): folder with the event logs
+        output_folder (str): folder where the clean batches and the rejects are written
+
+    Returns:
+        summary (dict): number of clean and rejected records and paths of the batches
+    """
+
+    casters = event_casters(load_jsonpaths())
+
+    def records():
+        for path in json_files(log_folder):
+            with open(path, "rb") as f:
+                yield from stream_json_records(f)
+
+    return write_batches(validate_records(records(), casters), output_folder)
+
+
+def copy_records(cur, spec, records):
+    """
+    This method bulk-loads records into a table of the PostgreSQL stand-in with COPY FROM STDIN.
+    The records are spooled as CSV in a temporary file so the memory used does not depend on their number.
+
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        spec (schema.table_spec): specification of the target table
+        records (iterable): records keyed by column name
+
+    Returns:
+        n_records (int)
+    """
+
+    casters = [(column, column_caster(column_type)) for column, column_type in spec.columns]
+    n_records = 0
+
+    with tempfile.TemporaryFile("w+", newline="") as spool:
+        writer = csv.writer(spool)
+        for record in records:
+            values = [cast(record.get(column)) for column, cast in casters]
+            writer.writerow([NULL_MARKER if value is None else value for value in values])
+            n_records += 1
+        spool.seek(0)
+        columns = ", ".join(column for column, _ in spec.columns)
+        cur.copy_expert(stdin_csv_copy.format(spec.name, columns).strip(), spool)
+
+    return n_records
+
+
+def load_staging(cur, conn, batches, song_folder):
+    """
+    This method loads the clean event batches into staging_events and the song files into staging_songs.
+
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        conn (psycopg2.extensions.connection): psycopg2 connection object
+        batches (list): paths of the clean JSON-lines batches written by validate_logs
+        song_folder (str): folder with the song files
+
+    Returns:
+        timings (dict): seconds spent loading each staging table
+    """
+
+    def files(paths):
+        for path in paths:
+            with open(path, "rb") as f:
+                yield from stream_json_records(f)
+
+    timings = {}
+    for spec, paths in [(staging_events_table, batches), (staging_songs_table, json_files(song_folder))]:
+        start = time.perf_counter()
+        n_records = copy_records(cur, spec, files(paths))
+        conn.commit()
+        timings[spec.name] = time.perf_counter() - start
+        print("{} records loaded into {} in {:.2f}s".format(n_records, spec.name, timings[spec.name]))
+
+    return timings
+
+
+def export_worker(dsn, method, table, path, itersize, results):
+    """
+    This method exports a table to Parquet in a child process and puts the number of rows, the seconds
+    and the peak RSS of the process in results. With fetchall the whole table is read before it is written.
+
+    Args:
+        dsn (str): libpq connection string of the PostgreSQL stand-in
+        method (str): fetchall or stream
+        table (str): name of a table of export.EXPORT_TABLES
+        path (str): Parquet file written
+        itersize (int): rows fetched at once by the server-side cursor of the stream method
+        results (multiprocessing.Queue): queue the measures are put in
+    """
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    conn = psycopg2.connect(dsn)
+    start = time.perf_counter()
+    try:
+        if method == "fetchall":
+            spec = EXPORT_TABLES[table]
+            schema = export_schema(spec)
+            cur = conn.cursor()
+            cur.execute(table_select.format(", ".join(column for column, _ in spec.columns), spec.name))
+            rows = cur.fetchall()
+            columns = list(zip(*rows)) or [[] for _ in spec.columns]
+            pq.write_table(pa.Table.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, schema)],\
+                                                schema=schema), path)
+            n_rows = len(rows)
+        else:
+            n_rows = export_table(conn, table, path, itersize)
+    finally:
+        conn.close()
+
+    # ru_maxrss is in KB on Linux
+    results.put((n_rows, time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def benchmark_export(dsn, table="songplays", itersize=10000):
+    """
+    This method times the export of a table to Parquet with each method of EXPORT_METHODS.
+    Every method runs in a new process, so the peak RSS of one does not hide the other.
+
+    Args:
+        dsn (str): libpq connection string of the PostgreSQL stand-in
+        table (str): name of a table of export.EXPORT_TABLES
+        itersize (int): rows fetched at once by the server-side cursor of the stream method
+
+    Returns:
+        measures (dict): method -> {"rows", "seconds", "rows_per_second", "peak_rss_mb"}
+    """
+
+    context = multiprocessing.get_context("spawn")
+    measures = {}
+
+    with tempfile.TemporaryDirectory() as folder:
+        for method in EXPORT_METHODS:
+            results = context.Queue()
+            process = context.Process(target=export_worker, args=(dsn, method, table, os.path.join(folder, method + ".parquet"),\
+                                                                  itersize, results))
+            process.start()
+            n_rows, seconds, peak_rss_mb = results.get()
+            process.join()
+
+            measures[method] = {"rows": n_rows, "seconds": seconds, "rows_per_second": n_rows / max(seconds, 1e-9),\
+                                "peak_rss_mb": peak_rss_mb}
+            print("{} rows of {} exported with {} in {:.2f}s ({:.0f} rows/s, peak RSS {:.0f} MB)".format(n_rows, table,\
+                method, seconds, measures[method]["rows_per_second"], peak_rss_mb))
+
+    return measures
+
+
+def git_revision():
+    """
+    This method returns the git revision of the code being benchmarked.
+
+    Returns:
+        revision (str): short commit hash, None outside a git checkout
+    """
+
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,\
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(dsn, n_users, n_songs, days, events_per_day, seed=0, export_itersize=10000, skip_export=False):
+    """
+    This method generates a dataset, runs the pipeline against the PostgreSQL database dsn and times every stage.
+    The benchmark tables are dropped and created again before the run.
+
+    Args:
+        dsn (str): libpq connection string of the PostgreSQL stand-in
+        n_users (int): number of users
+        n_songs (int): number of songs
+        days (int): number of days of event logs
+        events_per_day (int): number of events of each day
+        seed (int): seed of the data generator
+        export_itersize (int): rows fetched at once by the streaming export
+        skip_export (bool): whether the export stage is left out
+
+    Returns:
+        results (dict): parameters, revision, seconds of each stage, rows of each table and export measures
+    """
+
+    results = {
+        "revision": git_revision(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "parameters": {"users": n_users, "songs": n_songs, "days": days, "events_per_day": events_per_day, "seed": seed},
+        "stages": {},
+        "rows": {},
+    }
+    stages = results["stages"]
+
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+
+    try:
+        for spec in BENCHMARK_TABLES:
+            cur.execute(drop_table(spec))
+            cur.execute(create_table(spec, dialect="postgres"))
+        conn.commit()
+
+        with tempfile.TemporaryDirectory() as folder:
+            start = time.perf_counter()
+            generated = generate_dataset(folder, n_users, n_songs, days, events_per_day, seed=seed)
+            stages["generate"] = time.perf_counter() - start
+            print("{} songs and {} events generated in {:.2f}s".format(generated["songs"], generated["events"],\
+                                                                       stages["generate"]))
+
+            start = time.perf_counter()
+            validated = validate_logs(os.path.join(folder, "log_data"), os.path.join(folder, "validated"))
+            stages["validate"] = time.perf_counter() - start
+            print("{} events validated in {:.2f}s ({} rejected)".format(validated["clean"], stages["validate"],\
+                                                                       validated["rejected"]))
+
+            for table, seconds in load_staging(cur, conn, validated["batches"], os.path.join(folder, "song_data")).items():
+                stages["load:{}".format(table)] = seconds
+
+        # The transforms are timed by the instrumentation of instrument.py, without the Redshift statistics
+        summary = summary_exporter()
+        metrics = recorder(exporters=[summary])
+        transform_cur = instrumented_cursor(conn.cursor(), metrics, query_stats=False)
+        for query in insert_table_queries:
+            transform_cur.execute(query)
+            conn.commit()
+        metrics.close()
+        for record in summary.records:
+            stages["transform:{}".format(record["label"])] = record["seconds"]
+
+        for spec in BENCHMARK_TABLES:
+            cur.execute("SELECT COUNT(*) FROM {}".format(spec.name))
+            results["rows"][spec.name] = cur.fetchone()[0]
+    finally:
+        conn.close()
+
+    if not skip_export:
+        results["export"] = benchmark_export(dsn, itersize=export_itersize)
+        for method, measures in results["export"].items():
+            stages["export:{}".format(method)] = measures["seconds"]
+
+    stages["total"] = sum(stages.values())
+
+    return results
+
+
+def compare(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """
+    This method prints the duration of each stage next to the one of a baseline run
+    and reports the stages that got slower by more than tolerance.
+
+    Args:
+        results (dict): results of the current run, as returned by run
+        baseline (dict): results of a previous run
+        tolerance (float): accepted slowdown ratio, 0.2 means 20% slower
+
+    Returns:
+        regressions (list): names of the stages slower than the baseline
+    """
+
+    if baseline["parameters"] != results["parameters"]:
+        print("Warning: the baseline was run with different parameters {}".format(baseline["parameters"]))
+
+    print("\n{:<32} {:>10} {:>10} {:>8}".format("Stage", "Baseline", "Current", "Change"))
+    regressions = []
+    for stage, seconds in results["stages"].items():
+        previous = baseline["stages"].get(stage)
+        if previous is None:
+            print("{:<32} {:>10} {:>10.2f} {:>8}".format(stage, "-", seconds, "new"))
+            continue
+        change = (seconds - previous) / previous if previous > 0 else 0.0
+        flag = ""
+        if change > tolerance:
+            regressions.append(stage)
+            flag = "  REGRESSION"
+        print("{:<32} {:>10.2f} {:>10.2f} {:>+7.0%}{}".format(stage, previous, seconds, change, flag))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ETL pipeline against a local PostgreSQL database")
+    parser.add_argument("--dsn", default=os.environ.get("BENCHMARK_DSN", "dbname=sparkify_bench"),
+                        help="libpq connection string of the PostgreSQL stand-in (BENCHMARK_DSN)")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--songs", type=int, default=2000)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--events-per-day", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--export-itersize", type=int, default=10000,
+                        help="rows fetched at once by the streaming export of songplays")
+    parser.add_argument("--skip-export", action="store_true", help="do not time the export of songplays to Parquet")
+    parser.add_argument("--output", default=None, help="JSON file the results are written to")
+    parser.add_argument("--baseline", default=None, help="JSON results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE,
+                        help="slowdown ratio above which a stage is reported as a regression")
+    args = parser.parse_args()
+
+    results = run(args.dsn, args.users, args.songs, args.days, args.events_per_day, args.seed, args.export_itersize,\
+                  args.skip_export)
+
+    output = args.output or os.path.join("benchmark_results", "{}.json".format(time.strftime("%Y%m%dT%H%M%S")))
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("\nResults of revision {} written to {}".format(results["revision"], output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            raise SystemExit("Stages slower than the baseline: {}".format(", ".join(regressions)))
+
+
+if __name__ == "__main__":
+    main()
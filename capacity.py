@@ -0,0 +1,210 @@
+"""
+This script contains the capacity controller that sizes the Redshift cluster around the ETL windows.
+
+The cluster is only busy while etl.py runs, so instead of keeping DWH_NUM_NODES nodes all the time:
+
+    1. before the run the cluster is resumed if it is paused and, when the pending input is large,
+       it is scaled up with an elastic resize (plan_capacity)
+    2. after the run it is resized back to DWH_NUM_NODES and/or paused, as set by IDLE_ACTION (plan_release)
+
+The decisions are pure functions of the cluster state returned by describe_clusters and of the settings
+in the [CAPACITY] section of dwh.cfg, so they can be checked without AWS. capacity_controller applies them
+with the boto3 Redshift client of lib.aws and waits for each operation with provision.wait_for_cluster.
+"""
+
+import asyncio
+import math
+
+from ingest import resolve_partitions
+from lib import list_s3_objects
+from provision import wait_for_cluster
+
+
+def elastic_resize_range(nodes):
+    """
+    This method returns the node counts an elastic resize can reach from the current one.
+    Elastic resize of dc2 and ra3 clusters can at most double or halve the number of nodes.
+
+    Args:
+        nodes (int): current number of nodes
+
+    Returns:
+        min_nodes (int)
+        max_nodes (int)
+    """
+
+    return max(1, math.ceil(nodes / 2)), nodes * 2
+
+
+def plan_capacity(cluster, pending_bytes, config):
+    """
+    This method decides what has to be done before an ETL run that loads pending_bytes of input.
+    The cluster is resumed when it is paused, once the pause is completed when it is still pausing, and it is
+    scaled up when its nodes are fewer than pending_bytes / GB_PER_NODE, within MIN_NODES and MAX_NODES.
+    The cluster is never scaled down before a run.
+
+    Args:
+        cluster (dict): cluster properties returned by describe_clusters
+        pending_bytes (int): size of the input to be loaded
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+
+    Returns:
+        actions (list): (action, nodes) tuples, with action wait_paused, resume or resize
+    """
+
+    actions = []
+    # a cluster cannot be resumed while it is pausing
+    if cluster['ClusterStatus'] == "pausing":
+        actions.append(("wait_paused", None))
+    if cluster['ClusterStatus'] in ("paused", "pausing"):
+        actions.append(("resume", None))
+
+    nodes = cluster['NumberOfNodes']
+    wanted = math.ceil(pending_bytes / config.capacity_bytes_per_node)
+    wanted = min(max(wanted, config.capacity_min_nodes), config.capacity_max_nodes)
+    target = min(wanted, elastic_resize_range(nodes)[1])
+    if target > nodes:
+        actions.append(("resize", target))
+
+    return actions
+
+
+def plan_release(cluster, config):
+    """
+    This method decides what has to be done once an ETL run is completed, following IDLE_ACTION:
+
+        none:   nothing
+        resize: the cluster is resized back to DWH_NUM_NODES
+        pause:  the cluster is resized back to DWH_NUM_NODES and paused, so it resumes with its usual size
+
+    Args:
+        cluster (dict): cluster properties returned by describe_clusters
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+
+    Returns:
+        actions (list): (action, nodes) tuples, with action resize or pause
+    """
+
+    if config.capacity_idle_action not in ("none", "resize", "pause"):
+        raise ValueError("Unknown IDLE_ACTION {}, expected none, resize or pause".format(config.capacity_idle_action))
+
+    actions = []
+    if config.capacity_idle_action == "none" or cluster['ClusterStatus'] in ("paused", "pausing"):
+        return actions
+
+    nodes = cluster['NumberOfNodes']
+    target = max(int(config.dwh_num_nodes), elastic_resize_range(nodes)[0])
+    if target != nodes:
+        actions.append(("resize", target))
+    if config.capacity_idle_action == "pause":
+        actions.append(("pause", None))
+
+    return actions
+
+
+def pending_input_bytes(s3, config, first_day=None, last_day=None, loaded_keys=None):
+    """
+    This method measures the input of an ETL run: the event logs of the date range (or all of them) and the song data.
+    For an incremental run the objects already loaded are left out.
+
+    Args:
+        s3 (boto3.resources.factory.s3.ServiceResource): boto3 S3 resource
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        first_day (datetime.date): first day of the event logs to be loaded (optional)
+        last_day (datetime.date): last day of the event logs to be loaded (optional)
+        loaded_keys (set): S3 URIs of the objects already loaded, as recorded in etl_loaded_keys (optional)
+
+    Returns:
+        pending_bytes (int)
+    """
+
+    if first_day is not None:
+        partitions = resolve_partitions(s3, config.log_data, first_day, last_day or first_day)
+        events = [obj for objects in partitions.values() for obj in objects]
+    else:
+        events = list_s3_objects(s3, config.log_data)
+
+    loaded_keys = loaded_keys or set()
+    return sum(size for uri, size in events + list_s3_objects(s3, config.song_data) if uri not in loaded_keys)
+
+
+class capacity_controller:
+    """
+    This class applies the capacity decisions to the Redshift cluster and waits until each operation is completed.
+
+    Attributes:
+        redshift: boto3 Redshift client
+        config: object that contains metadata information about the DWH setup (.cfg file)
+    """
+
+    def __init__(self, redshift, config):
+        self.redshift = redshift
+        self.config   = config
+
+    def describe(self):
+        """
+        This method returns the current properties of the cluster.
+
+        Returns:
+            cluster (dict)
+        """
+
+        return self.redshift.describe_clusters(ClusterIdentifier=self.config.dwh_cluster_identifier)['Clusters'][0]
+
+    def apply(self, actions):
+        """
+        This method runs the actions one after the other and waits for each of them.
+
+        Args:
+            actions (list): (action, nodes) tuples as returned by plan_capacity or plan_release
+        """
+
+        identifier = self.config.dwh_cluster_identifier
+        for action, nodes in actions:
+            if action == "wait_paused":
+                print("Waiting for the Redshift cluster {} to be paused before resuming it".format(identifier))
+                asyncio.run(wait_for_cluster(self.redshift, self.config, "paused"))
+            elif action == "resume":
+                print("Resuming the Redshift cluster {}".format(identifier))
+                self.redshift.resume_cluster(ClusterIdentifier=identifier)
+                asyncio.run(wait_for_cluster(self.redshift, self.config, "available"))
+            elif action == "resize":
+                print("Resizing the Redshift cluster {} to {} nodes".format(identifier, nodes))
+                self.redshift.resize_cluster(ClusterIdentifier=identifier, NumberOfNodes=nodes, Classic=False)
+                asyncio.run(wait_for_cluster(self.redshift, self.config, "available", nodes))
+            elif action == "pause":
+                print("Pausing the Redshift cluster {}".format(identifier))
+                self.redshift.pause_cluster(ClusterIdentifier=identifier)
+                asyncio.run(wait_for_cluster(self.redshift, self.config, "paused"))
+            else:
+                raise ValueError("Unknown capacity action {}".format(action))
+
+    def ensure_running(self):
+        """
+        This method resumes the cluster if it is paused, so connections can be opened.
+        It is only called when a script starts: a cluster paused while the script runs is not resumed.
+        """
+
+        self.apply([action for action in plan_capacity(self.describe(), 0, self.config)\
+                    if action[0] in ("wait_paused", "resume")])
+
+    def prepare(self, pending_bytes):
+        """
+        This method gets the cluster ready for an ETL run that loads pending_bytes of input.
+
+        Args:
+            pending_bytes (int): size of the input to be loaded
+        """
+
+        actions = plan_capacity(self.describe(), pending_bytes, self.config)
+        print("{:.2f} GB of input pending, capacity actions: {}".format(pending_bytes / 2**30, actions or "none"))
+        self.apply(actions)
+
+    def release(self):
+        """
+        This method scales the cluster back and/or pauses it once the ETL run is completed.
+        """
+
+        actions = plan_release(self.describe(), self.config)
+        print("ETL window closed, capacity actions: {}".format(actions or "none"))
+        self.apply(actions)
@@ -0,0 +1,367 @@
+"""
+This script contains the conversion stage that rewrites the raw log and song JSON into formats that
+Redshift loads faster and that move less data out of S3:
+
+    gzip / zstd: compressed JSON-lines, loaded with COPY ... json '<jsonpaths>' GZIP/ZSTD
+    parquet:     columnar files with the columns of the staging table, loaded with COPY ... FORMAT AS PARQUET
+
+The input files are parsed as a stream and the output is written in chunks, so files of any size are
+converted in bounded memory. The zstd and parquet formats need the optional packages zstandard and pyarrow.
+
+It can be run locally, for example against the files in data_sample/:
+
+    $ python convert.py data_sample/log-events.json /tmp/log-events.parquet --table staging_events --format parquet
+"""
+
+import argparse
+import gzip
+import json
+import os
+import tempfile
+
+from lib import parse_s3_uri
+from schema import staging_events_table, staging_songs_table
+
+# Data formats produced by the conversion and the extension of the converted files
+FORMAT_EXTENSIONS = {
+    "gzip": ".json.gz",
+    "zstd": ".json.zst",
+    "parquet": ".parquet",
+}
+
+STAGING_TABLES = {
+    "staging_events": staging_events_table,
+    "staging_songs": staging_songs_table,
+}
+
+# Number of records written at once in a Parquet row group
+ROW_GROUP_SIZE = 100000
+
+# Size of the chunks read from the input files
+READ_CHUNK_BYTES = 1024 * 1024
+
+
+def stream_json_records(fileobj, chunk_bytes=READ_CHUNK_BYTES):
+    """
+    This method yields the JSON documents of a file that contains JSON lines or concatenated (even pretty-printed)
+    JSON documents. The file is read in chunks so only the documents being parsed are kept in memory.
+
+    Args:
+        fileobj (file): binary file-like object
+        chunk_bytes (int): size of the chunks read from the file
+
+    Yields:
+        record (dict)
+    """
+
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pending = b""
+
+    while True:
+        chunk = fileobj.read(chunk_bytes)
+        data = pending + chunk
+        # keep the incomplete UTF-8 sequence at the end of the chunk for the next read
+        try:
+            text = data.decode("utf-8")
+            pending = b""
+        except UnicodeDecodeError as e:
+            if not chunk or e.start < len(data) - 3:
+                raise
+            text, pending = data[:e.start].decode("utf-8"), data[e.start:]
+        buffer += text
+
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position == len(buffer):
+                break
+            try:
+                record, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if not chunk:
+                    raise
+                break
+            yield record
+        buffer = buffer[position:]
+
+        if not chunk:
+            return
+
+
+def column_caster(column_type):
+    """
+    This method returns the function that converts a JSON value into the Python value of a staging column.
+    Values that cannot be converted (like an empty userId) become None.
+
+    Args:
+        column_type (str): column type as declared in schema.py
+
+    Returns:
+        cast (callable)
+    """
+
+    base_type = column_type.split("(")[0].split(" ")[0].upper()
+
+    if base_type in ("INT", "INTEGER", "SMALLINT", "BIGINT"):
+        def cast(value):
+            try:
+                return int(float(value)) if value not in (None, "") else None
+            except (TypeError, ValueError):
+                return None
+    elif base_type in ("FLOAT", "REAL", "DOUBLE"):
+        def cast(value):
+            try:
+                return float(value) if value not in (None, "") else None
+            except (TypeError, ValueError):
+                return None
+    else:
+        def cast(value):
+            return None if value is None else str(value)
+
+    return cast
+
+
+def arrow_schema(spec):
+    """
+    This method builds the Arrow schema of a staging table. The column order is the one of the table
+    since COPY FORMAT AS PARQUET maps the columns by position.
+
+    Args:
+        spec (schema.table_spec): staging table specification
+
+    Returns:
+        schema (pyarrow.Schema)
+    """
+
+    import pyarrow as pa
+
+    arrow_types = {"INT": pa.int32(), "INTEGER": pa.int32(), "SMALLINT": pa.int16(), "BIGINT": pa.int64(),\
+                   "FLOAT": pa.float64(), "REAL": pa.float32(), "DOUBLE": pa.float64()}
+
+    return pa.schema([(column, arrow_types.get(column_type.split("(")[0].upper(), pa.string()))\
+                      for column, column_type in spec.columns])
+
+
+class jsonl_writer:
+    """
+    This class writes records as compressed JSON-lines.
+
+    Attributes:
+        stream: compressed output stream
+    """
+
+    def __init__(self, fileobj, data_format):
+        if data_format == "gzip":
+            self.stream = gzip.GzipFile(fileobj=fileobj, mode="wb")
+        else:
+            import zstandard
+            self.stream = zstandard.ZstdCompressor().stream_writer(fileobj, closefd=False)
+
+    def write(self, records):
+        for record in records:
+            self.stream.write((json.dumps(record) + "\n").encode("utf-8"))
+
+    def close(self):
+        self.stream.close()
+
+
+class parquet_writer:
+    """
+    This class writes records as Parquet row groups with the columns of a staging table.
+
+    Attributes:
+        spec: staging table specification
+    """
+
+    def __init__(self, fileobj, spec):
+        import pyarrow.parquet as pq
+
+        self.spec     = spec
+        self._schema  = arrow_schema(spec)
+        self._casters = [(column, column_caster(column_type)) for column, column_type in spec.columns]
+        self._writer  = pq.ParquetWriter(fileobj, self._schema, compression="snappy")
+
+    def write(self, records):
+        import pyarrow as pa
+
+        columns = {column: [] for column, _ in self._casters}
+        for record in records:
+            for column, cast in self._casters:
+                columns[column].append(cast(record.get(column)))
+        self._writer.write_table(pa.Table.from_pydict(columns, schema=self._schema))
+
+    def close(self):
+        self._writer.close()
+
+
+def open_writer(fileobj, data_format, spec):
+    """
+    This method returns the writer of a data format.
+
+    Args:
+        fileobj (file): binary file-like object the converted data is written to
+        data_format (str): gzip, zstd or parquet
+        spec (schema.table_spec): staging table specification
+
+    Returns:
+        writer (convert.jsonl_writer or convert.parquet_writer)
+    """
+
+    if data_format not in FORMAT_EXTENSIONS:
+        raise ValueError("Unknown format {}, expected one of {}".format(data_format, sorted(FORMAT_EXTENSIONS)))
+
+    if data_format == "parquet":
+        return parquet_writer(fileobj, spec)
+    return jsonl_writer(fileobj, data_format)
+
+
+def chunks(records, size):
+    """
+    This method groups a stream of records into lists of at most size records.
+
+    Args:
+        records (iterable): records
+        size (int): maximum number of records of each list
+
+    Yields:
+        chunk (list)
+    """
+
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def convert_records(records, fileobj, data_format, spec, row_group_size=ROW_GROUP_SIZE):
+    """
+    This method writes a stream of records into a file with the given data format.
+
+    Args:
+        records (iterable): records to convert
+        fileobj (file): binary file-like object the converted data is written to
+        data_format (str): gzip, zstd or parquet
+        spec (schema.table_spec): staging table specification
+        row_group_size (int): records written at once
+
+    Returns:
+        n_records (int)
+    """
+
+    writer = open_writer(fileobj, data_format, spec)
+    n_records = 0
+    try:
+        for chunk in chunks(records, row_group_size):
+            writer.write(chunk)
+            n_records += len(chunk)
+    finally:
+        writer.close()
+
+    return n_records
+
+
+def convert_file(input_path, output_path, data_format, table):
+    """
+    This method converts a local JSON file.
+
+    Args:
+        input_path (str): path of the raw JSON file
+        output_path (str): path of the converted file
+        data_format (str): gzip, zstd or parquet
+        table (str): staging table the file is loaded into, staging_events or staging_songs
+
+    Returns:
+        n_records (int)
+    """
+
+    with open(input_path, "rb") as source, open(output_path, "wb") as target:
+        return convert_records(stream_json_records(source), target, data_format, STAGING_TABLES[table])
+
+
+def convert_s3_objects(s3, objects, target_prefix, data_format, table, part_records=1000000,\
+                       row_group_size=ROW_GROUP_SIZE):
+    """
+    This method converts S3 objects and writes the result under target_prefix as parts of at most part_records
+    records. The input objects are read as streams, the records are written row_group_size at a time and each 
+    part is spooled in a temporary file before being uploaded, so the memory used does not depend on the size 
+    of the input.
+
+    Args:
+        s3 (boto3.resources.factory.s3.ServiceResource): boto3 S3 resource
+        objects (list): list of (S3 URI, size in bytes) tuples to convert
+        target_prefix (str): S3 URI of the folder where the converted objects are written
+        data_format (str): gzip, zstd or parquet
+        table (str): staging table the objects are loaded into, staging_events or staging_songs
+        part_records (int): maximum number of records of each converted object
+        row_group_size (int): records written at once
+
+    Returns:
+        converted (list): list of (S3 URI, size in bytes) tuples of the converted objects
+    """
+
+    bucket_name, prefix = parse_s3_uri(target_prefix.rstrip("/"))
+    spec = STAGING_TABLES[table]
+
+    def records():
+        for uri, _ in objects:
+            source_bucket, key = parse_s3_uri(uri)
+            body = s3.Object(source_bucket, key).get()["Body"]
+            try:
+                yield from stream_json_records(body)
+            finally:
+                body.close()
+
+    converted = []
+    part = {"spool": None, "writer": None, "records": 0}
+
+    def close_part():
+        part["writer"].close()
+        key = "{}/part-{:05d}{}".format(prefix, len(converted), FORMAT_EXTENSIONS[data_format])
+        size = part["spool"].tell()
+        part["spool"].seek(0)
+        s3.Object(bucket_name, key).put(Body=part["spool"])
+        part["spool"].close()
+        converted.append(("s3://{}/{}".format(bucket_name, key), size))
+        part.update(spool=None, writer=None, records=0)
+
+    for chunk in chunks(records(), min(row_group_size, part_records)):
+        # a chunk that does not fit in the current part is split across the next one
+        while chunk:
+            if part["writer"] is None:
+                part["spool"] = tempfile.TemporaryFile()
+                part["writer"] = open_writer(part["spool"], data_format, spec)
+            head, chunk = chunk[:part_records - part["records"]], chunk[part_records - part["records"]:]
+            part["writer"].write(head)
+            part["records"] += len(head)
+            if part["records"] >= part_records:
+                close_part()
+
+    if part["writer"] is not None:
+        close_part()
+
+    print("{} objects converted to {} into {} objects under {}".format(len(objects), data_format, len(converted), target_prefix))
+
+    return converted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert raw log or song JSON into compressed JSON-lines or Parquet")
+    parser.add_argument("input", help="local JSON file")
+    parser.add_argument("output", help="converted file")
+    parser.add_argument("--table", choices=sorted(STAGING_TABLES), required=True)
+    parser.add_argument("--format", choices=sorted(FORMAT_EXTENSIONS), default="gzip")
+    args = parser.parse_args()
+
+    n_records = convert_file(args.input, args.output, args.format, args.table)
+    print("{} records written to {} ({} -> {} bytes)".format(n_records, args.output,\
+                                                             os.path.getsize(args.input), os.path.getsize(args.output)))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,11 +2,15 @@
 This script is designed to create the DW's tables
 """
 
+import argparse
 import configparser
 import psycopg2
 import boto3
 from lib import aws_config, aws
-from lib import redshift_connection
+from lib import shared_pool
+from instrument import build_recorder, instrumented_cursor
+from capacity import capacity_controller
+from wlm import tag_session
 from sql_queries import create_table_queries, drop_table_queries
 
 def drop_tables(cur, conn):
@@ -44,6 +48,13 @@ def create_tables(cur, conn):
         
 
 def main():
+    parser = argparse.ArgumentParser(description="Drop and create the tables of the DWH")
+    parser.add_argument("--metrics", default=None, 
+                        help="JSON-lines file the timing and query id of each statement are appended to")
+    parser.add_argument("--statsd", default=None, metavar="HOST:PORT", 
+                        help="StatsD server the statement metrics are sent to")
+    args = parser.parse_args()
+    
     # To be done by the developer/user of this code: 
     # Edit the configuration file ./dwh.cfg according to your use-case
     # REMEMBER TO NOT EXPOSE LIVE TOKENS/PASSWORDS IN GIT/GITHUB!
@@ -55,14 +66,26 @@ def main():
     
     redshift = aws_clients.redshift
     
-    # The method redshift_connection is used to stablish a connection to the Redshift database
-    conn, cur = redshift_connection(redshift, config)
+    # The cluster is resumed if it has been paused after the last ETL run
+    capacity_controller(redshift, config).ensure_running()
+    
+    # The method shared_pool is used to take a connection to the Redshift database from the connection pool
+    pool = shared_pool(redshift, config)
+    
+    metrics = build_recorder(args.metrics, args.statsd)
     
-    # Drop operation followed by the creation DDLs of the tables that will be hosted in the database
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
+    with pool.connection() as conn:
+        cur = instrumented_cursor(conn.cursor(), metrics)
+        
+        # The DDL runs in the ETL queue of the WLM (see wlm.py)
+        tag_session(cur, conn, config, "ddl")
+        
+        # Drop operation followed by the creation DDLs of the tables that will be hosted in the database
+        drop_tables(cur, conn)
+        create_tables(cur, conn)
 
-    conn.close()
+    metrics.close()
+    pool.closeall()
 
     
 if __name__ == "__main__":
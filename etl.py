@@ -6,15 +6,77 @@ This script encapsulates the ETL pipeline that performs the following actions:
             s3://udacity-dend/staging_songs -> sparkify:staging_songs
     
     2. Re-organize the raw data in a star-shaped schema.
+
+With the --incremental flag only the S3 objects not ingested in previous runs are copied 
+and only the events newer than the stored high-water mark are transformed.
+
+With --from and --to only the daily partitions of the event logs in that date range are copied 
+and transformed. The days already loaded are skipped, so a failed run can be resumed.
+
+With --max-errors the COPYs skip the malformed lines instead of failing, and the rejected lines 
+are normalized and copied again before the transforms (see repair.py).
+
+With --publish swap the tables are rebuilt into shadow tables and renamed into place in a single 
+transaction, so the readers never see a partial load (see publish.py).
+
+After the transforms the summary tables are refreshed for the time range of the events transformed 
+(see summaries.py), then the tables with too many unsorted rows or stale statistics are vacuumed 
+and analyzed (see maintenance.py).
+
+A full run records its completed stages in a run ledger. If it fails, the next run with the same input 
+skips them and starts again from the stage that failed, unless --restart is given (see ledger.py).
+
+The statements of the load, transform and maintenance stages are tagged with the WLM query group 
+of the stage, so they run in the ETL queue of the cluster instead of the queue of the analysts (see wlm.py).
 """
 
+import argparse
 import configparser
+import time
+from datetime import date, datetime, timedelta, timezone
 import psycopg2
 from lib import aws_config, aws
-from lib import redshift_connection
-from sql_queries import copy_table_queries, insert_table_queries
+from lib import shared_pool
+from lib import list_s3_objects, write_manifest
+from ingest import cluster_slices, compact_objects, copy_in_batches, resolve_partitions, DEFAULT_BATCH_BYTES
+from convert import convert_s3_objects, FORMAT_EXTENSIONS
+from scheduler import step, run_dag, print_report
+from instrument import build_recorder, instrumented_cursor, instrumented_connection
+from capacity import capacity_controller, pending_input_bytes
+from repair import repair_staging_loads
+from maintenance import run_maintenance
+from publish import publish_tables
+from summaries import transformed_range, refresh_summaries
+from result_cache import publish_version
+from wlm import workload
+from ledger import run_ledger, input_fingerprint
+from sql_queries import query_catalog
+from sql_queries import song_lookup_build, songplay_table_insert, user_table_insert, song_table_insert
+from sql_queries import artist_table_insert, time_table_insert
+from sql_queries import incremental_insert_table_queries
+from sql_queries import staging_events_table_truncate, staging_songs_table_truncate
+from sql_queries import watermark_select, watermark_delete, watermark_insert
+from sql_queries import loaded_keys_select, loaded_keys_insert, loaded_keys_delete, loaded_keys_values_insert
+from sql_queries import late_events_select
+from sql_queries import partitions_loaded_select, partition_loaded_insert, staging_events_range_delete
+from sql_queries import range_insert_table_queries
 
-def load_staging_tables(cur, conn, config):
+def truncate_staging_tables(cur, conn):
+    """
+    This method is used to empty the staging tables before a full load, so they only hold the input 
+    of the current run and running the ETL again does not duplicate the staging rows.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        conn (psycopg2.extensions.connection): psycopg2 connection object
+    """
+    
+    cur.execute(staging_songs_table_truncate)
+    cur.execute(staging_events_table_truncate)
+    conn.commit()
+
+
+def load_staging_tables(cur, conn, config, queries):
     """
     This method is used to load ingest the raw data located in S3 into into Redshift. 
     The data ingestion is the following:
@@ -26,6 +88,7 @@ def load_staging_tables(cur, conn, config):
         cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
         conn (psycopg2.extensions.connection): psycopg2 connection object
         config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        queries (sql_queries.query_catalog): catalog that renders the COPY statements
     """
     
     song_data_uri = config.song_data
@@ -35,33 +98,532 @@ def load_staging_tables(cur, conn, config):
     print_songs = "\nCopying song data\nS3 URI: {}".format(song_data_uri)
     print_events = "\nCopying event logs\nS3 URI: {}".format(events_data_uri)
     
-    for query, out in zip(copy_table_queries, [print_songs, print_events]):
+    truncate_staging_tables(cur, conn)
+    
+    for query, out in zip(queries.copy_table_queries, [print_songs, print_events]):
         print(out)
         cur.execute(query)
         conn.commit()
 
 
-def insert_tables(cur, conn, config):
+def full_load_keys(s3, config):
+    """
+    This method lists the S3 objects copied by a full load, recorded in etl_loaded_keys once the load is transformed.
+    
+    Args:
+        s3 (boto3.resources.factory.s3.ServiceResource): boto3 S3 resource
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+    
+    Returns:
+        loaded_keys (dict): S3 URIs of the objects of each staging table
+    """
+    
+    return {source: [obj_uri for obj_uri, _ in list_s3_objects(s3, uri)]\
+            for source, uri in [("staging_songs", config.song_data), ("staging_events", config.log_data)]}
+
+
+def full_load_bookkeeping(loaded_keys):
+    """
+    This method renders the bookkeeping of a full load that the incremental loads start from: the high-water mark 
+    of the events transformed, MAX(ts) of staging_events, and the S3 objects copied, which replace the ones 
+    recorded before. It is meant to run in the transaction of the songplays insert, so the next incremental 
+    load neither copies these objects again nor transforms their events a second time.
+    
+    Args:
+        loaded_keys (dict): S3 URIs copied for each staging table, as returned by full_load_keys
+    
+    Returns:
+        query (str)
+    """
+    
+    queries = [watermark_delete.strip() + ";", watermark_insert.format(0).strip() + ";"]
+    for source, uris in loaded_keys.items():
+        queries.append(loaded_keys_delete.format(source).strip())
+        if uris:
+            rows = ", ".join("('{}', '{}', GETDATE())".format(source, uri.replace("'", "''")) for uri in uris)
+            queries.append(loaded_keys_values_insert.format(rows).strip())
+    
+    return "\n".join(queries)
+
+
+def full_load_steps(loaded_keys=None):
+    """
+    This method returns the steps of a full load, with the bookkeeping of the load in the songplays step.
+    
+    Args:
+        loaded_keys (dict): S3 URIs copied for each staging table, no bookkeeping when None
+    
+    Returns:
+        steps (list): list of scheduler.step objects
+    """
+    
+    if loaded_keys is None:
+        return insert_table_steps
+    
+    return [step(s.name, s.query.rstrip().rstrip(";") + ";\n" + full_load_bookkeeping(loaded_keys), s.depends_on)\
+            if s.name == "songplays" else s for s in insert_table_steps]
+
+
+def insert_tables(cur, conn, config, ledger=None, loaded_keys=None):
     """
     This method is used to re-allocate the log and song data present in the staging tables 
     across the database tables: songplays, users, songs, artists and time. 
     This way, the information in the database is modeled in a star-shaped schema  
+    With a run ledger, the inserts completed by the resumed run are skipped and each insert 
+    is recorded in the ledger in its own transaction.
     
     Args:
         cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
         conn (psycopg2.extensions.connection): psycopg2 connection object
         config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        ledger (ledger.run_ledger): ledger of the run (optional)
+        loaded_keys (dict): S3 URIs copied by the load, recorded with the songplays insert (optional)
     """
     
     print("\nIngesting data into songplays, users, songs, artists and time tables\n")
     
-    for query in insert_table_queries:
-        print(query+"\n")
-        cur.execute(query)
+    for s in full_load_steps(loaded_keys):
+        if ledger is not None and ledger.done(s.name):
+            continue
+        print(s.query+"\n")
+        cur.execute(s.query)
+        if ledger is not None:
+            ledger.record(cur, s.name)
+        conn.commit()
+
+
+# Dependencies between the transforms: the dimensions, time included, only read the staging tables 
+# and songplays is joined to the song lookup
+insert_table_steps = [
+    step("song_lookup", song_lookup_build),
+    step("songplays", songplay_table_insert, depends_on=["song_lookup"]),
+    step("users", user_table_insert),
+    step("songs", song_table_insert),
+    step("artists", artist_table_insert),
+    step("time", time_table_insert),
+]
+
+
+def insert_tables_parallel(acquire, release, max_workers, ledger=None, loaded_keys=None):
+    """
+    This method runs the inserts of insert_table_steps in parallel, each step on its own connection, 
+    respecting their dependencies. The duration of each step and the critical path are reported at the end.
+    With a run ledger, the steps completed by the resumed run are skipped and each step records itself.
+    
+    Args:
+        acquire (callable): returns a psycopg2 connection
+        release (callable): gives a connection back once a step is completed
+        max_workers (int): maximum number of queries running at the same time
+        ledger (ledger.run_ledger): ledger of the run (optional)
+        loaded_keys (dict): S3 URIs copied by the load, recorded with the songplays insert (optional)
+    """
+    
+    steps = full_load_steps(loaded_keys)
+    if ledger is not None:
+        steps = ledger.pending_steps(steps)
+    if not steps:
+        return
+    
+    print("\nIngesting data into songplays, users, songs, artists and time tables with {} workers\n".format(max_workers))
+    
+    timings = run_dag(steps, acquire, release, max_workers=max_workers)
+    print_report(steps, timings)
+
+
+def loaded_s3_keys(cur, source):
+    """
+    This method returns the S3 objects already ingested into a staging table, as recorded in etl_loaded_keys.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        source (str): name of the staging table
+    
+    Returns:
+        loaded (set): S3 URIs of the objects
+    """
+    
+    cur.execute(loaded_keys_select, (source,))
+    
+    return set(row[0] for row in cur.fetchall())
+
+
+def new_s3_objects(cur, s3, source, uri):
+    """
+    This method returns the S3 objects located under the prefix uri that were not ingested yet.
+    The objects already ingested are read from the control table etl_loaded_keys.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        s3 (boto3.resources.factory.s3.ServiceResource): boto3 S3 resource
+        source (str): name of the staging table fed by the prefix
+        uri (str): S3 URI of the prefix
+    
+    Returns:
+        new_objects (list): (S3 URI, size in bytes) tuples of the objects not ingested yet
+    """
+    
+    loaded = loaded_s3_keys(cur, source)
+    
+    return [(obj_uri, size) for obj_uri, size in list_s3_objects(s3, uri) if obj_uri not in loaded]
+
+
+def copy_objects(cur, conn, config, s3, queries, source, objects, run_id, compact=False,\
+                 batch_bytes=DEFAULT_BATCH_BYTES, data_format=None):
+    """
+    This method loads a list of S3 objects into a staging table with one manifest COPY per balanced batch.
+    With compact=True the objects are first merged into larger gzip'd JSON-lines objects under STAGING_PREFIX.
+    With data_format (gzip, zstd or parquet) the objects are first converted into that format under STAGING_PREFIX.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        conn (psycopg2.extensions.connection): psycopg2 connection object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        s3 (boto3.resources.factory.s3.ServiceResource): boto3 S3 resource
+        queries (sql_queries.query_catalog): catalog that renders the COPY statements
+        source (str): staging table name, staging_events or staging_songs
+        objects (list): (S3 URI, size in bytes) tuples of the objects to load
+        run_id (str): identifier of the run used in the S3 paths of the manifests and compacted objects
+        compact (bool): merge the objects into larger gzip'd objects before loading them
+        batch_bytes (int): target size in bytes of each COPY batch
+        data_format (str): format the objects are converted into before loading them (optional)
+    """
+    
+    if config.manifest_prefix is None:
+        raise ValueError("MANIFEST_PREFIX must be set in the [S3] section of dwh.cfg to load from manifests")
+    
+    copy = {
+        "staging_events": queries.staging_events_manifest_copy,
+        "staging_songs": queries.staging_songs_manifest_copy,
+    }[source]
+    
+    if compact or data_format is not None:
+        if config.staging_prefix is None:
+            raise ValueError("STAGING_PREFIX must be set in the [S3] section of dwh.cfg to rewrite the input objects")
+        target_prefix = "{}/{}/{}".format(config.staging_prefix.rstrip("/"), run_id, source)
+        if data_format is not None:
+            objects = convert_s3_objects(s3, objects, target_prefix, data_format, source)
+        else:
+            objects = compact_objects(s3, objects, target_prefix)
+            data_format = "gzip"
+    
+    manifest_prefix = "{}/{}/{}".format(config.manifest_prefix.rstrip("/"), run_id, source)
+    copy_in_batches(cur, conn, s3, objects, manifest_prefix, lambda manifest_uri: copy(manifest_uri, data_format),\
+                    cluster_slices(config, cur), batch_bytes)
+
+
+def load_staging_tables_batched(cur, conn, config, s3, queries, compact_songs=False, batch_bytes=DEFAULT_BATCH_BYTES,\
+                                data_format=None):
+    """
+    This method is used to load the whole LOG_DATA and SONG_DATA prefixes with one manifest COPY 
+    per balanced batch instead of a single COPY per prefix.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        conn (psycopg2.extensions.connection): psycopg2 connection object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        s3 (boto3.resources.factory.s3.ServiceResource): boto3 S3 resource
+        queries (sql_queries.query_catalog): catalog that renders the COPY statements
+        compact_songs (bool): merge the song files into larger gzip'd objects before loading them
+        batch_bytes (int): target size in bytes of each COPY batch
+        data_format (str): format the objects are converted into before loading them (optional)
+    """
+    
+    run_id = time.strftime("%Y%m%dT%H%M%S")
+    
+    truncate_staging_tables(cur, conn)
+    
+    for source, uri, compact in [("staging_songs", config.song_data, compact_songs),\
+                                 ("staging_events", config.log_data, False)]:
+        print("\nCopying {} in batches\nS3 URI: {}".format(source, uri))
+        copy_objects(cur, conn, config, s3, queries, source, list_s3_objects(s3, uri), run_id, compact, batch_bytes,\
+                     data_format)
+
+
+def load_staging_tables_incremental(cur, conn, config, s3, queries, compact_songs=False,\
+                                    batch_bytes=DEFAULT_BATCH_BYTES, data_format=None):
+    """
+    This method is used to load into Redshift only the S3 objects that were not ingested in previous runs.
+    The new objects are copied in balanced batches by means of generated manifests. staging_events is 
+    truncated beforehand so it holds only the delta of the current run, while staging_songs keeps the 
+    whole song catalog that the songplays join needs.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        conn (psycopg2.extensions.connection): psycopg2 connection object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        s3 (boto3.resources.factory.s3.ServiceResource): boto3 S3 resource
+        queries (sql_queries.query_catalog): catalog that renders the COPY statements
+        compact_songs (bool): merge the new song files into larger gzip'd objects before loading them
+        batch_bytes (int): target size in bytes of each COPY batch
+        data_format (str): format the objects are converted into before loading them (optional)
+    
+    Returns:
+        new_keys (dict): S3 URIs copied in this run for each staging table
+    """
+    
+    run_id = time.strftime("%Y%m%dT%H%M%S")
+    
+    cur.execute(staging_events_table_truncate)
+    conn.commit()
+    
+    new_keys = {}
+    for source, uri, compact in [("staging_songs", config.song_data, compact_songs),\
+                                 ("staging_events", config.log_data, False)]:
+        new_objects = new_s3_objects(cur, s3, source, uri)
+        new_keys[source] = [obj_uri for obj_uri, _ in new_objects]
+        print("\n{} new objects found under {}".format(len(new_objects), uri))
+        if not new_objects:
+            continue
+        
+        copy_objects(cur, conn, config, s3, queries, source, new_objects, run_id, compact, batch_bytes, data_format)
+    
+    return new_keys
+
+
+def insert_tables_incremental(cur, conn, new_keys):
+    """
+    This method is used to transform the staging rows newer than the stored high-water mark.
+    The inserts, the new high-water mark and the list of ingested S3 objects are committed 
+    in a single transaction so a failed run can be repeated without duplicating data.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        conn (psycopg2.extensions.connection): psycopg2 connection object
+        new_keys (dict): S3 URIs copied in this run for each staging table
+    """
+    
+    cur.execute(watermark_select)
+    watermark = cur.fetchone()[0]
+    
+    cur.execute(late_events_select.format(watermark))
+    late_events = cur.fetchone()[0]
+    if late_events:
+        print("\n{} NextSong events of the new objects are not newer than ts={} and are not transformed, "\
+              "load their days again with --from/--to".format(late_events, watermark))
+    
+    print("\nIngesting events newer than ts={} into songplays, users, songs, artists and time tables\n".format(watermark))
+    
+    try:
+        for query in incremental_insert_table_queries:
+            query = query.format(watermark)
+            print(query+"\n")
+            cur.execute(query)
+        
+        cur.execute(watermark_delete)
+        cur.execute(watermark_insert.format(watermark))
+        for source, uris in new_keys.items():
+            cur.executemany(loaded_keys_insert, [(source, uri) for uri in uris])
         conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def day_bounds(first_day, last_day):
+    """
+    This method returns the epoch-ms bounds of a range of days, like the ts column of staging_events.
+    
+    Args:
+        first_day (datetime.date): first day of the range
+        last_day (datetime.date): last day of the range, included
+    
+    Returns:
+        start_ms (int): first millisecond of first_day (UTC)
+        end_ms (int): first millisecond of the day after last_day (UTC)
+    """
+    
+    def epoch_ms(day):
+        return int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp()) * 1000
+    
+    return epoch_ms(first_day), epoch_ms(last_day + timedelta(days=1))
+
+
+def partition_prefix(config, day):
+    """
+    This method returns the S3 prefix of the event logs of a day: log_data/YYYY/MM/YYYY-MM-DD-events
+    
+    Args:
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        day (datetime.date): day of the partition
+    
+    Returns:
+        uri (str)
+    """
+    
+    return "{}/{:04d}/{:02d}/{}-events".format(config.log_data.rstrip("/"), day.year, day.month, day.isoformat())
+
+
+def load_partitions(cur, conn, config, s3, queries, first_day, last_day, acquire, release, max_workers=1,\
+                    mode="parallel"):
+    """
+    This method is used to load into staging_events the daily partitions of the event logs between 
+    first_day and last_day. The days recorded in etl_partitions are skipped. The events of each day are 
+    deleted before it is copied and the day is recorded in the same transaction as its COPY, so a day is 
+    either loaded completely or not at all and a failed run can be resumed.
+    
+        parallel: one COPY per day, up to max_workers days at the same time on separate connections
+        manifest: a single COPY of all the pending days from a generated manifest
+    
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        conn (psycopg2.extensions.connection): psycopg2 connection object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        s3 (boto3.resources.factory.s3.ServiceResource): boto3 S3 resource
+        queries (sql_queries.query_catalog): catalog that renders the COPY statements
+        first_day (datetime.date): first day of the range
+        last_day (datetime.date): last day of the range, included
+        acquire (callable): returns a psycopg2 connection for the parallel COPYs
+        release (callable): gives a connection back once a COPY is completed
+        max_workers (int): maximum number of days copied at the same time
+        mode (str): parallel or manifest
+    
+    Returns:
+        loaded (list): days loaded in this run
+    """
+    
+    partitions = resolve_partitions(s3, config.log_data, first_day, last_day)
+    
+    cur.execute(partitions_loaded_select, (first_day, last_day))
+    done = set(row[0] for row in cur.fetchall())
+    pending = [day for day in partitions if day not in done]
+    
+    n_days = (last_day - first_day).days + 1
+    print("\n{} of {} days between {} and {} have event logs: {} already loaded, {} to load".format(\
+        len(partitions), n_days, first_day, last_day, len(partitions) - len(pending), len(pending)))
+    if not pending:
+        return []
+    
+    def day_query(day):
+        return staging_events_range_delete.format(*day_bounds(day, day)) +\
+            queries.staging_events_prefix_copy(partition_prefix(config, day)) +\
+            partition_loaded_insert.format(day.isoformat(), partition_prefix(config, day))
+    
+    if mode == "manifest":
+        if config.manifest_prefix is None:
+            raise ValueError("MANIFEST_PREFIX must be set in the [S3] section of dwh.cfg to load from manifests")
+        manifest_uri = "{}/{}/staging_events-{}-{}.manifest".format(config.manifest_prefix.rstrip("/"),\
+                                                                    time.strftime("%Y%m%dT%H%M%S"), pending[0], pending[-1])
+        objects = [obj for day in pending for obj in partitions[day]]
+        write_manifest(s3, manifest_uri, [uri for uri, _ in objects], [size for _, size in objects])
+        
+        query = "".join(staging_events_range_delete.format(*day_bounds(day, day)) for day in pending) +\
+            queries.staging_events_manifest_copy(manifest_uri) +\
+            "".join(partition_loaded_insert.format(day.isoformat(), partition_prefix(config, day)) for day in pending)
+        try:
+            cur.execute(query)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    else:
+        steps = [step(day.isoformat(), day_query(day)) for day in pending]
+        timings = run_dag(steps, acquire, release, max_workers=max_workers)
+        print_report(steps, timings)
+    
+    return pending
+
+
+def load_new_songs(cur, conn, config, s3, queries, compact_songs=False, batch_bytes=DEFAULT_BATCH_BYTES, data_format=None):
+    """
+    This method is used to copy into staging_songs only the song files that were not ingested in previous runs.
+    The files copied are recorded in etl_loaded_keys right away since staging_songs keeps the whole song catalog.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        conn (psycopg2.extensions.connection): psycopg2 connection object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        s3 (boto3.resources.factory.s3.ServiceResource): boto3 S3 resource
+        queries (sql_queries.query_catalog): catalog that renders the COPY statements
+        compact_songs (bool): merge the new song files into larger gzip'd objects before loading them
+        batch_bytes (int): target size in bytes of each COPY batch
+        data_format (str): format the objects are converted into before loading them (optional)
+    """
+    
+    new_objects = new_s3_objects(cur, s3, "staging_songs", config.song_data)
+    print("\n{} new objects found under {}".format(len(new_objects), config.song_data))
+    if not new_objects:
+        return
+    
+    copy_objects(cur, conn, config, s3, queries, "staging_songs", new_objects, time.strftime("%Y%m%dT%H%M%S"),\
+                 compact_songs, batch_bytes, data_format)
+    cur.executemany(loaded_keys_insert, [("staging_songs", uri) for uri, _ in new_objects])
+    conn.commit()
+
+
+def insert_tables_range(cur, conn, first_day, last_day):
+    """
+    This method is used to transform the events of a range of days. The songplays of the range are 
+    replaced and the dimensions are upserted, all in a single transaction, so a range can be transformed 
+    again without duplicating data.
+    
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        conn (psycopg2.extensions.connection): psycopg2 connection object
+        first_day (datetime.date): first day of the range
+        last_day (datetime.date): last day of the range, included
+    """
+    
+    start_ms, end_ms = day_bounds(first_day, last_day)
+    
+    print("\nIngesting the events from {} to {} into songplays, users, songs, artists and time tables\n".format(first_day, last_day))
+    
+    try:
+        for query in range_insert_table_queries:
+            query = query.format(start_ms, end_ms)
+            print(query+"\n")
+            cur.execute(query)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Sparkify ETL pipeline")
+    parser.add_argument("--incremental", action="store_true", 
+                        help="load only the new S3 objects and transform only the events past the high-water mark")
+    parser.add_argument("--batched", action="store_true", 
+                        help="copy the S3 objects in balanced batches from generated manifests")
+    parser.add_argument("--compact-songs", action="store_true", 
+                        help="merge the small song files into larger gzip'd JSON-lines objects before copying them")
+    parser.add_argument("--format", choices=sorted(FORMAT_EXTENSIONS), default=None, 
+                        help="convert the raw JSON into compressed JSON-lines or Parquet before copying it")
+    parser.add_argument("--batch-mb", type=int, default=DEFAULT_BATCH_BYTES // 2**20, 
+                        help="target size in MB of each COPY batch")
+    parser.add_argument("--workers", type=int, default=1, 
+                        help="number of transform queries (or days with --from) run in parallel on separate connections")
+    parser.add_argument("--from", dest="from_day", type=date.fromisoformat, default=None, metavar="YYYY-MM-DD", 
+                        help="first day of the event logs to load and transform")
+    parser.add_argument("--to", dest="to_day", type=date.fromisoformat, default=None, metavar="YYYY-MM-DD", 
+                        help="last day of the event logs to load and transform, --from by default")
+    parser.add_argument("--partition-load", choices=["parallel", "manifest"], default="parallel", 
+                        help="copy the days of the range in parallel (--workers at a time) or with a single manifest COPY")
+    parser.add_argument("--max-errors", type=int, default=None, metavar="N", 
+                        help="let each COPY skip up to N malformed lines, then quarantine, normalize and copy them again")
+    parser.add_argument("--publish", choices=["direct", "swap"], default="direct", 
+                        help="insert into the live tables or rebuild shadow tables and swap them in at once")
+    parser.add_argument("--skip-maintenance", action="store_true", 
+                        help="do not vacuum and analyze the tables above the thresholds of dwh.cfg after the transforms")
+    parser.add_argument("--autoscale", action="store_true", 
+                        help="scale the cluster up for the pending input and scale it back or pause it afterwards")
+    parser.add_argument("--metrics", default=None, 
+                        help="JSON-lines file the timing, row count and query id of each statement are appended to")
+    parser.add_argument("--statsd", default=None, metavar="HOST:PORT", 
+                        help="StatsD server the statement metrics are sent to")
+    parser.add_argument("--restart", action="store_true", 
+                        help="start from the COPYs even if the last full run failed with the same input")
+    args = parser.parse_args()
+    
+    if args.to_day is not None and args.from_day is None:
+        parser.error("--to requires --from")
+    if args.from_day is not None and args.incremental:
+        parser.error("--from/--to and --incremental cannot be combined")
+    if args.publish == "swap" and (args.from_day is not None or args.incremental):
+        parser.error("--publish swap rebuilds the tables from the whole staging area, it cannot be combined "\
+                     "with --from/--to or --incremental")
+    if args.max_errors is not None and args.format in ("zstd", "parquet"):
+        parser.error("--max-errors can only repair raw or gzip'd JSON, not --format {}".format(args.format))
+    
     # To be done by the developer/user of this code: 
     # Edit the configuration file ./dwh.cfg according to your use-case
     # REMEMBER TO NOT EXPOSE LIVE TOKENS/PASSWORDS IN GIT/GITHUB!
@@ -70,9 +632,38 @@ def main():
     # the aws_config and aws classes can be found in the file lib.py
     config = aws_config(config_path)
     aws_clients = aws(config)
+    if args.max_errors is not None and config.quarantine_prefix is None:
+        parser.error("--max-errors requires QUARANTINE_PREFIX in the [S3] section of dwh.cfg")
+    # the main connection is held for the whole run, the load statistics are read on another one (see instrument.py)
+    # and the workers share the rest of the pool
+    if args.workers + 2 > config.pool_max_connections:
+        parser.error("--workers {} needs {} connections, MAX_CONNECTIONS of the [CONNECTION_POOL] section of dwh.cfg "\
+                     "is {}".format(args.workers, args.workers + 2, config.pool_max_connections))
     
     redshift = aws_clients.redshift
-    conn, cur = redshift_connection(redshift, config)
+    # The cluster is resumed if it is paused, before the pool opens its first connections (see capacity.py)
+    controller = capacity_controller(redshift, config)
+    controller.ensure_running()
+    
+    # The connections of the main process and of the parallel workers are taken from the same pool
+    pool = shared_pool(redshift, config)
+    
+    # With --autoscale the cluster is resized for the pending input, without the objects already loaded
+    # by the previous runs when the run is incremental
+    if args.autoscale:
+        already_loaded = set()
+        if args.incremental:
+            with pool.connection() as keys_conn:
+                with keys_conn.cursor() as keys_cur:
+                    for source in ("staging_events", "staging_songs"):
+                        already_loaded |= loaded_s3_keys(keys_cur, source)
+                keys_conn.rollback()
+        controller.prepare(pending_input_bytes(aws_clients.s3, config, args.from_day, args.to_day, already_loaded))
+    
+    conn = pool.getconn()
+    # Every statement is timed and its row count and query id are recorded (see instrument.py)
+    metrics = build_recorder(args.metrics, args.statsd)
+    cur = instrumented_cursor(conn.cursor(), metrics, stats_connection=pool.connection)
     bucket = aws_clients.s3.Bucket("udacity-dend")
     
     # Uncomment these lines to visualize the S3 paths of the song_data
@@ -83,12 +674,99 @@ def main():
     """
     
     rolearn_dwhS3 = aws_clients.iam.get_role(RoleName=config.iam_role_name)['Role']['Arn']
+    queries = query_catalog(config, rolearn_dwhS3, args.max_errors, metrics.run_id)
     
-    load_staging_tables(cur, conn, config)
+    batch_bytes = args.batch_mb * 2**20
     
-    insert_tables(cur, conn, config)
-
-    conn.close()
+    # The sessions are tagged with the WLM query group of each stage, the worker connections too (see wlm.py)
+    wlm_stages = workload(config, args.workers)
+    acquire = wlm_stages.tagged(lambda: instrumented_connection(pool.getconn(), metrics, pool.connection))
+    release = wlm_stages.untagged(lambda worker_conn: pool.putconn(worker_conn.connection))
+    
+    # A full run resumes the last run if it failed with the same input, the incremental and 
+    # date-range runs are only recorded (see ledger.py)
+    # The S3 objects of a full run are always listed into the fingerprint, so the next run can resume it
+    # even when this one was started with --restart, which only keeps the completed stages from being read back
+    full_load = args.from_day is None and not args.incremental
+    options = {"from": args.from_day, "to": args.to_day, "incremental": args.incremental, "batched": args.batched,\
+               "compact_songs": args.compact_songs, "format": args.format, "max_errors": args.max_errors,\
+               "publish": args.publish}
+    ledger = run_ledger(cur, conn, metrics.run_id, input_fingerprint(aws_clients.s3, config, options, full_load),\
+                        resume=full_load and not args.restart)
+    
+    try:
+        # The objects of a full load are recorded with its transform, so the next incremental load starts after them
+        if full_load:
+            loaded_keys = full_load_keys(aws_clients.s3, config)
+        
+        # The COPYs commit before the load is recorded, so a load that did not complete is run again
+        # from empty staging tables: both full-load paths truncate them first
+        wlm_stages.enter(cur, conn, "load")
+        if args.from_day is not None:
+            last_day = args.to_day or args.from_day
+            load_new_songs(cur, conn, config, aws_clients.s3, queries, args.compact_songs, batch_bytes, args.format)
+            load_partitions(cur, conn, config, aws_clients.s3, queries, args.from_day, last_day, acquire, release,\
+                            args.workers, args.partition_load)
+        elif args.incremental:
+            new_keys = load_staging_tables_incremental(cur, conn, config, aws_clients.s3, queries,\
+                                                       args.compact_songs, batch_bytes, args.format)
+        elif ledger.done("load"):
+            pass
+        elif args.batched or args.compact_songs or args.format:
+            load_staging_tables_batched(cur, conn, config, aws_clients.s3, queries, args.compact_songs, batch_bytes,\
+                                        args.format)
+        else:
+            load_staging_tables(cur, conn, config, queries)
+        
+        # The lines rejected by the COPYs are quarantined, normalized and copied again (see repair.py)
+        if args.max_errors is not None and "load" not in ledger.completed:
+            repair_staging_loads(cur, conn, config, aws_clients.s3, queries, metrics.run_id)
+        ledger.complete(cur, conn, "load")
+        
+        wlm_stages.enter(cur, conn, "transform")
+        if args.from_day is not None:
+            insert_tables_range(cur, conn, args.from_day, last_day)
+        elif args.incremental:
+            insert_tables_incremental(cur, conn, new_keys)
+        elif args.publish == "swap":
+            if not ledger.done("publish"):
+                publish_tables(cur, conn, acquire, release, args.workers, full_load_bookkeeping(loaded_keys))
+                ledger.complete(cur, conn, "publish")
+        elif args.workers > 1:
+            insert_tables_parallel(acquire, release, args.workers, ledger, loaded_keys)
+        else:
+            insert_tables(cur, conn, config, ledger, loaded_keys)
+        
+        # The summary tables are recomputed for the time buckets of the events transformed by this run
+        if args.from_day is not None:
+            start_ms, end_ms = day_bounds(args.from_day, last_day)
+            refresh_summaries(cur, conn, start_ms, end_ms - 1)
+        elif not ledger.done("summaries"):
+            refresh_summaries(cur, conn, *transformed_range(cur))
+        ledger.complete(cur, conn, "summaries")
+        
+        # The query results cached before this run are no longer served (see result_cache.py)
+        publish_version(cur, conn)
+        
+        if not args.skip_maintenance and not ledger.done("maintenance"):
+            wlm_stages.enter(cur, conn, "maintenance")
+            run_maintenance(cur, conn, config)
+            ledger.complete(cur, conn, "maintenance")
+        
+        ledger.finish(cur, conn)
+    except Exception:
+        # The failure is recorded so the next run resumes from the stage that failed
+        try:
+            ledger.finish(cur, conn, "failed")
+        except Exception as e:
+            print("The failure of the run {} could not be recorded: {}".format(ledger.run_id, e))
+        raise
+    finally:
+        metrics.close()
+        pool.putconn(conn)
+        pool.closeall()
+        if args.autoscale:
+            controller.release()
     
     print("ETL completed")
 
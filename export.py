@@ -0,0 +1,255 @@
+"""
+This script contains the export of the tables of the DWH, or of any query, to Arrow and Parquet.
+
+cur.fetchall() on a plain cursor pulls the whole result into Python tuples at once. The export reads the
+result through a server-side (named) cursor instead: the rows are fetched itersize at a time, each batch
+is turned into an Arrow record batch or written as a Parquet row group and dropped, so the memory used
+depends on itersize and not on the size of the table.
+
+A Redshift cursor is materialized on the leader node before the first fetch, so for the largest tables
+the data can instead be unloaded to S3 by the compute nodes in parallel (UNLOAD ... PARALLEL ON), one
+Parquet file per slice. The IAM role of the cluster needs write access to the prefix.
+
+    $ python export.py songplays --output /tmp/songplays.parquet --itersize 50000
+    $ python export.py songplays --unload s3://my-bucket/exports/songplays/
+
+The type of the columns of a table comes from its specification in schema.py, the one of an ad-hoc
+query is inferred from the first batch. Exporting needs the optional package pyarrow.
+"""
+
+import argparse
+import itertools
+import time
+
+from capacity import capacity_controller
+from lib import aws_config, aws, redshift_connection
+from schema import summary_tables
+from sql_queries import published_tables, table_select, unload_parquet
+
+# Tables that can be exported by name
+EXPORT_TABLES = {spec.name: spec for spec in published_tables + [summary.table for summary in summary_tables]}
+
+# Names of the server-side cursors, unique within a connection
+_cursor_ids = itertools.count(1)
+
+
+def export_schema(spec):
+    """
+    This method builds the Arrow schema of the rows of a table, as returned by psycopg2.
+
+    Args:
+        spec (schema.table_spec): table specification
+
+    Returns:
+        schema (pyarrow.Schema)
+    """
+
+    import pyarrow as pa
+
+    arrow_types = {"SMALLINT": pa.int16(), "INT": pa.int32(), "INTEGER": pa.int32(), "BIGINT": pa.int64(),\
+                   "FLOAT": pa.float64(), "REAL": pa.float32(), "DOUBLE": pa.float64(), "BOOLEAN": pa.bool_(),\
+                   "DATE": pa.date32(), "TIMESTAMP": pa.timestamp("us")}
+
+    fields = []
+    for column, column_type in spec.columns:
+        base_type = column_type.split("(")[0].split(" ")[0].upper()
+        if base_type in ("DECIMAL", "NUMERIC"):
+            precision, scale = column_type[column_type.index("(") + 1:column_type.index(")")].split(",")
+            fields.append((column, pa.decimal128(int(precision), int(scale))))
+        else:
+            fields.append((column, arrow_types.get(base_type, pa.string())))
+
+    return pa.schema(fields)
+
+
+def stream_rows(conn, query, args=None, itersize=10000):
+    """
+    This method runs a query on a server-side cursor and yields its rows in batches of itersize rows,
+    together with the names of the columns.
+    The cursor lives in the transaction of the connection, which is committed once the rows are read.
+
+    Args:
+        conn (psycopg2.extensions.connection): psycopg2 connection object, not in autocommit mode
+        query (str): SELECT statement
+        args: query parameters, as in cursor.execute
+        itersize (int): rows fetched from the server at once
+
+    Yields:
+        names (list): column names
+        rows (list): tuples of at most itersize rows
+    """
+
+    cur = conn.cursor(name="export_{}".format(next(_cursor_ids)))
+    cur.itersize = itersize
+    try:
+        cur.execute(query, args)
+        while True:
+            rows = cur.fetchmany(itersize)
+            if not rows:
+                break
+            yield [column[0] for column in cur.description], rows
+    finally:
+        cur.close()
+        conn.commit()
+
+
+def record_batches(conn, query, schema=None, args=None, itersize=10000):
+    """
+    This method streams the result of a query as Arrow record batches.
+
+    Args:
+        conn (psycopg2.extensions.connection): psycopg2 connection object, not in autocommit mode
+        query (str): SELECT statement
+        schema (pyarrow.Schema): types of the columns, inferred from the first batch when None
+        args: query parameters, as in cursor.execute
+        itersize (int): rows of each batch
+
+    Yields:
+        batch (pyarrow.RecordBatch)
+    """
+
+    import pyarrow as pa
+
+    for names, rows in stream_rows(conn, query, args, itersize):
+        columns = list(zip(*rows))
+        if schema is None:
+            arrays = [pa.array(column) for column in columns]
+            # a column without any value in the first batch is exported as a string
+            schema = pa.schema([(name, pa.string() if array.type == pa.null() else array.type)\
+                                for name, array in zip(names, arrays)])
+        yield pa.RecordBatch.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, schema)],\
+                                         schema=schema)
+
+
+def export_parquet(conn, query, path, schema=None, args=None, itersize=10000):
+    """
+    This method writes the result of a query to a Parquet file, one row group per batch of itersize rows.
+
+    Args:
+        conn (psycopg2.extensions.connection): psycopg2 connection object, not in autocommit mode
+        query (str): SELECT statement
+        path (str): Parquet file written
+        schema (pyarrow.Schema): types of the columns, inferred from the first batch when None
+        args: query parameters, as in cursor.execute
+        itersize (int): rows of each row group
+
+    Returns:
+        n_rows (int)
+    """
+
+    import pyarrow.parquet as pq
+
+    writer = None
+    n_rows = 0
+    try:
+        for batch in record_batches(conn, query, schema, args, itersize):
+            if writer is None:
+                writer = pq.ParquetWriter(path, batch.schema, compression="snappy")
+            writer.write_batch(batch)
+            n_rows += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is None and schema is not None:
+        # an empty result still gives a file with the columns of the table
+        pq.write_table(schema.empty_table(), path)
+
+    return n_rows
+
+
+def export_table(conn, table, path, itersize=10000):
+    """
+    This method writes a table of the DWH to a Parquet file with the column types of schema.py.
+
+    Args:
+        conn (psycopg2.extensions.connection): psycopg2 connection object, not in autocommit mode
+        table (str): name of a table of EXPORT_TABLES
+        path (str): Parquet file written
+        itersize (int): rows of each row group
+
+    Returns:
+        n_rows (int)
+    """
+
+    spec = EXPORT_TABLES[table]
+    query = table_select.format(", ".join(column for column, _ in spec.columns), spec.name)
+
+    return export_parquet(conn, query, path, export_schema(spec), itersize=itersize)
+
+
+def unload_query(query, s3_uri, role_arn):
+    """
+    This method renders the UNLOAD of a query to an S3 prefix as Parquet files written by all the slices.
+
+    Args:
+        query (str): SELECT statement
+        s3_uri (str): S3 prefix of the files
+        role_arn (str): ARN role that allows Redshift to write to S3
+
+    Returns:
+        query (str)
+    """
+
+    return unload_parquet.format(query.strip().rstrip(";").replace("'", "''"), s3_uri, role_arn)
+
+
+def unload_table(cur, conn, table, s3_uri, role_arn):
+    """
+    This method unloads a table of the DWH to S3 as Parquet files, in parallel on the compute nodes.
+
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        conn (psycopg2.extensions.connection): psycopg2 connection object
+        table (str): name of a table of EXPORT_TABLES
+        s3_uri (str): S3 prefix of the files
+        role_arn (str): ARN role that allows Redshift to write to S3
+    """
+
+    spec = EXPORT_TABLES[table]
+    query = table_select.format(", ".join(column for column, _ in spec.columns), spec.name)
+
+    try:
+        cur.execute(unload_query(query, s3_uri, role_arn))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export a table of the DWH to Parquet")
+    parser.add_argument("table", choices=sorted(EXPORT_TABLES))
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--output", default=None, help="local Parquet file the table is streamed to")
+    target.add_argument("--unload", default=None, metavar="S3_URI",
+                        help="S3 prefix the table is unloaded to by the compute nodes (UNLOAD ... PARALLEL ON)")
+    parser.add_argument("--itersize", type=int, default=None,
+                        help="rows fetched at once by the server-side cursor, ITERSIZE of the [EXPORT] section by default")
+    args = parser.parse_args()
+
+    # To be done by the developer/user of this code:
+    # Edit the configuration file ./dwh.cfg according to your use-case
+    # REMEMBER TO NOT EXPOSE LIVE TOKENS/PASSWORDS IN GIT/GITHUB!
+    config = aws_config("./dwh.cfg")
+    aws_clients = aws(config)
+    capacity_controller(aws_clients.redshift, config).ensure_running()
+
+    conn, cur = redshift_connection(aws_clients.redshift, config)
+    start = time.time()
+    try:
+        if args.unload is not None:
+            role_arn = aws_clients.iam.get_role(RoleName=config.iam_role_name)['Role']['Arn']
+            unload_table(cur, conn, args.table, args.unload, role_arn)
+            print("{} unloaded to {} in {:.2f}s".format(args.table, args.unload, time.time() - start))
+        else:
+            n_rows = export_table(conn, args.table, args.output, args.itersize or config.export_itersize)
+            seconds = time.time() - start
+            print("{} rows of {} exported to {} in {:.2f}s ({:.0f} rows/s)".format(n_rows, args.table, args.output,\
+                                                                                 seconds, n_rows / max(seconds, 1e-9)))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,330 @@
+"""
+This script contains the pre-ingest stage that prepares the S3 objects before they are copied into the staging area.
+
+Redshift COPY loads the files of a single command in parallel, one file per slice at a time, so the best
+throughput is reached when each COPY reads a number of files that is a multiple of the number of slices
+and the files have similar sizes. The song dataset is the worst case: tens of thousands of tiny JSON files
+with one song each. The methods below:
+
+    1. list the objects of a prefix (lib.list_s3_objects)
+    2. optionally compact the tiny files into larger gzip'd JSON-lines objects
+    3. group the objects into balanced batches whose size is a multiple of the slice count
+    4. COPY every batch by means of a generated manifest
+
+All the S3 operations go through a boto3 S3 resource, so the class local_s3 can be used instead to run them
+against a local directory.
+"""
+
+import gzip
+import json
+import math
+import os
+import re
+from collections import deque
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from lib import list_s3_objects, parse_s3_uri, write_manifest
+
+# Slices per node of each node type
+# See https://docs.aws.amazon.com/redshift/latest/mgmt/working-with-clusters.html#rs-node-type-info
+SLICES_PER_NODE = {
+    "dc2.large": 2,
+    "dc2.8xlarge": 16,
+    "ds2.xlarge": 2,
+    "ds2.8xlarge": 16,
+    "ra3.xlplus": 2,
+    "ra3.4xlarge": 4,
+    "ra3.16xlarge": 16,
+}
+
+# Name of the daily event log files: log_data/YYYY/MM/YYYY-MM-DD-events.json
+PARTITION_PATTERN = re.compile(r"(\d{4})-(\d{2})-(\d{2})-events[^/]*$")
+
+# Size of the batches (and of the compacted objects) the objects are grouped into
+DEFAULT_BATCH_BYTES = 256 * 1024 * 1024
+DEFAULT_COMPACTED_BYTES = 64 * 1024 * 1024
+
+
+class local_s3:
+    """
+    This class is a local stand-in of the boto3 S3 resource that stores the buckets as folders of a local directory.
+    It implements the subset of the API used by this repository: Bucket(name).objects.filter(Prefix=...),
+    Object(bucket, key).put(Body=...) and Object(bucket, key).get()['Body'].read().
+
+    Attributes:
+        root: local directory that contains one folder per bucket
+    """
+
+    class _object_summary:
+        def __init__(self, key, size):
+            self.key  = key
+            self.size = size
+
+    class _objects:
+        def __init__(self, path):
+            self.path = path
+
+        def filter(self, Prefix=""):
+            if not os.path.isdir(self.path):
+                return []
+            summaries = []
+            for folder, _, files in os.walk(self.path):
+                for name in files:
+                    full_path = os.path.join(folder, name)
+                    key = os.path.relpath(full_path, self.path).replace(os.sep, "/")
+                    if key.startswith(Prefix):
+                        summaries.append(local_s3._object_summary(key, os.path.getsize(full_path)))
+            return sorted(summaries, key=lambda summary: summary.key)
+
+    class _bucket:
+        def __init__(self, path):
+            self.objects = local_s3._objects(path)
+
+    class _object:
+        def __init__(self, path):
+            self.path = path
+
+        def put(self, Body):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, "wb") as f:
+                f.write(Body if isinstance(Body, bytes) else Body.read())
+
+        def get(self):
+            return {"Body": open(self.path, "rb")}
+
+    def __init__(self, root):
+        self.root = root
+
+    def Bucket(self, name):
+        return local_s3._bucket(os.path.join(self.root, name))
+
+    def Object(self, bucket_name, key):
+        return local_s3._object(os.path.join(self.root, bucket_name, *key.split("/")))
+
+
+def cluster_slices(config, cur=None):
+    """
+    This method returns the number of slices of the cluster. If a cursor is given the slices are counted
+    in the system table stv_slices, otherwise they are derived from the node type and number of nodes in dwh.cfg.
+
+    Args:
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database (optional)
+
+    Returns:
+        slices (int)
+    """
+
+    if cur is not None:
+        cur.execute("SELECT COUNT(*) FROM stv_slices")
+        return cur.fetchone()[0]
+
+    return SLICES_PER_NODE.get(config.dwh_node_type, 2) * int(config.dwh_num_nodes)
+
+
+def plan_batches(objects, slices, batch_bytes=DEFAULT_BATCH_BYTES):
+    """
+    This method groups S3 objects into batches to be loaded by separate COPY commands.
+    Every batch but the last one holds the same number of files, a multiple of the number of slices chosen
+    so the batches hold around batch_bytes, and the last batch holds the remaining files. The files are
+    assigned largest first to the lightest batch that is not full so the batches, and the files each slice
+    reads, have similar sizes.
+
+    Args:
+        objects (list): list of (S3 URI, size in bytes) tuples
+        slices (int): number of slices of the cluster
+        batch_bytes (int): target size of a batch in bytes
+
+    Returns:
+        batches (list): list of batches, each of them a list of (S3 URI, size in bytes) tuples
+    """
+
+    if not objects:
+        return []
+
+    average_size = max(1, sum(size for _, size in objects) / len(objects))
+    files_per_batch = max(slices, int(batch_bytes / average_size) // slices * slices)
+    n_batches = math.ceil(len(objects) / files_per_batch)
+    capacities = [files_per_batch] * (n_batches - 1) + [len(objects) - files_per_batch * (n_batches - 1)]
+
+    batches = [[] for _ in range(n_batches)]
+    batch_sizes = [0] * n_batches
+    for uri, size in sorted(objects, key=lambda obj: obj[1], reverse=True):
+        open_batches = [i for i in range(n_batches) if len(batches[i]) < capacities[i]]
+        lightest = min(open_batches, key=lambda i: batch_sizes[i])
+        batches[lightest].append((uri, size))
+        batch_sizes[lightest] += size
+
+    return batches
+
+
+def read_s3_object(s3, uri):
+    """
+    This method reads the content of an S3 object.
+
+    Args:
+        s3 (boto3.resources.factory.s3.ServiceResource): boto3 S3 resource
+        uri (str): S3 URI of the object
+
+    Returns:
+        body (bytes)
+    """
+
+    bucket_name, key = parse_s3_uri(uri)
+    body = s3.Object(bucket_name, key).get()["Body"]
+    try:
+        return body.read()
+    finally:
+        body.close()
+
+
+def json_records(body):
+    """
+    This method yields the JSON records of a file that contains either a single JSON document or JSON lines.
+
+    Args:
+        body (bytes): file content
+
+    Yields:
+        record (dict)
+    """
+
+    text = body.decode("utf-8").strip()
+    if not text:
+        return
+    try:
+        yield json.loads(text)
+    except json.JSONDecodeError:
+        for line in text.splitlines():
+            if line.strip():
+                yield json.loads(line)
+
+
+def compact_objects(s3, objects, target_prefix, compacted_bytes=DEFAULT_COMPACTED_BYTES, max_workers=16):
+    """
+    This method merges many small JSON objects into larger gzip'd JSON-lines objects written under target_prefix.
+    The small objects are downloaded in parallel, with at most twice max_workers downloads submitted at once
+    so the bodies waiting to be merged do not pile up in memory. The compacted objects are loaded with the GZIP
+    option of COPY.
+
+    Args:
+        s3 (boto3.resources.factory.s3.ServiceResource): boto3 S3 resource
+        objects (list): list of (S3 URI, size in bytes) tuples to compact
+        target_prefix (str): S3 URI of the folder where the compacted objects are written
+        compacted_bytes (int): uncompressed size in bytes after which a compacted object is closed
+        max_workers (int): number of parallel downloads
+
+    Returns:
+        compacted (list): list of (S3 URI, size in bytes) tuples of the compacted objects
+    """
+
+    bucket_name, prefix = parse_s3_uri(target_prefix.rstrip("/"))
+    compacted = []
+    lines = []
+    lines_bytes = 0
+
+    def flush():
+        key = "{}/part-{:05d}.json.gz".format(prefix, len(compacted))
+        body = gzip.compress("".join(lines).encode("utf-8"))
+        s3.Object(bucket_name, key).put(Body=body)
+        compacted.append(("s3://{}/{}".format(bucket_name, key), len(body)))
+
+    def merge(body):
+        nonlocal lines, lines_bytes
+        for record in json_records(body):
+            line = json.dumps(record) + "\n"
+            lines.append(line)
+            lines_bytes += len(line)
+        if lines_bytes >= compacted_bytes:
+            flush()
+            lines, lines_bytes = [], 0
+
+    # the downloads are merged in the order of the objects
+    in_flight = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for uri, _ in objects:
+            in_flight.append(executor.submit(read_s3_object, s3, uri))
+            if len(in_flight) >= 2 * max_workers:
+                merge(in_flight.popleft().result())
+        while in_flight:
+            merge(in_flight.popleft().result())
+
+    if lines:
+        flush()
+
+    print("{} objects compacted into {} gzip'd JSON-lines objects under {}".format(len(objects), len(compacted), target_prefix))
+
+    return compacted
+
+
+def copy_in_batches(cur, conn, s3, objects, manifest_prefix, copy, slices, batch_bytes=DEFAULT_BATCH_BYTES):
+    """
+    This method loads S3 objects with one COPY per balanced batch. A manifest is written for every batch
+    and each COPY is committed on its own.
+
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        conn (psycopg2.extensions.connection): psycopg2 connection object
+        s3 (boto3.resources.factory.s3.ServiceResource): boto3 S3 resource
+        objects (list): list of (S3 URI, size in bytes) tuples to load
+        manifest_prefix (str): S3 URI of the folder where the manifests are written
+        copy (callable): renders the COPY statement of a manifest URI
+        slices (int): number of slices of the cluster
+        batch_bytes (int): target size of a batch in bytes
+
+    Returns:
+        manifests (list): S3 URIs of the manifests loaded
+    """
+
+    batches = plan_batches(objects, slices, batch_bytes)
+    print("{} objects grouped in {} batches for {} slices".format(len(objects), len(batches), slices))
+
+    manifests = []
+    for i, batch in enumerate(batches):
+        manifest_uri = "{}/batch-{:05d}.manifest".format(manifest_prefix.rstrip("/"), i)
+        write_manifest(s3, manifest_uri, [uri for uri, _ in batch], [size for _, size in batch])
+        cur.execute(copy(manifest_uri))
+        conn.commit()
+        manifests.append(manifest_uri)
+
+    return manifests
+
+
+def resolve_partitions(s3, log_data, first_day, last_day):
+    """
+    This method finds the daily partitions of the event logs between two days (both included).
+    The event logs are partitioned as log_data/YYYY/MM/YYYY-MM-DD-events.json, so only the 
+    month prefixes of the range are listed.
+
+    Args:
+        s3 (boto3.resources.factory.s3.ServiceResource): boto3 S3 resource
+        log_data (str): S3 URI of the event logs, like s3://udacity-dend/log_data
+        first_day (datetime.date): first day of the range
+        last_day (datetime.date): last day of the range
+
+    Returns:
+        partitions (dict): day (datetime.date) -> list of (S3 URI, size in bytes) tuples of the day, sorted by day
+    """
+
+    if first_day > last_day:
+        raise ValueError("The first day {} is after the last day {}".format(first_day, last_day))
+
+    months = []
+    day = first_day.replace(day=1)
+    while day <= last_day:
+        months.append(day)
+        day = (day + timedelta(days=32)).replace(day=1)
+
+    partitions = {}
+    for month in months:
+        month_uri = "{}/{:04d}/{:02d}/".format(log_data.rstrip("/"), month.year, month.month)
+        for uri, size in list_s3_objects(s3, month_uri):
+            match = PARTITION_PATTERN.search(uri)
+            if match is None:
+                continue
+            day = date(*(int(part) for part in match.groups()))
+            if first_day <= day <= last_day:
+                partitions.setdefault(day, []).append((uri, size))
+
+    return dict(sorted(partitions.items()))
@@ -0,0 +1,489 @@
+"""
+This script contains the instrumentation of the SQL statements run by the pipeline.
+
+The cursors of create_tables.py and etl.py are wrapped by instrumented_cursor, which records for every statement:
+
+    label:     statement kind and target, like "COPY staging_events" or "UPSERT users"
+    seconds:   wall-clock time of the statement
+    rowcount:  rows affected, as reported by the driver (-1 when unknown)
+    query_id:  id of the statement in the Redshift system tables (pg_last_query_id)
+    copy:      for COPY, the files, lines and errors committed according to stl_load_commits
+
+The multi-statement queries of sql_queries.py (upserts, COPYs followed by their bookkeeping, steps followed by
+the run ledger) are executed one statement at a time in the same transaction, and the row count and query id
+recorded are the ones of the statement the label refers to: the COPY, or the INSERT of an upsert.
+
+The records are handed to a recorder, which forwards them to pluggable exporters. The exporters included are
+a JSON-lines file, a summary table printed at the end of the run and a StatsD client. Any object with the
+methods export(record) and close() can be attached, for example to push the metrics to a Prometheus gateway.
+"""
+
+import json
+import re
+import socket
+import threading
+import time
+import weakref
+
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+from schema import etl_watermark_table, etl_loaded_keys_table, etl_partitions_table, etl_load_errors_table
+from schema import etl_run_ledger_table
+from sql_queries import last_query_id_select, load_commits_select
+
+# Statement kinds and the pattern of the table they target
+_LABEL_PATTERNS = [
+    ("CREATE TABLE", r"CREATE\s+(?:TEMP\s+)?TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)"),
+    ("DROP TABLE", r"DROP\s+TABLE\s+(?:IF\s+EXISTS\s+)?(\w+)"),
+    ("INSERT INTO", r"INSERT\s+INTO\s+(\w+)"),
+    ("DELETE FROM", r"DELETE\s+FROM\s+(\w+)"),
+    ("TRUNCATE", r"TRUNCATE\s+(?:TABLE\s+)?(\w+)"),
+    ("COPY", r"COPY\s+(\w+)"),
+]
+
+# Control tables written by the bookkeeping statements appended to the loads and the transforms
+_CONTROL_TABLES = [spec.name for spec in (etl_watermark_table, etl_loaded_keys_table, etl_partitions_table,\
+                                          etl_load_errors_table, etl_run_ledger_table)]
+
+# Whether the backend of a connection has pg_last_query_id (Redshift does, the PostgreSQL stand-in does not)
+_query_id_support = weakref.WeakKeyDictionary()
+
+
+# Tokens of a SQL text: the string literals, the quoted identifiers, the comments, the semicolons and the rest.
+# An unterminated literal, identifier or comment matches unterminated
+_SQL_TOKEN = re.compile(r"""
+    (?P<string>'(?:[^']|'')*')
+   |(?P<identifier>"(?:[^"]|"")*")
+   |(?P<comment>--[^\n]*|/\*.*?\*/)
+   |(?P<semicolon>;)
+   |(?P<unterminated>/\*|['"])
+   |(?P<text>[^'";/-]+|[/-])
+""", re.VERBOSE | re.DOTALL)
+
+
+def sql_tokens(query):
+    """
+    This method splits a SQL text into tokens, scanning the string literals, the quoted identifiers and the
+    -- and /* */ comments together so a quote inside a comment or a comment marker inside a literal is not
+    taken for what it is not.
+
+    Args:
+        query (str): SQL text
+
+    Returns:
+        tokens (list): list of (kind, text) tuples, kind being string, identifier, comment, semicolon or text
+    """
+
+    tokens = []
+    position = 0
+    while position < len(query):
+        match = _SQL_TOKEN.match(query, position)
+        if match.lastgroup == "unterminated":
+            raise ValueError("Unterminated {} at position {}".format(match.group(), position))
+        tokens.append((match.lastgroup, match.group()))
+        position = match.end()
+
+    return tokens
+
+
+def split_statements(query):
+    """
+    This method splits a multi-statement query on the semicolons that are not inside a string literal,
+    a quoted identifier or a comment. The comments are left out of the statements. A query that cannot
+    be tokenized is returned as a single statement.
+
+    Args:
+        query (str): SQL statements
+
+    Returns:
+        statements (list): the statements, without the semicolons
+    """
+
+    try:
+        tokens = sql_tokens(query)
+    except ValueError:
+        return [query]
+
+    statements = []
+    current = []
+    for kind, text in tokens:
+        if kind == "semicolon":
+            statements.append("".join(current))
+            current = []
+        else:
+            current.append(" " if kind == "comment" else text)
+    statements.append("".join(current))
+
+    return [statement for statement in statements if statement.strip()] or [query]
+
+
+def statement_target(statement):
+    """
+    This method returns the kind and the target table of a single statement.
+
+    Args:
+        statement (str): SQL statement
+
+    Returns:
+        kind (str): one of the kinds of _LABEL_PATTERNS, or the first keyword of the statement
+        table (str): target table, None when the statement is not one of _LABEL_PATTERNS
+    """
+
+    text = " ".join(statement.split())
+    for kind, pattern in _LABEL_PATTERNS:
+        match = re.match(pattern, text, re.IGNORECASE)
+        if match is not None:
+            return kind, match.group(1)
+
+    return text.split(" ", 1)[0].upper(), None
+
+
+def measured_statement(statements):
+    """
+    This method chooses the statement of a query whose row count and query id are recorded: the first COPY,
+    otherwise the last INSERT of the statements that do not write a control table (the bookkeeping),
+    otherwise the last statement.
+
+    Args:
+        statements (list): statements of a query, as returned by split_statements
+
+    Returns:
+        index (int): position of the statement in the list
+    """
+
+    targets = [statement_target(statement) for statement in statements]
+    for i, (kind, _) in enumerate(targets):
+        if kind == "COPY":
+            return i
+
+    main = [i for i, (_, table) in enumerate(targets) if table not in _CONTROL_TABLES] or list(range(len(statements)))
+    inserts = [i for i in main if targets[i][0] == "INSERT INTO"]
+
+    return inserts[-1] if inserts else main[-1]
+
+
+def statement_label(query):
+    """
+    This method is used to name a statement after its kind and target table. A COPY followed by its
+    bookkeeping (the load errors or the partition loaded) is named after the COPY, the multi-statement
+    upserts of sql_queries.py are named after the table they insert into and the run ledger statements
+    appended to a step are left out of its name.
+
+    Args:
+        query (str): SQL statement
+
+    Returns:
+        label (str)
+    """
+
+    statements = split_statements(query)
+    measured = measured_statement(statements)
+    kind, table = statement_target(statements[measured])
+    if table is None:
+        return kind
+
+    main = [statement for statement in statements if statement_target(statement)[1] not in _CONTROL_TABLES] or statements
+    if kind == "INSERT INTO" and len(main) > 1:
+        return "UPSERT {}".format(table)
+
+    return "{} {}".format(kind, table)
+
+
+class jsonl_exporter:
+    """
+    This class writes each statement record as a JSON line.
+
+    Attributes:
+        path: path of the output file, it is appended to
+    """
+
+    def __init__(self, path):
+        self.path  = path
+        self._file = open(path, "a")
+
+    def export(self, record):
+        self._file.write(json.dumps(record, default=str) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class summary_exporter:
+    """
+    This class keeps the statement records and prints a summary table when the run ends,
+    slowest statements first.
+
+    Attributes:
+        records: statement records of the run
+    """
+
+    def __init__(self):
+        self.records = []
+
+    def export(self, record):
+        self.records.append(record)
+
+    def close(self):
+        if not self.records:
+            return
+
+        print("\n{:<32} {:>10} {:>12} {:>12} {:>8}  {}".format("Statement", "Seconds", "Rows", "Query id", "Files", "Status"))
+        for record in sorted(self.records, key=lambda record: record["seconds"], reverse=True):
+            copy = record["copy"] or {}
+            print("{:<32} {:>10.2f} {:>12} {:>12} {:>8}  {}".format(record["label"][:32], record["seconds"],\
+                                                                   str(record["rowcount"]), str(record["query_id"]),\
+                                                                   copy.get("files", ""), record["status"]))
+        print("{} statements in {:.2f}s\n".format(len(self.records), sum(record["seconds"] for record in self.records)))
+
+
+class statsd_exporter:
+    """
+    This class sends the duration and the row count of each statement to a StatsD server over UDP.
+    The metrics are <prefix>.<label>.seconds (timer in ms), <prefix>.<label>.rows and <prefix>.<label>.errors (counters).
+
+    Attributes:
+        address: (host, port) of the StatsD server
+        prefix: prefix of the metric names
+    """
+
+    def __init__(self, host, port=8125, prefix="sparkify.etl"):
+        self.address = (host, int(port))
+        self.prefix  = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def export(self, record):
+        name = "{}.{}".format(self.prefix, re.sub(r"\W+", "_", record["label"]).strip("_").lower())
+        lines = ["{}.seconds:{:.0f}|ms".format(name, record["seconds"] * 1000)]
+        if record["rowcount"] is not None and record["rowcount"] >= 0:
+            lines.append("{}.rows:{}|c".format(name, record["rowcount"]))
+        if record["status"] != "ok":
+            lines.append("{}.errors:1|c".format(name))
+        try:
+            self._socket.sendto("\n".join(lines).encode("utf-8"), self.address)
+        except OSError as e:
+            print("StatsD export failed: {}".format(e))
+
+    def close(self):
+        self._socket.close()
+
+
+class recorder:
+    """
+    This class collects the statement records of a run and forwards them to the exporters.
+    It can be shared by the cursors of the parallel workers.
+
+    Attributes:
+        run_id: identifier of the run added to every record
+        exporters: objects with the methods export(record) and close()
+    """
+
+    def __init__(self, run_id=None, exporters=None):
+        self.run_id    = run_id or time.strftime("%Y%m%dT%H%M%S")
+        self.exporters = list(exporters) if exporters is not None else [summary_exporter()]
+        self._lock     = threading.Lock()
+
+    def record(self, record):
+        """
+        This method is used to hand a statement record to the exporters.
+
+        Args:
+            record (dict): statement record
+        """
+
+        record = dict(record, run_id=self.run_id)
+        with self._lock:
+            for exporter in self.exporters:
+                exporter.export(record)
+
+    def close(self):
+        """
+        This method is used to close the exporters at the end of the run. The summary table is printed here.
+        """
+
+        with self._lock:
+            for exporter in self.exporters:
+                exporter.close()
+
+
+class instrumented_cursor:
+    """
+    This class wraps a DB-API cursor and records the statistics of the statements it executes.
+    The other attributes (fetchone, fetchall, rowcount, ...) are the ones of the wrapped cursor.
+
+    Attributes:
+        cursor: wrapped cursor
+        recorder: instrument.recorder the statement records are sent to
+        query_stats: read pg_last_query_id and stl_load_commits after each statement. The query ids are skipped
+                     on the connections whose backend does not have pg_last_query_id
+        stats_connection: callable returning a context manager that yields a connection, like lib.redshift_pool.connection.
+                          stl_load_commits is read on it, outside the transaction of the cursor. The COPY statistics
+                          are not read when it is None
+    """
+
+    def __init__(self, cursor, recorder, query_stats=True, stats_connection=None):
+        self.cursor           = cursor
+        self.recorder         = recorder
+        self.query_stats      = query_stats
+        self.stats_connection = stats_connection
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cursor.close()
+
+    def _supports_query_ids(self):
+        # Calling pg_last_query_id where it does not exist aborts the transaction, so the support is probed once
+        # per connection while the connection is between transactions, and the probe is rolled back
+        conn = self.cursor.connection
+        supported = _query_id_support.get(conn)
+        if supported is not None:
+            return supported
+        if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute(last_query_id_select)
+            supported = True
+        except Exception as e:
+            print("Query ids not available on this connection: {}".format(e))
+            supported = False
+        conn.rollback()
+        _query_id_support[conn] = supported
+
+        return supported
+
+    def _query_ids(self, label):
+        # pg_last_query_id and pg_last_copy_id only exist in the session of the statement. They do not read
+        # any table, and they are read on a separate cursor so the results of the statement can still be fetched
+        try:
+            with self.cursor.connection.cursor() as cur:
+                cur.execute(last_query_id_select)
+                return cur.fetchone()
+        except Exception as e:
+            print("Query id of {} not available: {}".format(label, e))
+            return None, None
+
+    def _copy_stats(self, label, copy_id):
+        # stl_load_commits is read on another connection so the transaction of the COPY is left untouched
+        if self.stats_connection is None or copy_id is None or copy_id < 0:
+            return None
+        try:
+            with self.stats_connection() as conn:
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute(load_commits_select, (copy_id,))
+                        files, lines, errors = cur.fetchone()
+                finally:
+                    conn.rollback()
+            return {"query_id": copy_id, "files": files, "lines": lines, "errors": errors}
+        except Exception as e:
+            print("Load statistics of {} not available: {}".format(label, e))
+            return None
+
+    def _run(self, method, query, args):
+        label = statement_label(query)
+        # the statements of a query without parameters are executed one at a time to measure one of them
+        statements = [query] if args else split_statements(query)
+        measured = measured_statement(statements)
+        query_ids = self.query_stats and self._supports_query_ids()
+        query_id, copy_id = None, None
+        rowcount = None
+        lookup = 0
+        start = time.time()
+        try:
+            for i, statement in enumerate(statements):
+                result = method(statement, *args)
+                if i == measured:
+                    rowcount = self.cursor.rowcount
+                    if query_ids:
+                        lookup_start = time.time()
+                        query_id, copy_id = self._query_ids(label)
+                        lookup = time.time() - lookup_start
+        except Exception as e:
+            # the transaction is aborted, so the statistics cannot be queried
+            self.recorder.record({"label": label, "started_at": start, "seconds": time.time() - start - lookup,\
+                                  "rowcount": rowcount, "query_id": query_id, "copy": None,\
+                                  "status": "error: {}".format(e).strip()})
+            raise
+
+        seconds = time.time() - start - lookup
+        copy = self._copy_stats(label, copy_id) if label.startswith("COPY") and query_ids else None
+        self.recorder.record({"label": label, "started_at": start, "seconds": seconds, "rowcount": rowcount,\
+                              "query_id": query_id, "copy": copy, "status": "ok"})
+
+        return result
+
+    def execute(self, query, *args):
+        """
+        This method is used to execute a statement and record its statistics.
+
+        Args:
+            query (str): SQL statement
+            args: query parameters, as in cursor.execute
+        """
+
+        return self._run(self.cursor.execute, query, args)
+
+    def executemany(self, query, *args):
+        """
+        This method is used to execute a statement for a sequence of parameters and record its statistics.
+
+        Args:
+            query (str): SQL statement
+            args: sequence of query parameters, as in cursor.executemany
+        """
+
+        return self._run(self.cursor.executemany, query, args)
+
+
+class instrumented_connection:
+    """
+    This class wraps a DB-API connection so its cursors are instrumented. It is used by the parallel
+    workers of the scheduler, which open their own cursor on each connection.
+
+    Attributes:
+        connection: wrapped connection, to be given back to the pool
+        recorder: instrument.recorder the statement records are sent to
+        stats_connection: callable returning a context manager that yields the connection the COPY statistics are read on
+    """
+
+    def __init__(self, connection, recorder, stats_connection=None):
+        self.connection       = connection
+        self.recorder         = recorder
+        self.stats_connection = stats_connection
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def cursor(self, *args, **kwargs):
+        return instrumented_cursor(self.connection.cursor(*args, **kwargs), self.recorder,\
+                                   stats_connection=self.stats_connection)
+
+
+def build_recorder(jsonl_path=None, statsd=None, run_id=None):
+    """
+    This method is used to build the recorder of a run from the command-line options.
+    The summary table is always printed.
+
+    Args:
+        jsonl_path (str): path of the JSON-lines file the records are appended to (optional)
+        statsd (str): host:port of a StatsD server (optional)
+        run_id (str): identifier of the run (optional)
+
+    Returns:
+        recorder (instrument.recorder)
+    """
+
+    exporters = [summary_exporter()]
+    if jsonl_path:
+        exporters.append(jsonl_exporter(jsonl_path))
+    if statsd:
+        host, _, port = statsd.partition(":")
+        exporters.append(statsd_exporter(host, port or 8125))
+
+    return recorder(run_id, exporters)
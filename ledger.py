@@ -0,0 +1,208 @@
+"""
+This script contains the run ledger that makes a failed full run of etl.py resumable.
+
+Every run is recorded in the control table etl_run_ledger with a fingerprint of its input: the options of the
+run and the URI and size of every S3 object of LOG_DATA and SONG_DATA. When a stage of a full load completes,
+a row with its row count is added to the ledger:
+
+    load:         truncate and COPY of the staging tables, and repair of the rejected lines
+    song_lookup, songplays, users, songs, artists, time: one stage per insert (publish with --publish swap)
+    summaries:    refresh of the summary tables
+    maintenance:  VACUUM and ANALYZE
+
+The row of a transform stage is written in the same transaction as the stage itself. The COPYs of the load
+commit one by one, so the row of the load is written after them: a load that did not complete is run again
+from the truncation of the staging tables, which drops the rows of the COPYs that did.
+
+When the last run failed (or was interrupted) and the input has not changed, the next run resumes it:
+the completed stages are skipped and the run starts again from the stage that failed. songplays is
+a plain INSERT, so it is never run twice for the same staging data. A run with other input, or with
+--restart, starts from the COPYs. The input of a run with --restart is listed too, so the next run can resume it. The incremental and date-range loads keep their own bookkeeping
+(etl_watermark, etl_loaded_keys, etl_partitions) and are only recorded, they are not resumed.
+"""
+
+import hashlib
+import json
+
+from lib import list_s3_objects
+from scheduler import step
+from schema import summary_tables
+from sql_queries import published_tables, ledger_last_run_select, ledger_stages_select, ledger_stage_upsert
+
+# Stage of the row that records the run itself
+RUN_STAGE = "run"
+
+# Tables whose rows are counted when a stage completes
+STAGE_TABLES = {
+    "load": ["staging_events", "staging_songs"],
+    "song_lookup": ["song_lookup"],
+    "songplays": ["songplays"],
+    "users": ["users"],
+    "songs": ["songs"],
+    "artists": ["artists"],
+    "time": ["time"],
+    "publish": [spec.name for spec in published_tables],
+    "summaries": [spec.name for spec in summary_tables],
+}
+
+
+def input_fingerprint(s3, config, options, list_input=True):
+    """
+    This method computes the fingerprint of the input of a run. Two runs with the same fingerprint
+    load the same S3 objects with the same options.
+
+    Args:
+        s3 (boto3.resources.factory.s3.ServiceResource): boto3 S3 resource
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        options (dict): options of the run that change what is loaded
+        list_input (bool): whether the S3 objects of LOG_DATA and SONG_DATA are part of the fingerprint
+
+    Returns:
+        fingerprint (str): SHA-1 hex digest
+    """
+
+    digest = hashlib.sha1(json.dumps(options, sort_keys=True, default=str).encode("utf-8"))
+    if list_input:
+        for uri in (config.log_data, config.song_data):
+            for object_uri, size in list_s3_objects(s3, uri):
+                digest.update("{} {}\n".format(object_uri, size).encode("utf-8"))
+
+    return digest.hexdigest()
+
+
+def row_count_expression(stage):
+    """
+    This method renders the SQL expression that counts the rows of the tables of a stage,
+    recorded in the ledger when the stage completes.
+
+    Args:
+        stage (str): stage name
+
+    Returns:
+        expression (str): sum of COUNT(*) subqueries, NULL for the stages without tables
+    """
+
+    tables = STAGE_TABLES.get(stage)
+    if not tables:
+        return "NULL"
+    return " + ".join("(SELECT COUNT(*) FROM {})".format(table) for table in tables)
+
+
+class run_ledger:
+    """
+    This class records the stages of a run in etl_run_ledger and tells which ones a resumed run can skip.
+
+    Attributes:
+        run_id: identifier of the run, the one of the resumed run when a failed run is resumed
+        fingerprint: fingerprint of the input of the run
+        completed: stages already completed -> (row count, completion time)
+    """
+
+    def __init__(self, cur, conn, run_id, fingerprint, resume=True):
+        self.fingerprint = fingerprint
+        self.completed   = {}
+
+        cur.execute(ledger_last_run_select)
+        last_run = cur.fetchone()
+        if resume and last_run is not None and last_run[1] != "completed" and last_run[2] == fingerprint:
+            self.run_id = last_run[0]
+            cur.execute(ledger_stages_select, (self.run_id, fingerprint))
+            self.completed = {stage: (row_count, updated_at) for stage, row_count, updated_at in cur.fetchall()}
+        else:
+            self.run_id = run_id
+
+        cur.execute(ledger_stage_upsert.format(self.run_id, RUN_STAGE, "running", fingerprint, "NULL"))
+        conn.commit()
+
+        if self.completed:
+            print("\nResuming the run {}, the stages already completed are skipped:".format(self.run_id))
+            for stage, (row_count, updated_at) in self.completed.items():
+                print("    {:<12} {:>12} rows, completed at {}".format(stage, str(row_count), updated_at))
+
+    def done(self, stage):
+        """
+        This method tells whether a stage was completed by the resumed run.
+
+        Args:
+            stage (str): stage name
+
+        Returns:
+            done (bool)
+        """
+
+        if stage in self.completed:
+            print("\nStage {} already completed, skipped".format(stage))
+            return True
+        return False
+
+    def record_query(self, stage):
+        """
+        This method renders the statement that records a completed stage with the row count of its tables.
+        It is meant to run in the transaction of the stage.
+
+        Args:
+            stage (str): stage name
+
+        Returns:
+            query (str)
+        """
+
+        return ledger_stage_upsert.format(self.run_id, stage, "completed", self.fingerprint, row_count_expression(stage))
+
+    def record(self, cur, stage):
+        """
+        This method records a completed stage in the current transaction, which the caller commits.
+
+        Args:
+            cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+            stage (str): stage name
+        """
+
+        cur.execute(self.record_query(stage))
+
+    def complete(self, cur, conn, stage):
+        """
+        This method records a completed stage and commits it.
+
+        Args:
+            cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+            conn (psycopg2.extensions.connection): psycopg2 connection object
+            stage (str): stage name
+        """
+
+        if stage in self.completed:
+            return
+        self.record(cur, stage)
+        conn.commit()
+
+    def pending_steps(self, steps):
+        """
+        This method returns the steps of a DAG that are not completed yet. Each step records itself
+        in the ledger in its own transaction, and the dependencies on the completed steps are removed.
+
+        Args:
+            steps (list): list of scheduler.step objects
+
+        Returns:
+            steps (list): list of scheduler.step objects
+        """
+
+        return [step(s.name, s.query.rstrip().rstrip(";") + ";\n" + self.record_query(s.name),\
+                     depends_on=[name for name in s.depends_on if name not in self.completed])\
+                for s in steps if not self.done(s.name)]
+
+    def finish(self, cur, conn, status="completed"):
+        """
+        This method records the end of the run. A run that ends as failed can be resumed by the next one,
+        its aborted transaction is rolled back first.
+
+        Args:
+            cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+            conn (psycopg2.extensions.connection): psycopg2 connection object
+            status (str): completed or failed
+        """
+
+        if status == "failed":
+            conn.rollback()
+        cur.execute(ledger_stage_upsert.format(self.run_id, RUN_STAGE, status, self.fingerprint, "NULL"))
+        conn.commit()
@@ -6,7 +6,14 @@ the needed resources to run this repository
 import boto3
 import configparser
 import json
+import threading
+import time
+import weakref
 import psycopg2
+import psycopg2.pool
+from contextlib import contextmanager
+from result_cache import cached_cursor
+from wlm import wlm_configuration
 
 class aws_config(str):
     """
@@ -30,6 +37,37 @@ class aws_config(str):
         log_data: S3 log (or events) data path 
         log_jsonpath: JSON path of log data used in the COPY query
         song_data: S3 sonce data path 
+        manifest_prefix: S3 path where the COPY manifests are written (optional)
+        staging_prefix: S3 path where the compacted or converted input objects are written (optional)
+        quarantine_prefix: S3 path where the objects with lines rejected by COPY are quarantined and repaired (optional)
+        pool_min_connections: connections opened when the pool is created
+        pool_max_connections: maximum number of connections open at the same time
+        pool_keepalives_idle: seconds of inactivity before TCP keepalives are sent
+        pool_health_check_interval: seconds of inactivity after which a pooled connection is checked before use
+        pool_acquire_timeout: seconds a caller waits for a pooled connection before giving up
+        ingress_cidr: IP range allowed to connect to the cluster port
+        poll_initial_delay: seconds between the first status checks of the cluster while it is created or deleted
+        poll_max_delay: maximum seconds between two status checks, the delay doubles up to this value
+        provisioning_timeout: seconds after which the wait for the cluster is abandoned
+        capacity_min_nodes: minimum number of nodes the capacity controller resizes the cluster to
+        capacity_max_nodes: maximum number of nodes the capacity controller resizes the cluster to
+        capacity_bytes_per_node: input bytes a node is expected to load and transform in an ETL window
+        capacity_idle_action: what the capacity controller does after the ETL: pause, resize (back to DWH_NUM_NODES) or none
+        maintenance_unsorted_pct: percentage of unsorted rows above which a table is vacuumed after the ETL
+        maintenance_stats_off_pct: staleness of the statistics (percent) above which a table is analyzed after the ETL
+        cache_max_bytes: size of the query results kept in memory by the client-side result cache
+        cache_max_entries: number of query results kept in memory by the client-side result cache
+        cache_spill_dir: folder where the results evicted from memory are written as Parquet files, None to drop them
+        cache_version_check_interval: seconds during which the cached results are served without checking for a new load
+        export_itersize: rows fetched at once by the server-side cursors of export.py
+        wlm_parameter_group: name of the WLM parameter group attached to the cluster, None for the default parameter group
+        wlm_etl_concurrency: slots of the WLM queue of the ETL query groups
+        wlm_etl_memory_pct: percentage of the memory given to the WLM queue of the ETL query groups
+        wlm_analytics_concurrency: slots of the default WLM queue, used by the analysts
+        wlm_concurrency_scaling: concurrency scaling mode of the default WLM queue, auto or off
+        wlm_max_concurrency_scaling_clusters: maximum number of concurrency scaling clusters
+        wlm_short_query_acceleration: whether short queries run in the short query queue
+        wlm_transform_slots: slots claimed by the heavy transform and maintenance statements
     """
 
     def __init__(self, config_path):
@@ -59,16 +97,62 @@ class aws_config(str):
         self.log_data     = config.get('S3','LOG_DATA')
         self.log_jsonpath = config.get('S3','LOG_JSONPATH')
         self.song_data    = config.get('S3','SONG_DATA')
+        self.manifest_prefix = config.get('S3','MANIFEST_PREFIX', fallback='') or None
+        self.staging_prefix  = config.get('S3','STAGING_PREFIX', fallback='') or None
+        self.quarantine_prefix = config.get('S3','QUARANTINE_PREFIX', fallback='') or None
+        
+        # CONNECTION_POOL
+        self.pool_min_connections       = config.getint('CONNECTION_POOL','MIN_CONNECTIONS', fallback=1)
+        self.pool_max_connections       = config.getint('CONNECTION_POOL','MAX_CONNECTIONS', fallback=5)
+        self.pool_keepalives_idle       = config.getint('CONNECTION_POOL','KEEPALIVES_IDLE', fallback=60)
+        self.pool_health_check_interval = config.getint('CONNECTION_POOL','HEALTH_CHECK_INTERVAL', fallback=30)
+        self.pool_acquire_timeout       = config.getint('CONNECTION_POOL','ACQUIRE_TIMEOUT', fallback=300)
+        
+        # PROVISIONING
+        self.ingress_cidr         = config.get('PROVISIONING','INGRESS_CIDR', fallback='0.0.0.0/0')
+        self.poll_initial_delay   = config.getfloat('PROVISIONING','POLL_INITIAL_DELAY', fallback=10)
+        self.poll_max_delay       = config.getfloat('PROVISIONING','POLL_MAX_DELAY', fallback=60)
+        self.provisioning_timeout = config.getfloat('PROVISIONING','TIMEOUT', fallback=1800)
+        
+        # CAPACITY
+        self.capacity_min_nodes      = config.getint('CAPACITY','MIN_NODES', fallback=2)
+        self.capacity_max_nodes      = config.getint('CAPACITY','MAX_NODES', fallback=8)
+        self.capacity_bytes_per_node = int(config.getfloat('CAPACITY','GB_PER_NODE', fallback=1) * 2**30)
+        self.capacity_idle_action    = config.get('CAPACITY','IDLE_ACTION', fallback='none')
+        
+        # MAINTENANCE
+        self.maintenance_unsorted_pct  = config.getfloat('MAINTENANCE','UNSORTED_PCT', fallback=5)
+        self.maintenance_stats_off_pct = config.getfloat('MAINTENANCE','STATS_OFF_PCT', fallback=10)
+
+        # RESULT_CACHE
+        self.cache_max_bytes              = int(config.getfloat('RESULT_CACHE','MAX_MB', fallback=256) * 2**20)
+        self.cache_max_entries            = config.getint('RESULT_CACHE','MAX_ENTRIES', fallback=1000)
+        self.cache_spill_dir              = config.get('RESULT_CACHE','SPILL_DIR', fallback='') or None
+        self.cache_version_check_interval = config.getfloat('RESULT_CACHE','VERSION_CHECK_INTERVAL', fallback=30)
+
+        # EXPORT
+        self.export_itersize = config.getint('EXPORT','ITERSIZE', fallback=10000)
+
+        # WLM
+        self.wlm_parameter_group                  = config.get('WLM','PARAMETER_GROUP', fallback='') or None
+        self.wlm_etl_concurrency                  = config.getint('WLM','ETL_CONCURRENCY', fallback=3)
+        self.wlm_etl_memory_pct                   = config.getint('WLM','ETL_MEMORY_PCT', fallback=50)
+        self.wlm_analytics_concurrency            = config.getint('WLM','ANALYTICS_CONCURRENCY', fallback=5)
+        self.wlm_concurrency_scaling              = config.get('WLM','CONCURRENCY_SCALING', fallback='auto')
+        self.wlm_max_concurrency_scaling_clusters = config.getint('WLM','MAX_CONCURRENCY_SCALING_CLUSTERS', fallback=1)
+        self.wlm_short_query_acceleration         = config.getboolean('WLM','SHORT_QUERY_ACCELERATION', fallback=True)
+        self.wlm_transform_slots                  = config.getint('WLM','TRANSFORM_SLOTS', fallback=2)
 
         
 class aws(aws_config):
     """
-    This class is designed to build objects that act as entry point of the IAM, Redshift and S3 functionality.
-    For this purpose the different attributes correspond to the boto3 clients of iam, redshift and s3.
+    This class is designed to build objects that act as entry point of the IAM, Redshift, EC2 and S3 functionality.
+    For this purpose the different attributes correspond to the boto3 clients of iam, redshift, ec2 and s3.
     
     Attributes:
         iam: boto3 IAM client
         redshift: boto3 Redshift client
+        ec2: boto3 EC2 client, used to open the cluster port in its security group
         s3: boto3 S3 resource
     """
     
@@ -86,6 +170,12 @@ class aws(aws_config):
                                     aws_secret_access_key=aws_config.secret\
                                    )
         
+        aws.ec2 = boto3.client('ec2',\
+                               region_name=aws_config.region_name,\
+                               aws_access_key_id=aws_config.key,\
+                               aws_secret_access_key=aws_config.secret\
+                              )
+        
         aws.s3 = boto3.resource('s3',\
                                 region_name=aws_config.region_name,\
                                 aws_access_key_id=aws_config.key,\
@@ -140,6 +230,11 @@ def create_redshift(redshift, config, role_arn):
         role_arn (str): ARN role that will be attached to the Redshift cluster
     """
     
+    # The WLM parameter group, when there is one, is created by create_parameter_group first
+    parameter_group = {}
+    if config.wlm_parameter_group is not None:
+        parameter_group["ClusterParameterGroupName"] = config.wlm_parameter_group
+    
     response = redshift.create_cluster(     
         ClusterType       = config.dwh_cluster_type,
         NodeType          = config.dwh_node_type,
@@ -148,7 +243,8 @@ def create_redshift(redshift, config, role_arn):
         ClusterIdentifier = config.dwh_cluster_identifier,
         MasterUsername    = config.db_user,
         MasterUserPassword= config.db_password,
-        IamRoles          = [role_arn]  
+        IamRoles          = [role_arn],
+        **parameter_group
     )
     
     print("Redshift cluster created with properties:")
@@ -160,7 +256,48 @@ def create_redshift(redshift, config, role_arn):
     # Commented for security reasons
     #print("MasterUsername : {}".format(config.db_user)
     #print("MasterUserPassword : {}".format(config.db_password)
-    print("IamRoles: {}\n".format(role_arn))
+    print("IamRoles: {}".format(role_arn))
+    print("ClusterParameterGroupName: {}\n".format(config.wlm_parameter_group or "default"))
+
+
+def create_parameter_group(redshift, config):
+    """
+    This method is used to create the cluster parameter group of the [WLM] section of the configuration file.
+    
+    Args:
+        redshift (botocore.client.Redshift): boto3 Redshift object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+    """
+    
+    redshift.create_cluster_parameter_group(
+        ParameterGroupName   = config.wlm_parameter_group,
+        ParameterGroupFamily = "redshift-1.0",
+        Description          = "WLM queues of the ETL and of the analytics queries"
+    )
+    
+    print("Redshift parameter group {} created".format(config.wlm_parameter_group))
+
+
+def apply_wlm_parameters(redshift, config):
+    """
+    This method is used to set the WLM queues (see wlm.wlm_configuration) and the concurrency scaling limit
+    of the cluster parameter group. The clusters using the group pick up the changes of the queues after a reboot.
+    
+    Args:
+        redshift (botocore.client.Redshift): boto3 Redshift object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+    """
+    
+    redshift.modify_cluster_parameter_group(
+        ParameterGroupName = config.wlm_parameter_group,
+        Parameters = [
+            {'ParameterName': 'wlm_json_configuration', 'ParameterValue': wlm_configuration(config)},
+            {'ParameterName': 'max_concurrency_scaling_clusters',\
+             'ParameterValue': str(config.wlm_max_concurrency_scaling_clusters)},
+        ]
+    )
+    
+    print("WLM queues of the parameter group {}: {}\n".format(config.wlm_parameter_group, wlm_configuration(config)))
     
     
 def cleanup_iam(iam, config):
@@ -189,38 +326,313 @@ def cleanup_redshift(redshift, config):
     
     redshift.delete_cluster(ClusterIdentifier=config.dwh_cluster_identifier, SkipFinalClusterSnapshot=True)
     print("Redshift cluster {} deleted".format(config.dwh_cluster_identifier))
+
+
+def cleanup_parameter_group(redshift, config):
+    """
+    This method deletes the WLM parameter group. It can only be deleted once the cluster using it is gone.
+    
+    Args:
+        redshift (botocore.client.Redshift): boto3 Redshift object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+    """
+    
+    redshift.delete_cluster_parameter_group(ParameterGroupName=config.wlm_parameter_group)
+    print("Redshift parameter group {} deleted".format(config.wlm_parameter_group))
+    
+
+# Endpoint addresses already resolved by describe_clusters, keyed by cluster identifier
+_endpoint_cache = {}
+
+
+def cluster_endpoint(redshift, config, refresh=False):
+    """
+    This method returns the endpoint address of the Redshift cluster. 
+    The address is looked up with describe_clusters only the first time and cached afterwards.
+    
+    Args:
+        redshift (botocore.client.Redshift): boto3 Redshift object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        refresh (bool): ignore the cached address and look it up again
+    
+    Returns:
+        host (str)
+    """
+    
+    cluster_identifier = config.dwh_cluster_identifier
+    if refresh or cluster_identifier not in _endpoint_cache:
+        redshift_properties = redshift.describe_clusters(ClusterIdentifier=cluster_identifier)['Clusters'][0]
+        _endpoint_cache[cluster_identifier] = redshift_properties['Endpoint']['Address']
+    
+    return _endpoint_cache[cluster_identifier]
+
+
+def cache_endpoint(config, address):
+    """
+    This method stores the endpoint address of the Redshift cluster, for example once the provisioning 
+    has waited for the cluster to be available, so the connections do not have to look it up again.
+    
+    Args:
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        address (str): endpoint address of the cluster
+    """
+    
+    _endpoint_cache[config.dwh_cluster_identifier] = address
+
+
+def connection_string(redshift, config):
+    """
+    This method generates the psycopg2 connection string of the Redshift database.
+    
+    Args:
+        redshift (botocore.client.Redshift): boto3 Redshift object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+    
+    Returns:
+        connection_string (str)
+    """
+    
+    host = cluster_endpoint(redshift, config)
     
+    return "host={} dbname={} user={} password={} port={}".format(host,\
+                                                                  config.db_name,\
+                                                                  config.db_user,\
+                                                                  config.db_password,\
+                                                                  config.db_port)
+
 
-def redshift_connection(redshift, config):
+def redshift_connection(redshift, config, cache=None):
     """
     This method can be used to connect to the Redshift clusted. 
     It will make use of the method lib.aws_config to read the ClusterIdentifier, database name, 
     database uer, database pasword and database port from the configuration file to generate the connection string.
     It returns the psycopg2 cursor and connection to the Redshift database.
+    With a result cache, the cursor returns the results of the repeated SELECT queries from the cache
+    and the connection is in autocommit mode, so every version check sees the last load.
     
     Args:
         redshift (botocore.client.Redshift): boto3 Redshift object
         config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        cache (result_cache.result_cache): client-side result cache, optional
     
     Returns:
         cur (psycopg2.extensions.cursor)
         conn (psycopg2.extensions.connection)
     """
-        
-    cluster_identifier = config.dwh_cluster_identifier
-    redshift_properties = redshift.describe_clusters(ClusterIdentifier=cluster_identifier)['Clusters'][0]
-    
-    host = redshift_properties['Endpoint']['Address']
-    connection_string = "host={} dbname={} user={} password={} port={}".format(host,\
-                                                                               config.db_name,\
-                                                                               config.db_user,\
-                                                                               config.db_password,\
-                                                                               config.db_port)
+    
     # Careful! This will print a password on the screen!
     # Commented for security reasons
-    #print(connection_string)
+    #print(connection_string(redshift, config))
     
-    conn = psycopg2.connect(connection_string)
+    conn = psycopg2.connect(connection_string(redshift, config))
     cur = conn.cursor()
+    if cache is not None:
+        conn.autocommit = True
+        cur = cached_cursor(cur, cache)
+    
+    return conn, cur
+
+
+class redshift_pool:
+    """
+    This class manages a pool of connections to the Redshift database shared by create_tables.py, 
+    etl.py and the parallel workers. The connections are opened once and reused, so the endpoint lookup 
+    and the connection handshake are not paid by every step. The pool blocks when all the connections 
+    are in use, up to acquire_timeout seconds, TCP keepalives are enabled and idle connections are checked
+    before being handed out.
+    
+    Attributes:
+        max_connections: maximum number of connections open at the same time
+        health_check_interval: seconds of inactivity after which a connection is checked before use
+        acquire_timeout: seconds getconn waits for a connection before raising psycopg2.pool.PoolError
+    """
+    
+    def __init__(self, redshift, config):
+        self.max_connections       = config.pool_max_connections
+        self.health_check_interval = config.pool_health_check_interval
+        self.acquire_timeout       = config.pool_acquire_timeout
+        
+        self._pool = psycopg2.pool.ThreadedConnectionPool(config.pool_min_connections,\
+                                                          config.pool_max_connections,\
+                                                          connection_string(redshift, config),\
+                                                          keepalives=1,\
+                                                          keepalives_idle=config.pool_keepalives_idle,\
+                                                          keepalives_interval=10,\
+                                                          keepalives_count=5)
+        self._available = threading.BoundedSemaphore(config.pool_max_connections)
+        # keyed by the connection itself: an id() can be reused by a new connection once a closed one is collected
+        self._last_used = weakref.WeakKeyDictionary()
+    
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.time() - self._last_used.get(conn, 0) < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+    
+    def getconn(self):
+        """
+        This method takes a connection from the pool. It waits until a connection is available 
+        and replaces the connections that do not pass the health check.
+        
+        Returns:
+            conn (psycopg2.extensions.connection)
+        
+        Raises:
+            psycopg2.pool.PoolError: no connection was given back within acquire_timeout seconds
+        """
+        
+        if not self._available.acquire(timeout=self.acquire_timeout):
+            raise psycopg2.pool.PoolError("No connection available after {}s, all the {} connections of the pool are in use. "\
+                                          "Increase MAX_CONNECTIONS in the [CONNECTION_POOL] section of dwh.cfg "\
+                                          "or run fewer workers".format(self.acquire_timeout, self.max_connections))
+        try:
+            conn = self._pool.getconn()
+            while not self._healthy(conn):
+                self._last_used.pop(conn, None)
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+        except Exception:
+            self._available.release()
+            raise
+        
+        return conn
+    
+    def putconn(self, conn):
+        """
+        This method gives a connection back to the pool. Open transactions are rolled back.
+        
+        Args:
+            conn (psycopg2.extensions.connection): connection taken with getconn
+        """
+        
+        self._last_used[conn] = time.time()
+        self._pool.putconn(conn, close=bool(conn.closed))
+        self._available.release()
+    
+    @contextmanager
+    def connection(self):
+        """
+        This method can be used in a with statement to take a connection and give it back when the block ends.
+        
+        Yields:
+            conn (psycopg2.extensions.connection)
+        """
+        
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+    
+    def closeall(self):
+        """
+        This method closes all the connections of the pool.
+        """
+        
+        self._pool.closeall()
+
+
+# Pools already created, keyed by cluster identifier
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def shared_pool(redshift, config):
+    """
+    This method returns the connection pool of the Redshift cluster, creating it the first time it is requested.
+    
+    Args:
+        redshift (botocore.client.Redshift): boto3 Redshift object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+    
+    Returns:
+        pool (lib.redshift_pool)
+    """
+    
+    with _pools_lock:
+        if config.dwh_cluster_identifier not in _pools:
+            _pools[config.dwh_cluster_identifier] = redshift_pool(redshift, config)
+    
+    return _pools[config.dwh_cluster_identifier]
+
+
+def parse_s3_uri(uri):
+    """
+    This method splits an S3 URI like s3://udacity-dend/log_data into its bucket and key prefix.
+    
+    Args:
+        uri (str): S3 URI
+    
+    Returns:
+        bucket (str)
+        prefix (str)
+    """
+    
+    if not uri.startswith("s3://"):
+        raise ValueError("Not an S3 URI: {}".format(uri))
+    
+    bucket, _, prefix = uri[len("s3://"):].partition("/")
+    
+    return bucket, prefix
+
+
+def list_s3_objects(s3, uri):
+    """
+    This method lists the objects stored under an S3 prefix. 
+    Folder placeholders (keys ending with "/") and empty objects are skipped.
+    
+    Args:
+        s3 (boto3.resources.factory.s3.ServiceResource): boto3 S3 resource
+        uri (str): S3 URI of the prefix to list
+    
+    Returns:
+        objects (list): list of (S3 URI, size in bytes) tuples sorted by URI
+    """
+    
+    bucket_name, prefix = parse_s3_uri(uri)
+    bucket = s3.Bucket(bucket_name)
+    
+    objects = []
+    for obj in bucket.objects.filter(Prefix=prefix):
+        if obj.key.endswith("/") or obj.size == 0:
+            continue
+        objects.append(("s3://{}/{}".format(bucket_name, obj.key), obj.size))
+    
+    return sorted(objects)
+
+
+def write_manifest(s3, manifest_uri, uris, sizes=None):
+    """
+    This method writes a COPY manifest that lists explicitly the S3 objects to be loaded.
+    The object sizes are required by COPY when loading columnar formats like Parquet.
+    See https://docs.aws.amazon.com/redshift/latest/dg/loading-data-files-using-manifest.html
+    
+    Args:
+        s3 (boto3.resources.factory.s3.ServiceResource): boto3 S3 resource
+        manifest_uri (str): S3 URI where the manifest will be written
+        uris (list): S3 URIs of the objects to be loaded
+        sizes (list): sizes in bytes of the objects, written as meta content_length (optional)
+    
+    Returns:
+        manifest_uri (str)
+    """
+    
+    entries = [{"url": uri, "mandatory": True} for uri in uris]
+    if sizes is not None:
+        for entry, size in zip(entries, sizes):
+            entry["meta"] = {"content_length": size}
+    manifest = {"entries": entries}
+    
+    bucket_name, key = parse_s3_uri(manifest_uri)
+    s3.Object(bucket_name, key).put(Body=json.dumps(manifest).encode("utf-8"))
+    
+    print("Manifest with {} entries written to {}".format(len(uris), manifest_uri))
     
-    return conn, cur
\ No newline at end of file
+    return manifest_uri
@@ -0,0 +1,315 @@
+"""
+This script contains a local ETL engine that runs the star-schema transforms of sql_queries.py without a cluster.
+
+It reads the raw log and song JSON from disk, parses the files in parallel with a process pool and builds
+the songplays, users, songs, artists and time tables with the same logic as the Redshift queries:
+
+    songplays: NextSong events joined to the song lookup on (title, artist_name, rounded duration) through a hash index
+    users:     one row per user with the level of its latest event (by ts)
+    songs:     one row per song_id
+    artists:   one row per artist_id, records with a known location preferred
+    time:      one row per distinct start_time of the NextSong events
+
+The output is a gzip'd CSV file per table, ready to be bulk-loaded with COPY (see sql_queries.query_catalog.table_csv_copy).
+It is useful for development and backfills and as a reference to check the results of the Redshift transforms.
+
+    $ python local_etl.py --log-data data/log_data --song-data data/song_data --output /tmp/star
+"""
+
+import argparse
+import csv
+import gzip
+import os
+import time
+from datetime import datetime, timezone
+from decimal import Decimal, ROUND_HALF_UP
+from multiprocessing import Pool
+
+from convert import stream_json_records, column_caster
+from schema import staging_songs_table, songplay_table, user_table, song_table, artist_table, time_table
+from validate import event_casters, load_jsonpaths, validate_records
+
+NULL_MARKER = "\\N"
+
+# Columns written for each table. songplay_id is an IDENTITY column generated by Redshift on load
+OUTPUT_COLUMNS = {
+    "songplays": [column for column, _ in songplay_table.columns if column != "songplay_id"],
+    "users": [column for column, _ in user_table.columns],
+    "songs": [column for column, _ in song_table.columns],
+    "artists": [column for column, _ in artist_table.columns],
+    "time": [column for column, _ in time_table.columns],
+}
+
+
+def json_files(folder):
+    """
+    This method lists the JSON files of a folder and its subfolders.
+
+    Args:
+        folder (str): root folder
+
+    Returns:
+        paths (list): sorted paths of the .json files
+    """
+
+    paths = []
+    for root, _, files in os.walk(folder):
+        paths.extend(os.path.join(root, name) for name in files if name.endswith(".json"))
+
+    return sorted(paths)
+
+
+def parse_event_file(path):
+    """
+    This method parses an event log file. It runs in the worker processes and reduces the file to what the
+    transforms need: the NextSong events and the latest record of each user.
+
+    Args:
+        path (str): path of the event log file
+
+    Returns:
+        plays (list): (ts, userId, level, song, artist, length, sessionId, location, userAgent) tuples of the NextSong events
+        users (dict): userId -> (ts, firstName, lastName, gender, level) of the latest event of each user
+        rejected (int): number of records that could not be normalized
+    """
+
+    casters = event_casters(load_jsonpaths())
+    plays = []
+    users = {}
+    rejected = 0
+
+    with open(path, "rb") as f:
+        for event, errors in validate_records(stream_json_records(f), casters):
+            if errors:
+                rejected += 1
+                continue
+
+            if event["page"] == "NextSong":
+                plays.append((event["ts"], event["userId"], event["level"], event["song"], event["artist"],\
+                              event["length"], event["sessionId"], event["location"], event["userAgent"]))
+
+            user_id = event["userId"]
+            if user_id is not None and event["ts"] is not None:
+                if user_id not in users or event["ts"] > users[user_id][0]:
+                    users[user_id] = (event["ts"], event["firstName"], event["lastName"], event["gender"], event["level"])
+
+    return plays, users, rejected
+
+
+def parse_song_files(paths):
+    """
+    This method parses a group of song files. It runs in the worker processes.
+
+    Args:
+        paths (list): paths of the song files
+
+    Returns:
+        songs (list): song records with the values cast to the staging_songs column types
+    """
+
+    casters = [(column, column_caster(column_type)) for column, column_type in staging_songs_table.columns]
+    songs = []
+
+    for path in paths:
+        with open(path, "rb") as f:
+            for record in stream_json_records(f):
+                songs.append({column: cast(record.get(column)) for column, cast in casters})
+
+    return songs
+
+
+def rounded_duration(duration):
+    """
+    This method rounds a duration to 2 decimals like CAST(duration AS DECIMAL(10,2)) in the song lookup.
+
+    Args:
+        duration (float): duration in seconds
+
+    Returns:
+        duration (decimal.Decimal)
+    """
+
+    if duration is None:
+        return None
+
+    return Decimal(repr(duration)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
+
+
+def build_songs(song_records):
+    """
+    This method builds the songs and artists tables and the hash index used by the songplays join.
+
+    Args:
+        song_records (list): song records, as returned by parse_song_files
+
+    Returns:
+        songs (dict): song_id -> songs row
+        artists (dict): artist_id -> artists row
+        index (dict): (title, artist_name, rounded duration) -> (song_id, artist_id), like the song_lookup table
+    """
+
+    songs = {}
+    artists = {}
+    index = {}
+
+    for song in song_records:
+        if song["song_id"] is not None:
+            row = (song["song_id"], song["title"], song["artist_id"], song["year"], song["duration"])
+            # same preference as song_delta_select: the latest year
+            if song["song_id"] not in songs or (row[3] or 0) > (songs[song["song_id"]][3] or 0):
+                songs[song["song_id"]] = row
+
+        if song["artist_id"] is not None:
+            row = (song["artist_id"], song["artist_name"], song["artist_location"],\
+                   None if song["artist_latitude"] is None else int(round(song["artist_latitude"])),\
+                   None if song["artist_longitude"] is None else int(round(song["artist_longitude"])))
+            # same preference as artist_delta_select: a known location, then the artist name
+            rank = (row[3] is None, row[1] or "")
+            current = artists.get(song["artist_id"])
+            if current is None or rank < (current[3] is None, current[1] or ""):
+                artists[song["artist_id"]] = row
+
+        key = (song["title"], song["artist_name"], rounded_duration(song["duration"]))
+        # same preference as song_lookup_build: the lowest song_id
+        if None not in key and (key not in index or (song["song_id"] or "") < (index[key][0] or "")):
+            index[key] = (song["song_id"], song["artist_id"])
+
+    return songs, artists, index
+
+
+def start_time(ts):
+    """
+    This method converts an epoch-ms ts into the start_time of songplays.
+    Like TIMESTAMP 'epoch' + ts/1000 * INTERVAL '1 second' in Redshift, the milliseconds are truncated.
+
+    Args:
+        ts (int): epoch milliseconds
+
+    Returns:
+        start_time (datetime.datetime)
+    """
+
+    if ts is None:
+        return None
+
+    return datetime.fromtimestamp(ts // 1000, tz=timezone.utc).replace(tzinfo=None)
+
+
+def time_row(start):
+    """
+    This method derives the time dimension row of a start_time.
+    The values match the Redshift EXTRACT functions: week is the ISO week and weekday is 0 for Sunday.
+
+    Args:
+        start (datetime.datetime): start_time
+
+    Returns:
+        row (tuple): (start_time, hour, day, week, month, year, weekday)
+    """
+
+    return (start, start.hour, start.day, start.isocalendar()[1], start.month, start.year, start.isoweekday() % 7)
+
+
+def write_table(rows, path, columns):
+    """
+    This method writes the rows of a table into a gzip'd CSV file with a header. 
+    Null values are written as \\N so they are not mistaken for empty strings on load.
+
+    Args:
+        rows (iterable): rows of the table
+        path (str): path of the output file
+        columns (list): column names
+
+    Returns:
+        n_rows (int)
+    """
+
+    n_rows = 0
+    with gzip.open(path, "wt", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([NULL_MARKER if value is None else value for value in row])
+            n_rows += 1
+
+    return n_rows
+
+
+def run(log_data, song_data, output_dir, processes=None):
+    """
+    This method runs the local ETL and writes a gzip'd CSV file per table into output_dir.
+
+    Args:
+        log_data (str): folder with the event log files
+        song_data (str): folder with the song files
+        output_dir (str): folder where the tables are written
+        processes (int): number of worker processes, the number of CPUs by default
+
+    Returns:
+        counts (dict): number of rows written for each table
+    """
+
+    start = time.perf_counter()
+    event_paths = json_files(log_data)
+    song_paths = json_files(song_data)
+    song_groups = [song_paths[i:i + 500] for i in range(0, len(song_paths), 500)]
+
+    with Pool(processes) as pool:
+        song_results = pool.map_async(parse_song_files, song_groups)
+        event_results = pool.map(parse_event_file, event_paths)
+        song_records = [song for group in song_results.get() for song in group]
+
+    print("{} event files and {} song files parsed in {:.2f}s".format(len(event_paths), len(song_paths),\
+                                                                     time.perf_counter() - start))
+
+    songs, artists, index = build_songs(song_records)
+
+    songplays = []
+    users = {}
+    rejected = 0
+    for plays, file_users, file_rejected in event_results:
+        rejected += file_rejected
+        for user_id, user in file_users.items():
+            if user_id not in users or user[0] > users[user_id][0]:
+                users[user_id] = user
+        for ts, user_id, level, song, artist, length, session_id, location, user_agent in plays:
+            match = index.get((song, artist, rounded_duration(length)))
+            if match is not None:
+                songplays.append((start_time(ts), user_id, level, match[0], match[1], session_id, location, user_agent))
+
+    times = sorted(set(start_time(play[0]) for plays, _, _ in event_results for play in plays if play[0] is not None))
+
+    os.makedirs(output_dir, exist_ok=True)
+    tables = {
+        "songplays": songplays,
+        "users": [(user_id,) + user[1:] for user_id, user in sorted(users.items())],
+        "songs": [songs[song_id] for song_id in sorted(songs)],
+        "artists": [artists[artist_id] for artist_id in sorted(artists)],
+        "time": [time_row(t) for t in times],
+    }
+
+    counts = {}
+    for table, rows in tables.items():
+        counts[table] = write_table(rows, os.path.join(output_dir, "{}.csv.gz".format(table)), OUTPUT_COLUMNS[table])
+        print("{}: {} rows".format(table, counts[table]))
+
+    if rejected:
+        print("{} event records could not be normalized and were skipped".format(rejected))
+    print("Local ETL completed in {:.2f}s".format(time.perf_counter() - start))
+
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the star-schema transforms locally")
+    parser.add_argument("--log-data", required=True, help="folder with the event log files")
+    parser.add_argument("--song-data", required=True, help="folder with the song files")
+    parser.add_argument("--output", required=True, help="folder where the gzip'd CSV tables are written")
+    parser.add_argument("--processes", type=int, default=None, help="number of worker processes")
+    args = parser.parse_args()
+
+    run(args.log_data, args.song_data, args.output, args.processes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+This script contains the maintenance stage run by etl.py after the transforms.
+
+The inserts leave unsorted regions at the end of the tables and make their statistics stale, so the
+query plans of the fact and dimension tables degrade as the tables grow. svv_table_info reports both,
+in percent, for every table:
+
+    unsorted:  rows outside of the sort order, restored by VACUUM SORT ONLY
+    stats_off: staleness of the statistics used by the planner, refreshed by ANALYZE
+
+Only the tables above the UNSORTED and STATS_OFF thresholds of the [MAINTENANCE] section of dwh.cfg
+are vacuumed or analyzed, so a run that changed a few rows does not pay for a full maintenance.
+The staging tables are not included: they are truncated or replaced by every run and their
+statistics are refreshed by their COPYs (STATUPDATE ON).
+"""
+
+import time
+
+from schema import summary_tables
+from sql_queries import table_info_select, vacuum_sort_only, analyze_table
+
+# Tables written by the transforms and the summary refresh
+MAINTAINED_TABLES = ["song_lookup", "songplays", "users", "songs", "artists", "time"] +\
+    [spec.name for spec in summary_tables]
+
+
+def table_info(cur, tables=MAINTAINED_TABLES):
+    """
+    This method reads the unsorted and stats_off percentages of the tables from svv_table_info.
+    Empty tables are not listed by svv_table_info.
+
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        tables (list): table names
+
+    Returns:
+        info (dict): table -> {"unsorted": float, "stats_off": float, "rows": int}
+    """
+
+    cur.execute(table_info_select, (tuple(tables),))
+
+    return {table.strip(): {"unsorted": unsorted, "stats_off": stats_off, "rows": rows}\
+            for table, unsorted, stats_off, rows in cur.fetchall()}
+
+
+def plan_maintenance(info, config):
+    """
+    This method decides which tables are vacuumed and which are analyzed. The tables without a sort key
+    (unsorted is NULL) are never vacuumed. The VACUUMs come first since they change the statistics.
+
+    Args:
+        info (dict): table information, as returned by table_info
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+
+    Returns:
+        actions (list): (action, table) tuples, with action vacuum or analyze
+    """
+
+    vacuums = [("vacuum", table) for table, stats in info.items()\
+               if stats["unsorted"] is not None and float(stats["unsorted"]) > config.maintenance_unsorted_pct]
+    analyzes = [("analyze", table) for table, stats in info.items()\
+                if stats["stats_off"] is not None and float(stats["stats_off"]) > config.maintenance_stats_off_pct]
+
+    return vacuums + analyzes
+
+
+def run_maintenance(cur, conn, config, tables=MAINTAINED_TABLES):
+    """
+    This method is used to vacuum and analyze the tables above the thresholds. The statements run in
+    autocommit mode since VACUUM cannot run inside a transaction block.
+
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        conn (psycopg2.extensions.connection): psycopg2 connection object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        tables (list): table names
+
+    Returns:
+        timings (dict): (action, table) -> seconds
+    """
+
+    info = table_info(cur, tables)
+    conn.commit()
+
+    print("\n{:<20} {:>12} {:>10} {:>10}".format("Table", "Rows", "Unsorted", "Stats off"))
+    for table in tables:
+        stats = info.get(table, {"rows": 0, "unsorted": None, "stats_off": None})
+        print("{:<20} {:>12} {:>10} {:>10}".format(table, str(stats["rows"]), str(stats["unsorted"]), str(stats["stats_off"])))
+
+    actions = plan_maintenance(info, config)
+    if not actions:
+        print("No table above {}% unsorted or {}% stats off, maintenance skipped".format(\
+            config.maintenance_unsorted_pct, config.maintenance_stats_off_pct))
+        return {}
+
+    timings = {}
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        for action, table in actions:
+            query = vacuum_sort_only.format(table) if action == "vacuum" else analyze_table.format(table)
+            print(query)
+            start = time.time()
+            cur.execute(query)
+            timings[(action, table)] = time.time() - start
+    finally:
+        conn.autocommit = autocommit
+
+    print("Maintenance completed in {:.2f}s".format(sum(timings.values())))
+
+    return timings
@@ -0,0 +1,272 @@
+"""
+This script contains the asynchronous provisioning and teardown of the AWS resources used by the DWH.
+
+create_cluster and delete_cluster only start the operation: the cluster takes minutes to become available
+(or to disappear). The coroutines below wait for it by polling describe_clusters with an exponential backoff,
+so aws_setup.py returns once the cluster accepts connections and aws_cleanup.py once it is gone.
+
+The boto3 clients are blocking, so their calls run in worker threads (asyncio.to_thread) and the
+independent steps, like the IAM cleanup and the cluster deletion, run at the same time. All the calls
+go through the clients of lib.aws, so stubbed clients can be passed to run the coroutines offline.
+"""
+
+import asyncio
+import time
+
+from lib import iamS3, create_redshift, cleanup_iam, cleanup_redshift, cache_endpoint
+from lib import create_parameter_group, apply_wlm_parameters, cleanup_parameter_group
+
+# Cluster statuses from which the cluster will not become available
+FAILED_STATUSES = ("failed", "hardware-failure", "incompatible-hsm", "incompatible-network", "incompatible-parameters",\
+                   "incompatible-restore", "storage-full")
+
+
+def error_code(e):
+    """
+    This method returns the AWS error code of a botocore ClientError, like ClusterNotFound.
+
+    Args:
+        e (Exception): exception raised by a boto3 client
+
+    Returns:
+        code (str): None when the exception does not come from the AWS API
+    """
+
+    return getattr(e, "response", {}).get("Error", {}).get("Code")
+
+
+async def wait_for_cluster(redshift, config, target="available", nodes=None):
+    """
+    This method polls describe_clusters until the cluster reaches the target status.
+    The delay between two checks starts at POLL_INITIAL_DELAY and doubles up to POLL_MAX_DELAY.
+
+    Args:
+        redshift (botocore.client.Redshift): boto3 Redshift object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        target (str): available, paused, or deleted to wait until the cluster does not exist anymore
+        nodes (int): number of nodes the cluster must have, to wait for the end of a resize (optional)
+
+    Returns:
+        cluster (dict): cluster properties returned by describe_clusters, None when the target is deleted
+    """
+
+    deadline = time.monotonic() + config.provisioning_timeout
+    delay = config.poll_initial_delay
+    status = None
+
+    while True:
+        try:
+            response = await asyncio.to_thread(redshift.describe_clusters,\
+                                               ClusterIdentifier=config.dwh_cluster_identifier)
+            cluster = response['Clusters'][0]
+        except Exception as e:
+            if target == "deleted" and error_code(e) == "ClusterNotFound":
+                print("Redshift cluster {} deleted".format(config.dwh_cluster_identifier))
+                return None
+            raise
+
+        if cluster['ClusterStatus'] != status:
+            status = cluster['ClusterStatus']
+            print("Redshift cluster {} is {}".format(config.dwh_cluster_identifier, status))
+
+        if status == target and (nodes is None or cluster.get('NumberOfNodes') == nodes)\
+                and (target != "available" or cluster.get('Endpoint')):
+            return cluster
+        if status in FAILED_STATUSES:
+            raise RuntimeError("Redshift cluster {} is {}".format(config.dwh_cluster_identifier, status))
+
+        if time.monotonic() + delay > deadline:
+            raise TimeoutError("Redshift cluster {} is still {} after {:.0f}s".format(\
+                config.dwh_cluster_identifier, status, config.provisioning_timeout))
+
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, config.poll_max_delay)
+
+
+async def create_role(iam, config):
+    """
+    This method creates the IAM role that allows Redshift to read from S3. An existing role is reused 
+    and the S3 policy is attached to it again (attaching a policy twice has no effect).
+
+    Args:
+        iam (botocore.client.IAM): boto3 IAM object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+
+    Returns:
+        role_arn (str)
+    """
+
+    try:
+        return await asyncio.to_thread(iamS3, iam, config)
+    except Exception as e:
+        if error_code(e) != "EntityAlreadyExists":
+            raise
+        print("IAM role {} already exists".format(config.iam_role_name))
+        await asyncio.to_thread(iam.attach_role_policy, RoleName=config.iam_role_name, PolicyArn=config.iam_arn)
+        response = await asyncio.to_thread(iam.get_role, RoleName=config.iam_role_name)
+        return response['Role']['Arn']
+
+
+async def create_wlm_parameter_group(redshift, config):
+    """
+    This method creates the WLM parameter group of the cluster, or reuses an existing one, and sets its queues.
+    Nothing is done without PARAMETER_GROUP in the [WLM] section of dwh.cfg.
+
+    Args:
+        redshift (botocore.client.Redshift): boto3 Redshift object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+    """
+
+    if config.wlm_parameter_group is None:
+        return
+
+    try:
+        await asyncio.to_thread(create_parameter_group, redshift, config)
+    except Exception as e:
+        if error_code(e) != "ClusterParameterGroupAlreadyExists":
+            raise
+        print("Redshift parameter group {} already exists".format(config.wlm_parameter_group))
+    await asyncio.to_thread(apply_wlm_parameters, redshift, config)
+
+
+async def create_cluster(redshift, config, role_arn):
+    """
+    This method requests the creation of the Redshift cluster. An existing cluster is reused.
+
+    Args:
+        redshift (botocore.client.Redshift): boto3 Redshift object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        role_arn (str): ARN role that will be attached to the Redshift cluster
+    """
+
+    try:
+        await asyncio.to_thread(create_redshift, redshift, config, role_arn)
+    except Exception as e:
+        if error_code(e) != "ClusterAlreadyExists":
+            raise
+        print("Redshift cluster {} already exists".format(config.dwh_cluster_identifier))
+
+
+async def open_ingress(ec2, config, cluster):
+    """
+    This method opens the database port of the cluster to INGRESS_CIDR in the VPC security group of the cluster.
+
+    Args:
+        ec2 (botocore.client.EC2): boto3 EC2 object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        cluster (dict): cluster properties returned by describe_clusters
+    """
+
+    for security_group in cluster.get('VpcSecurityGroups', []):
+        group_id = security_group['VpcSecurityGroupId']
+        try:
+            await asyncio.to_thread(ec2.authorize_security_group_ingress,\
+                                    GroupId=group_id,\
+                                    IpPermissions=[{'IpProtocol': 'tcp',\
+                                                    'FromPort': int(config.db_port),\
+                                                    'ToPort': int(config.db_port),\
+                                                    'IpRanges': [{'CidrIp': config.ingress_cidr}]}])
+            print("Port {} of the security group {} opened to {}".format(config.db_port, group_id, config.ingress_cidr))
+        except Exception as e:
+            if error_code(e) != "InvalidPermission.Duplicate":
+                raise
+            print("Port {} of the security group {} is already open".format(config.db_port, group_id))
+
+
+async def provision(aws_clients, config):
+    """
+    This method creates the IAM role, the WLM parameter group and the Redshift cluster, waits until the cluster
+    is available and opens its port. The endpoint is cached for the connections opened later in the same process.
+
+    Args:
+        aws_clients (lib.aws): object with the boto3 clients
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+
+    Returns:
+        endpoint (str): endpoint address of the cluster
+    """
+
+    role_arn, _ = await asyncio.gather(create_role(aws_clients.iam, config),\
+                                       create_wlm_parameter_group(aws_clients.redshift, config))
+    await create_cluster(aws_clients.redshift, config, role_arn)
+
+    cluster = await wait_for_cluster(aws_clients.redshift, config, "available")
+    await open_ingress(aws_clients.ec2, config, cluster)
+
+    endpoint = cluster['Endpoint']['Address']
+    cache_endpoint(config, endpoint)
+    print("Redshift cluster {} available at {}:{}".format(config.dwh_cluster_identifier, endpoint, config.db_port))
+
+    return endpoint
+
+
+async def delete_cluster(redshift, config):
+    """
+    This method deletes the Redshift cluster and waits until it does not exist anymore.
+
+    Args:
+        redshift (botocore.client.Redshift): boto3 Redshift object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+    """
+
+    try:
+        await asyncio.to_thread(cleanup_redshift, redshift, config)
+    except Exception as e:
+        if error_code(e) != "ClusterNotFound":
+            raise
+        print("Redshift cluster {} does not exist".format(config.dwh_cluster_identifier))
+        return
+
+    await wait_for_cluster(redshift, config, "deleted")
+
+
+async def delete_wlm_parameter_group(redshift, config):
+    """
+    This method deletes the WLM parameter group, which is only possible once the cluster is deleted.
+    A group that does not exist is ignored.
+
+    Args:
+        redshift (botocore.client.Redshift): boto3 Redshift object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+    """
+
+    if config.wlm_parameter_group is None:
+        return
+
+    try:
+        await asyncio.to_thread(cleanup_parameter_group, redshift, config)
+    except Exception as e:
+        if error_code(e) != "ClusterParameterGroupNotFound":
+            raise
+        print("Redshift parameter group {} does not exist".format(config.wlm_parameter_group))
+
+
+async def delete_role(iam, config):
+    """
+    This method deletes the IAM role of the cluster. A role that does not exist is ignored.
+
+    Args:
+        iam (botocore.client.IAM): boto3 IAM object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+    """
+
+    try:
+        await asyncio.to_thread(cleanup_iam, iam, config)
+    except Exception as e:
+        if error_code(e) != "NoSuchEntity":
+            raise
+        print("IAM role {} does not exist".format(config.iam_role_name))
+
+
+async def teardown(aws_clients, config):
+    """
+    This method deletes the Redshift cluster and the IAM role at the same time and waits until both are gone.
+    The WLM parameter group is deleted afterwards, since it cannot be deleted while the cluster uses it.
+
+    Args:
+        aws_clients (lib.aws): object with the boto3 clients
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+    """
+
+    await asyncio.gather(delete_cluster(aws_clients.redshift, config), delete_role(aws_clients.iam, config))
+    await delete_wlm_parameter_group(aws_clients.redshift, config)
@@ -0,0 +1,105 @@
+"""
+This script contains the blue/green publishing of the tables read by the analysts (etl.py --publish swap).
+
+Loading the live tables statement by statement shows half-loaded data to the queries that run meanwhile.
+Instead, each table is rebuilt from the staging area into a shadow table (songplays_shadow, users_shadow, ...)
+while the live tables keep serving the readers, and the shadow tables are put in place at once:
+
+    1. build: the shadow tables are created and filled, in parallel on separate connections with --workers
+    2. swap: in a single transaction every live table is renamed to <table>_retired and its shadow
+       table to <table>, so the readers see either all the old tables or all the new ones
+    3. cleanup: the retired tables are dropped once the swap is committed
+
+The readers are only held by the swap, which renames the tables and does not move data.
+"""
+
+import time
+
+from scheduler import step, run_dag, print_report
+from schema import create_table, drop_table
+from sql_queries import song_lookup_build, published_tables, shadow_tables, retired_tables, shadow_insert_queries
+from sql_queries import table_rename, shadow_suffix, retired_suffix
+
+
+def publish_steps():
+    """
+    This method returns the steps that build the shadow tables. The shadow tables are created together
+    since the foreign keys of songplays_shadow reference the shadow dimensions.
+
+    Returns:
+        steps (list): list of scheduler.step objects
+    """
+
+    # songplays (referencing the dimensions) is dropped first and created last
+    create_shadows = "".join(drop_table(spec) + ";\n" for spec in shadow_tables) +\
+        "".join(create_table(spec) + ";\n" for spec in reversed(shadow_tables))
+
+    steps = [step("song_lookup", song_lookup_build), step("shadow_tables", create_shadows)]
+    for spec in published_tables:
+        depends_on = ["shadow_tables", "song_lookup"] if spec.name == "songplays" else ["shadow_tables"]
+        steps.append(step(spec.name + shadow_suffix, shadow_insert_queries[spec.name], depends_on=depends_on))
+
+    return steps
+
+
+def swap_query():
+    """
+    This method renders the transaction that puts the shadow tables in place. The retired tables left
+    by a run that failed before dropping them are dropped first.
+
+    Returns:
+        query (str)
+    """
+
+    return "".join(drop_table(spec) + ";\n" for spec in retired_tables) +\
+        "".join(table_rename.format(spec.name, spec.name + retired_suffix) for spec in published_tables) +\
+        "".join(table_rename.format(spec.name + shadow_suffix, spec.name) for spec in published_tables)
+
+
+def publish_tables(cur, conn, acquire, release, max_workers=1, bookkeeping=None):
+    """
+    This method is used to rebuild the songplays, users, songs, artists and time tables from the staging
+    area into shadow tables and to swap them with the live tables in a single transaction.
+    The duration of the build steps, of the swap and of the cleanup are reported.
+
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        conn (psycopg2.extensions.connection): psycopg2 connection object
+        acquire (callable): returns a psycopg2 connection for the build steps
+        release (callable): gives a connection back once a build step is completed
+        max_workers (int): maximum number of build steps running at the same time
+        bookkeeping (str): statements committed together with the swap, like etl.full_load_bookkeeping (optional)
+
+    Returns:
+        timings (dict): (start, end) epoch seconds of the build steps, the swap and the cleanup
+    """
+
+    print("\nBuilding the shadow tables of {} with {} workers\n".format(", ".join(spec.name for spec in published_tables),\
+                                                                      max_workers))
+
+    steps = publish_steps()
+    timings = run_dag(steps, acquire, release, max_workers=max_workers)
+    print_report(steps, timings)
+
+    start = time.time()
+    try:
+        cur.execute(swap_query())
+        if bookkeeping:
+            cur.execute(bookkeeping)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    timings["swap"] = (start, time.time())
+
+    start = time.time()
+    for spec in retired_tables:
+        cur.execute(drop_table(spec))
+    conn.commit()
+    timings["cleanup"] = (start, time.time())
+
+    build_seconds = max(timings[s.name][1] for s in steps) - min(timings[s.name][0] for s in steps)
+    print("Tables built in {:.2f}s, swapped in {:.2f}s, retired tables dropped in {:.2f}s".format(build_seconds,\
+        timings["swap"][1] - timings["swap"][0], timings["cleanup"][1] - timings["cleanup"][0]))
+
+    return timings
@@ -0,0 +1,222 @@
+"""
+This script contains the repair of the staging loads run with MAXERROR (etl.py --max-errors N).
+
+A malformed record no longer aborts the COPY of a whole prefix: the COPY skips up to N bad lines and the
+lines it rejected are recorded in etl_load_errors (see query_catalog in sql_queries.py). Once the staging
+tables are loaded only the S3 objects with rejected lines are handled:
+
+    1. each affected object is copied as it is under QUARANTINE_PREFIX/<run id>/<table>/original/
+    2. its rejected lines are read back and normalized with the casters of validate.py
+    3. the normalized records are written as JSON lines under QUARANTINE_PREFIX/<run id>/<table>/repaired/
+       and copied again, while the records that cannot be normalized are written into rejects.json
+
+The lines that loaded fine are not copied twice, so one bad file out of thousands costs a few records
+instead of a full re-ingest. The retry records its own rejected lines with attempt 2 and those are left
+in quarantine.
+"""
+
+import gzip
+import json
+
+from ingest import read_s3_object
+from lib import parse_s3_uri, write_manifest
+from schema import staging_events_table, staging_songs_table
+from sql_queries import load_errors_select
+from validate import load_jsonpaths, event_casters, validate_records
+
+
+def record_casters(source):
+    """
+    This method returns the normalization functions of the records of a staging table. The events are mapped
+    with the fields of the JSON paths file and the songs, copied with json 'auto', with the column names.
+
+    Args:
+        source (str): staging table name, staging_events or staging_songs
+
+    Returns:
+        casters (list): (field name, cast function) tuples
+    """
+
+    if source == "staging_events":
+        return event_casters(load_jsonpaths(), staging_events_table)
+    return event_casters([column for column, _ in staging_songs_table.columns], staging_songs_table)
+
+
+def load_errors(cur, run_id, attempt=1):
+    """
+    This method reads the lines rejected by the staging COPYs of a run.
+
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        run_id (str): identifier of the run
+        attempt (int): 1 for the load, 2 for the retry of the normalized records
+
+    Returns:
+        errors (dict): (source, S3 URI) -> list of (line number, column, error code, reason) tuples
+    """
+
+    cur.execute(load_errors_select, (run_id, attempt))
+
+    errors = {}
+    for source, filename, line_number, colname, err_code, err_reason in cur.fetchall():
+        errors.setdefault((source, filename), []).append((line_number, colname, err_code, err_reason))
+
+    return errors
+
+
+def rejected_lines(body, line_numbers):
+    """
+    This method finds the text of the rejected records of a file. A file that holds a single JSON document,
+    like the song files, is a single record, whatever line COPY reported.
+
+    Args:
+        body (bytes): file content, uncompressed
+        line_numbers (list): line numbers reported by stl_load_errors, starting at 1
+
+    Returns:
+        lines (dict): line number -> text of the record, None when the line does not exist
+    """
+
+    text = body.decode("utf-8", errors="replace")
+    try:
+        json.loads(text)
+        return {line_numbers[0]: text}
+    except ValueError:
+        pass
+
+    lines = text.splitlines()
+    return {n: lines[n - 1] if 1 <= n <= len(lines) else None for n in sorted(set(line_numbers))}
+
+
+def normalize_line(line, casters):
+    """
+    This method parses and normalizes a rejected line.
+
+    Args:
+        line (str): text of the record, None when it could not be found
+        casters (list): (field name, cast function) tuples, as returned by record_casters
+
+    Returns:
+        record (dict): normalized record, None when it cannot be normalized
+        errors (list): reasons why the record cannot be normalized
+    """
+
+    if line is None:
+        return None, ["line not found in the object"]
+
+    try:
+        raw = json.loads(line)
+    except ValueError as e:
+        return None, ["invalid JSON: {}".format(e)]
+
+    record, errors = next(validate_records([raw], casters))
+    if errors:
+        return None, errors
+
+    return record, errors
+
+
+def quarantine_objects(s3, config, run_id, errors):
+    """
+    This method quarantines the objects with rejected lines and normalizes those lines.
+    For each staging table the originals, the normalized records and the rejects are written under
+    QUARANTINE_PREFIX/<run id>/<table>/.
+
+    Args:
+        s3 (boto3.resources.factory.s3.ServiceResource): boto3 S3 resource
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        run_id (str): identifier of the run
+        errors (dict): rejected lines of each object, as returned by load_errors
+
+    Returns:
+        repaired (dict): source -> list of (S3 URI, size in bytes) tuples of the normalized records
+        n_normalized (int): records normalized
+        n_rejected (int): records that cannot be normalized
+    """
+
+    bucket_name, prefix = parse_s3_uri("{}/{}".format(config.quarantine_prefix.rstrip("/"), run_id))
+
+    records = {}
+    rejects = {}
+    for (source, uri), lines in sorted(errors.items()):
+        raw = read_s3_object(s3, uri)
+        source_bucket, key = parse_s3_uri(uri)
+        s3.Object(bucket_name, "{}/{}/original/{}/{}".format(prefix, source, source_bucket, key)).put(Body=raw)
+
+        body = gzip.decompress(raw) if uri.endswith(".gz") else raw
+        casters = record_casters(source)
+        reasons = {}
+        for line_number, colname, err_code, err_reason in lines:
+            reasons.setdefault(line_number, []).append("{} ({}): {}".format(colname, err_code, err_reason))
+
+        for line_number, line in rejected_lines(body, [line_number for line_number, _, _, _ in lines]).items():
+            record, normalize_errors = normalize_line(line, casters)
+            if record is not None:
+                records.setdefault(source, []).append(json.dumps(record))
+            else:
+                rejects.setdefault(source, []).append(json.dumps({"filename": uri, "line_number": line_number,\
+                                                                  "load_errors": reasons.get(line_number, []),\
+                                                                  "errors": normalize_errors, "line": line}))
+
+    repaired = {}
+    for source, lines in records.items():
+        key = "{}/{}/repaired/part-00000.json".format(prefix, source)
+        body = ("\n".join(lines) + "\n").encode("utf-8")
+        s3.Object(bucket_name, key).put(Body=body)
+        repaired[source] = [("s3://{}/{}".format(bucket_name, key), len(body))]
+
+    for source, lines in rejects.items():
+        s3.Object(bucket_name, "{}/{}/rejects.json".format(prefix, source)).put(Body=("\n".join(lines) + "\n").encode("utf-8"))
+
+    return repaired, sum(len(lines) for lines in records.values()), sum(len(lines) for lines in rejects.values())
+
+
+def repair_staging_loads(cur, conn, config, s3, queries, run_id):
+    """
+    This method is used to repair the staging loads of a run: the objects with rejected lines are quarantined,
+    the rejected lines are normalized and copied again with a single manifest COPY per staging table.
+
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        conn (psycopg2.extensions.connection): psycopg2 connection object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        s3 (boto3.resources.factory.s3.ServiceResource): boto3 S3 resource
+        queries (sql_queries.query_catalog): catalog that renders the COPY statements, with max_errors and run_id
+        run_id (str): identifier of the run
+
+    Returns:
+        summary (dict): number of objects quarantined and of records rejected, repaired and still rejected
+    """
+
+    if config.quarantine_prefix is None:
+        raise ValueError("QUARANTINE_PREFIX must be set in the [S3] section of dwh.cfg to repair the staging loads")
+
+    errors = load_errors(cur, run_id)
+    summary = {"objects": len(errors), "rejected": sum(len(lines) for lines in errors.values()),\
+               "repaired": 0, "unrepairable": 0, "rejected_again": 0}
+    if not errors:
+        print("\nNo lines rejected by the staging COPYs")
+        return summary
+
+    print("\n{} lines rejected in {} objects, quarantined under {}/{}".format(summary["rejected"], len(errors),\
+                                                                             config.quarantine_prefix.rstrip("/"), run_id))
+
+    repaired, n_normalized, summary["unrepairable"] = quarantine_objects(s3, config, run_id, errors)
+
+    for source, objects in repaired.items():
+        manifest_uri = "{}/{}/{}/repaired.manifest".format(config.quarantine_prefix.rstrip("/"), run_id, source)
+        write_manifest(s3, manifest_uri, [uri for uri, _ in objects], [size for _, size in objects])
+        try:
+            cur.execute(queries.staging_repair_copy(source, manifest_uri))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    summary["rejected_again"] = sum(len(lines) for lines in load_errors(cur, run_id, 2).values())
+    summary["repaired"] = n_normalized - summary["rejected_again"]
+
+    print("{repaired} records repaired and copied again, {unrepairable} could not be normalized, "\
+          "{rejected_again} were rejected again".format(**summary))
+
+    return summary
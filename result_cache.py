@@ -0,0 +1,397 @@
+"""
+This script contains a client-side cache of the results of the analytical queries run from a notebook
+or from the analytics examples, so a repeated SELECT does not run on the cluster again.
+
+A result is cached under the SQL text, normalized (comments removed, whitespace collapsed outside of the
+string literals, lowercase), its parameters and the version of the published data. The version is the last update
+of etl_watermark, which etl.py updates every time it publishes new data (publish_version), so the results
+computed before a load are not returned after it. The version is read at most every VERSION_CHECK_INTERVAL
+seconds and the caches of the process are cleared right away when etl.py publishes.
+
+The results are kept in memory in a least-recently-used order up to MAX_MB. With SPILL_DIR the results
+evicted from memory are written as Parquet files (this needs the optional package pyarrow) and read back
+when they are requested again. The settings are read from the [RESULT_CACHE] section of dwh.cfg:
+
+    conn, cur = redshift_connection(redshift, config, cache=result_cache.from_config(config))
+"""
+
+import atexit
+import hashlib
+import os
+import pickle
+import re
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+from collections import OrderedDict
+
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+from instrument import sql_tokens
+from sql_queries import publish_version_table_select, publish_version_select, publish_version_delete
+from sql_queries import publish_version_insert
+
+# Caches of the process, cleared when etl.py publishes new data
+_caches = weakref.WeakSet()
+
+
+def normalize_sql(query):
+    """
+    This method is used to normalize the text of a query so equivalent spellings share a cache entry.
+    The comments are removed, the whitespace is collapsed and the case is folded, except in the string literals
+    and the quoted identifiers (Redshift folds the other identifiers to lowercase). The query is tokenized by
+    instrument.sql_tokens, and a query that cannot be tokenized, like one with an unterminated literal,
+    is returned as it is.
+
+    Args:
+        query (str): SQL statement
+
+    Returns:
+        query (str)
+    """
+
+    try:
+        tokens = sql_tokens(query)
+    except ValueError:
+        return query
+
+    # (quoted, text) segments, the consecutive unquoted tokens are merged to collapse the whitespace between them
+    segments = []
+    for kind, text in tokens:
+        quoted = kind in ("string", "identifier")
+        if not quoted:
+            text = " " if kind == "comment" else text.lower()
+        if not quoted and segments and not segments[-1][0]:
+            segments[-1] = (False, segments[-1][1] + text)
+        else:
+            segments.append((quoted, text))
+    normalized = "".join(text if quoted else re.sub(r"\s+", " ", text) for quoted, text in segments)
+
+    return normalized.strip().rstrip(";").strip()
+
+
+def cacheable(query):
+    """
+    This method tells whether the results of a statement can be cached: only SELECT and WITH queries are.
+
+    Args:
+        query (str): normalized SQL statement
+
+    Returns:
+        cacheable (bool)
+    """
+
+    return re.match(r"(SELECT|WITH)\b", query, re.IGNORECASE) is not None
+
+
+class result_cache:
+    """
+    This class keeps the results of the queries in a size-bounded LRU in memory, with an optional Parquet spill.
+    It can be shared by the cursors of several connections and threads.
+
+    Attributes:
+        max_bytes: size of the results kept in memory, as measured by pickle
+        max_entries: number of results kept in memory
+        spill_dir: folder of this cache where the results evicted from memory are written as Parquet files,
+                   created under the spill_dir argument and removed when the process exits (optional)
+        version_check_interval: seconds during which the version of the published data is not read again
+    """
+
+    def __init__(self, max_bytes=256 * 2**20, max_entries=1000, spill_dir=None, version_check_interval=30):
+        self.max_bytes              = max_bytes
+        self.max_entries            = max_entries
+        self.spill_dir              = None
+        self.version_check_interval = version_check_interval
+        self.hits                   = 0
+        self.misses                 = 0
+
+        self._entries    = OrderedDict()
+        self._spilled    = set()
+        self._bytes      = 0
+        self._version    = None
+        self._checked_at = 0
+        self._lock       = threading.Lock()
+
+        if spill_dir is not None:
+            # each cache spills into its own folder, so clearing it never deletes the files of another cache
+            os.makedirs(spill_dir, exist_ok=True)
+            self.spill_dir = tempfile.mkdtemp(prefix="result_cache_", dir=spill_dir)
+            atexit.register(shutil.rmtree, self.spill_dir, True)
+        _caches.add(self)
+
+    def version(self, connection):
+        """
+        This method returns the version of the published data, reading it on the connection when the
+        last check is older than version_check_interval. The cache is cleared when the version changed.
+
+        Args:
+            connection (psycopg2.extensions.connection): connection of the cursor
+
+        Returns:
+            version (str): None when there is no published data yet, or when it cannot be read
+        """
+
+        if time.time() - self._checked_at < self.version_check_interval:
+            return self._version
+
+        # the existence of etl_watermark is checked first, so a missing table does not abort the transaction
+        idle = connection.get_transaction_status() == TRANSACTION_STATUS_IDLE
+        try:
+            with connection.cursor() as cur:
+                cur.execute(publish_version_table_select)
+                if cur.fetchone()[0] == 0:
+                    updated_at = None
+                else:
+                    cur.execute(publish_version_select)
+                    updated_at = cur.fetchone()[0]
+            version = None if updated_at is None else str(updated_at)
+        except Exception as e:
+            print("Version of the published data not available, the results are not cached: {}".format(e))
+            if idle:
+                connection.rollback()
+            version = None
+
+        with self._lock:
+            if version != self._version:
+                self._clear()
+                self._version = version
+            self._checked_at = time.time()
+
+        return version
+
+    def key(self, query, args, version):
+        return hashlib.sha1(repr((query, args, version)).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        """
+        This method returns a cached result, from memory or from the spill folder.
+
+        Args:
+            key (str): cache key
+
+        Returns:
+            result (tuple): (description, rows), None when the result is not cached
+        """
+
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+
+        result = self._read_spill(key)
+        with self._lock:
+            if result is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self.put(key, result)
+
+        return result
+
+    def put(self, key, result):
+        """
+        This method stores a result. The least recently used results are evicted, or spilled,
+        until the memory used is below max_bytes and max_entries.
+
+        Args:
+            key (str): cache key
+            result (tuple): (description, rows)
+        """
+
+        size = len(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (result, size)
+            self._bytes += size
+            while self._entries and (self._bytes > self.max_bytes or len(self._entries) > self.max_entries):
+                evicted_key, (evicted_result, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                evicted.append((evicted_key, evicted_result))
+
+        for evicted_key, evicted_result in evicted:
+            self._write_spill(evicted_key, evicted_result)
+
+    def invalidate(self):
+        """
+        This method drops all the cached results, in memory and spilled, and forces a version check.
+        """
+
+        with self._lock:
+            self._clear()
+            self._checked_at = 0
+
+    def _clear(self):
+        self._entries.clear()
+        self._bytes = 0
+        for key in self._spilled:
+            try:
+                os.remove(self._spill_path(key))
+            except FileNotFoundError:
+                pass
+        self._spilled.clear()
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, "{}.parquet".format(key))
+
+    def _write_spill(self, key, result):
+        if self.spill_dir is None:
+            return
+
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        description, rows = result
+        names = [column[0] for column in description]
+        table = pa.table({"c{}".format(i): [row[i] for row in rows] for i in range(len(names))})
+        # the cursor description is kept in the file metadata, the column names of a result may repeat
+        table = table.replace_schema_metadata({b"description": pickle.dumps(description)})
+        pq.write_table(table, self._spill_path(key))
+        with self._lock:
+            self._spilled.add(key)
+
+    def _read_spill(self, key):
+        if key not in self._spilled or not os.path.exists(self._spill_path(key)):
+            return None
+
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(self._spill_path(key))
+        description = pickle.loads(table.schema.metadata[b"description"])
+        columns = [table.column(i).to_pylist() for i in range(table.num_columns)]
+
+        return description, list(zip(*columns)) if columns else []
+
+
+class cached_cursor:
+    """
+    This class wraps a DB-API cursor and serves the SELECT queries from a result_cache.
+    The other statements run on the wrapped cursor and clear the cache, since they may change the data.
+
+    Attributes:
+        cursor: wrapped cursor
+        cache: result_cache the results are stored in
+    """
+
+    def __init__(self, cursor, cache):
+        self.cursor = cursor
+        self.cache  = cache
+        self._rows  = None
+        self._pos   = 0
+        self._description = None
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cursor.close()
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    @property
+    def description(self):
+        return self._description if self._rows is not None else self.cursor.description
+
+    @property
+    def rowcount(self):
+        return len(self._rows) if self._rows is not None else self.cursor.rowcount
+
+    def execute(self, query, args=None):
+        """
+        This method is used to execute a statement. The result of a SELECT is returned from the cache
+        when the same query was run on the same version of the data. The cache is bypassed when there
+        is no version of the published data.
+
+        Args:
+            query (str): SQL statement
+            args: query parameters, as in cursor.execute
+        """
+
+        self._rows = None
+        normalized = normalize_sql(query)
+        if not cacheable(normalized):
+            self.cursor.execute(query, args)
+            self.cache.invalidate()
+            return
+
+        version = self.cache.version(self.cursor.connection)
+        if version is None:
+            self.cursor.execute(query, args)
+            return
+
+        key = self.cache.key(normalized, args, version)
+        result = self.cache.get(key)
+        if result is None:
+            self.cursor.execute(query, args)
+            result = (self.cursor.description, self.cursor.fetchall())
+            self.cache.put(key, result)
+
+        self._description, self._rows = result
+        self._pos = 0
+
+    def fetchone(self):
+        if self._rows is None:
+            return self.cursor.fetchone()
+        if self._pos >= len(self._rows):
+            return None
+        self._pos += 1
+        return self._rows[self._pos - 1]
+
+    def fetchmany(self, size=None):
+        if self._rows is None:
+            return self.cursor.fetchmany(size or self.cursor.arraysize)
+        rows = self._rows[self._pos:self._pos + (size or self.cursor.arraysize)]
+        self._pos += len(rows)
+        return rows
+
+    def fetchall(self):
+        if self._rows is None:
+            return self.cursor.fetchall()
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+
+def from_config(config):
+    """
+    This method builds a result_cache with the settings of the [RESULT_CACHE] section of dwh.cfg.
+
+    Args:
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+
+    Returns:
+        cache (result_cache.result_cache)
+    """
+
+    return result_cache(config.cache_max_bytes, config.cache_max_entries, config.cache_spill_dir,\
+                        config.cache_version_check_interval)
+
+
+def publish_version(cur, conn):
+    """
+    This method is used by etl.py once new data is published: the version of the published data is updated,
+    which invalidates the results cached by other processes, and the caches of this process are cleared.
+
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        conn (psycopg2.extensions.connection): psycopg2 connection object
+    """
+
+    try:
+        cur.execute(publish_version_delete)
+        cur.execute(publish_version_insert)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    for cache in list(_caches):
+        cache.invalidate()
@@ -0,0 +1,210 @@
+"""
+This script contains a small dependency-aware scheduler used to run the transform queries.
+
+Each step declares the steps it depends on. The steps whose dependencies are completed run at the
+same time on separate database connections, so the wall-clock time of the transforms gets close
+to the duration of the longest dependency chain (the critical path) instead of the sum of all the steps.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class step:
+    """
+    This class represents a query of the DAG.
+
+    Attributes:
+        name: step name
+        query: SQL query executed by the step
+        depends_on: names of the steps that must be completed before this one starts
+    """
+
+    def __init__(self, name, query, depends_on=()):
+        self.name       = name
+        self.query      = query
+        self.depends_on = list(depends_on)
+
+
+def validate_dag(steps):
+    """
+    This method checks that the step names are unique, that every dependency is declared
+    and that the dependencies do not form a cycle.
+
+    Args:
+        steps (list): list of scheduler.step objects
+
+    Returns:
+        order (list): step names in a valid execution order
+    """
+
+    names = [s.name for s in steps]
+    if len(set(names)) != len(names):
+        raise ValueError("Duplicated step names: {}".format(names))
+
+    for s in steps:
+        for dependency in s.depends_on:
+            if dependency not in names:
+                raise ValueError("Step {} depends on the unknown step {}".format(s.name, dependency))
+
+    remaining = {s.name: set(s.depends_on) for s in steps}
+    order = []
+    while remaining:
+        ready = sorted(name for name, dependencies in remaining.items() if not dependencies)
+        if not ready:
+            raise ValueError("Cyclic dependencies between the steps {}".format(sorted(remaining)))
+        for name in ready:
+            order.append(name)
+            del remaining[name]
+        for dependencies in remaining.values():
+            dependencies.difference_update(ready)
+
+    return order
+
+
+def run_step(s, acquire, release):
+    """
+    This method executes the query of a step on its own connection and commits it.
+
+    Args:
+        s (scheduler.step): step to execute
+        acquire (callable): returns a DB-API connection
+        release (callable): gives the connection back once the step is completed. Its failures are printed,
+                            not raised, so they do not hide the error of the step
+
+    Returns:
+        start (float): epoch seconds when the query started
+        end (float): epoch seconds when the query was committed
+    """
+
+    conn = acquire()
+    try:
+        cur = conn.cursor()
+        start = time.time()
+        cur.execute(s.query)
+        conn.commit()
+        end = time.time()
+    except Exception:
+        try:
+            conn.rollback()
+        except Exception as error:
+            print("Rollback of step {} failed: {}".format(s.name, error))
+        raise
+    finally:
+        # a failure to give the connection back must not hide the error of the step
+        try:
+            release(conn)
+        except Exception as error:
+            print("Release of the connection of step {} failed: {}".format(s.name, error))
+
+    return start, end
+
+
+def run_dag(steps, acquire, release=lambda conn: conn.close(), max_workers=4):
+    """
+    This method runs the steps in parallel respecting their dependencies.
+    When a step fails its dependent steps are not started, the running ones are awaited
+    and the error is raised once the scheduler has drained.
+
+    Args:
+        steps (list): list of scheduler.step objects
+        acquire (callable): returns a DB-API connection, called once per step
+        release (callable): gives a connection back, it closes it by default
+        max_workers (int): maximum number of steps running at the same time
+
+    Returns:
+        timings (dict): (start, end) epoch seconds of each step
+    """
+
+    validate_dag(steps)
+
+    by_name = {s.name: s for s in steps}
+    pending = {s.name: len(s.depends_on) for s in steps}
+    dependents = {s.name: [] for s in steps}
+    for s in steps:
+        for dependency in s.depends_on:
+            dependents[dependency].append(s.name)
+
+    timings = {}
+    errors = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+
+        def submit(name):
+            print("Starting step {}".format(name))
+            futures[executor.submit(run_step, by_name[name], acquire, release)] = name
+
+        for name, count in pending.items():
+            if count == 0:
+                submit(name)
+
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = futures.pop(future)
+                try:
+                    timings[name] = future.result()
+                except Exception as e:
+                    print("Step {} failed: {}".format(name, e))
+                    errors[name] = e
+                    continue
+
+                print("Step {} completed in {:.2f}s".format(name, timings[name][1] - timings[name][0]))
+                for dependent in dependents[name]:
+                    pending[dependent] -= 1
+                    if pending[dependent] == 0:
+                        submit(dependent)
+
+    if errors:
+        skipped = sorted(set(by_name) - set(timings) - set(errors))
+        raise RuntimeError("Steps {} failed, steps {} were not run".format(sorted(errors), skipped))\
+            from next(iter(errors.values()))
+
+    return timings
+
+
+def critical_path(steps, timings):
+    """
+    This method computes the dependency chain with the largest accumulated duration.
+
+    Args:
+        steps (list): list of scheduler.step objects
+        timings (dict): (start, end) epoch seconds of each step, as returned by run_dag
+
+    Returns:
+        path (list): step names of the critical path
+        duration (float): accumulated duration in seconds of the critical path
+    """
+
+    by_name = {s.name: s for s in steps}
+    longest = {}
+
+    for name in validate_dag(steps):
+        start, end = timings[name]
+        best = max(by_name[name].depends_on, key=lambda dependency: longest[dependency][1], default=None)
+        path, duration = longest[best] if best is not None else ([], 0.0)
+        longest[name] = (path + [name], duration + end - start)
+
+    return max(longest.values(), key=lambda item: item[1], default=([], 0.0))
+
+
+def print_report(steps, timings):
+    """
+    This method prints the duration of each step, the wall-clock time and the critical path.
+
+    Args:
+        steps (list): list of scheduler.step objects
+        timings (dict): (start, end) epoch seconds of each step, as returned by run_dag
+    """
+
+    print("\nStep durations:")
+    for s in steps:
+        start, end = timings[s.name]
+        print("{:<20} {:>10.2f}s".format(s.name, end - start))
+
+    wall = max(end for _, end in timings.values()) - min(start for start, _ in timings.values())
+    path, duration = critical_path(steps, timings)
+
+    print("Wall-clock time: {:.2f}s".format(wall))
+    print("Critical path: {} ({:.2f}s)\n".format(" -> ".join(path), duration))
@@ -0,0 +1,460 @@
+"""
+This script contains the specification of the tables hosted in the DWH and the methods
+that render their CREATE and DROP statements.
+
+Besides the columns, each table spec carries the physical design choices of Redshift:
+    - distribution: small dimensions are replicated in every node (DISTSTYLE ALL), songs and
+      songplays are co-located on song_id and the staging tables on the song title they are joined on
+    - sort keys: the columns used to filter and join, like start_time in songplays
+    - compression: AZ64 for numeric and temporal columns, ZSTD for text. Sort key columns are
+      left uncompressed (RAW) so range-restricted scans are not slowed down
+See https://docs.aws.amazon.com/redshift/latest/dg/c_designing-tables-best-practices.html
+"""
+
+import re
+
+# Tables with an estimated size below this number of rows and without a DISTKEY are replicated
+ALL_DISTSTYLE_MAX_ROWS = 1000000
+
+AZ64_TYPES = ("SMALLINT", "INT", "INTEGER", "BIGINT", "DECIMAL", "NUMERIC", "DATE", "TIMESTAMP", "TIMESTAMPTZ")
+
+
+class table_spec:
+    """
+    This class gathers the definition of a table and its distribution, sort and compression settings.
+
+    Attributes:
+        name: table name
+        columns: list of (column name, column type) tuples
+        primary_key: primary key column (informational in Redshift)
+        foreign_keys: list of (column name, referenced table, referenced column) tuples
+        distkey: distribution key column. If None the distribution style is planned from estimated_rows
+        sortkey: list of sort key columns
+        estimated_rows: order of magnitude of the table size used to plan the distribution style
+        cascade: whether DROP TABLE must cascade to the dependent objects
+    """
+
+    def __init__(self, name, columns, primary_key=None, foreign_keys=(), distkey=None, sortkey=(),\
+                 estimated_rows=None, cascade=False):
+        self.name           = name
+        self.columns        = list(columns)
+        self.primary_key    = primary_key
+        self.foreign_keys   = list(foreign_keys)
+        self.distkey        = distkey
+        self.sortkey        = list(sortkey)
+        self.estimated_rows = estimated_rows
+        self.cascade        = cascade
+
+        column_names = [column for column, _ in self.columns]
+        for column in [distkey] + self.sortkey:
+            if column is not None and column not in column_names:
+                raise ValueError("Column {} is not defined in table {}".format(column, name))
+
+
+def plan_diststyle(spec):
+    """
+    This method chooses the distribution style of a table.
+    Tables with a DISTKEY are distributed by KEY, small tables are replicated in every node (ALL)
+    and large tables without a natural join column are spread round-robin (EVEN).
+
+    Args:
+        spec (schema.table_spec): table specification
+
+    Returns:
+        diststyle (str)
+    """
+
+    if spec.distkey is not None:
+        return "KEY"
+    if spec.estimated_rows is not None and spec.estimated_rows <= ALL_DISTSTYLE_MAX_ROWS:
+        return "ALL"
+    return "EVEN"
+
+
+def column_encoding(spec, column, column_type):
+    """
+    This method chooses the compression encoding of a column.
+
+    Args:
+        spec (schema.table_spec): table specification
+        column (str): column name
+        column_type (str): column type
+
+    Returns:
+        encoding (str)
+    """
+
+    if column in spec.sortkey:
+        return "RAW"
+    if column_type.split("(")[0].split(" ")[0].upper() in AZ64_TYPES:
+        return "AZ64"
+    return "ZSTD"
+
+
+def create_table(spec, dialect="redshift"):
+    """
+    This method renders the CREATE TABLE statement of a table specification.
+    With dialect="postgres" the statement is rendered for a local PostgreSQL stand-in (see benchmark.py): 
+    the distribution, sort and compression settings are left out, IDENTITY columns are rendered with 
+    the PostgreSQL syntax and the foreign keys, which Redshift does not enforce, are not declared.
+
+    Args:
+        spec (schema.table_spec): table specification
+        dialect (str): redshift or postgres
+
+    Returns:
+        query (str)
+    """
+
+    if dialect not in ("redshift", "postgres"):
+        raise ValueError("Unknown dialect {}, expected redshift or postgres".format(dialect))
+
+    if dialect == "postgres":
+        lines = ["    {} {}".format(column, re.sub(r"IDENTITY\(\d+,\s*\d+\)", "GENERATED BY DEFAULT AS IDENTITY", column_type))\
+                 for column, column_type in spec.columns]
+    else:
+        lines = ["    {} {} ENCODE {}".format(column, column_type, column_encoding(spec, column, column_type))\
+                 for column, column_type in spec.columns]
+
+    if spec.primary_key is not None:
+        lines.append("    PRIMARY KEY ({})".format(spec.primary_key))
+    if dialect == "redshift":
+        for column, table, reference in spec.foreign_keys:
+            lines.append("    FOREIGN KEY ({}) REFERENCES {}({})".format(column, table, reference))
+
+    query = "\nCREATE TABLE IF NOT EXISTS {} (\n{}\n    )\n".format(spec.name, ",\n".join(lines))
+    if dialect == "postgres":
+        return query
+
+    diststyle = plan_diststyle(spec)
+    query += "DISTSTYLE {}\n".format(diststyle)
+    if diststyle == "KEY":
+        query += "DISTKEY ({})\n".format(spec.distkey)
+    if spec.sortkey:
+        query += "SORTKEY ({})\n".format(", ".join(spec.sortkey))
+
+    return query
+
+
+def drop_table(spec):
+    """
+    This method renders the DROP TABLE statement of a table specification.
+
+    Args:
+        spec (schema.table_spec): table specification
+
+    Returns:
+        query (str)
+    """
+
+    return "DROP TABLE IF EXISTS {}{}".format(spec.name, " CASCADE" if spec.cascade else "")
+
+
+def renamed_spec(spec, suffix, renamed=()):
+    """
+    This method returns the specification of a copy of a table named with a suffix, like the shadow tables
+    of the blue/green publishing in publish.py. The foreign keys that reference one of the renamed tables
+    reference its copy, so once the copies are renamed into place they reference each other.
+
+    Args:
+        spec (schema.table_spec): table specification
+        suffix (str): suffix added to the table name
+        renamed (list): names of the tables that are copied together with this one
+
+    Returns:
+        spec (schema.table_spec)
+    """
+
+    foreign_keys = [(column, table + suffix if table in renamed else table, reference)\
+                    for column, table, reference in spec.foreign_keys]
+
+    return table_spec(spec.name + suffix, spec.columns, spec.primary_key, foreign_keys, spec.distkey, spec.sortkey,\
+                      spec.estimated_rows, spec.cascade)
+
+
+class summary_spec:
+    """
+    This class declares a summary table of songplays: the plays are grouped by a time grain of start_time
+    and by some dimension columns, and a few measures are kept for each group. The table specification
+    is derived from the declaration, with the grain column as sort key.
+
+    Attributes:
+        name: table name
+        grain: DATE_TRUNC unit of songplays.start_time (hour, day, week, month), also the name of the grain column
+        dimensions: list of (column name, column type, expression) tuples the plays are grouped by
+        measures: list of (column name, column type, expression, rollup) tuples. rollup is the aggregate that
+                  combines several rows of the summary, like SUM for a count, or None when the measure
+                  cannot be combined, like a distinct count
+        joins: tables joined to songplays to compute the dimensions
+        table: table_spec of the summary table
+    """
+
+    def __init__(self, name, grain, dimensions, measures, joins="", estimated_rows=None):
+        self.name       = name
+        self.grain      = grain
+        self.dimensions = list(dimensions)
+        self.measures   = list(measures)
+        self.joins      = joins
+        self.table      = table_spec(name,
+                                     columns=[(grain, "TIMESTAMP")] +\
+                                             [(column, column_type) for column, column_type, _ in self.dimensions] +\
+                                             [(column, column_type) for column, column_type, _, _ in self.measures],
+                                     sortkey=[grain],
+                                     estimated_rows=estimated_rows)
+
+
+# STAGING TABLES
+# Both staging tables are distributed on the song title so the songplays join is co-located
+
+staging_events_table = table_spec("staging_events",
+    columns=[
+        ("artist", "VARCHAR"),
+        ("auth", "VARCHAR"),
+        ("firstName", "VARCHAR"),
+        ("gender", "VARCHAR"),
+        ("itemInSession", "INT"),
+        ("lastName", "VARCHAR"),
+        ("length", "FLOAT"),
+        ("level", "VARCHAR"),
+        ("location", "VARCHAR"),
+        ("method", "VARCHAR"),
+        ("page", "VARCHAR"),
+        ("registration", "BIGINT"),
+        ("sessionId", "INT"),
+        ("song", "VARCHAR"),
+        ("status", "INT"),
+        ("ts", "BIGINT"),
+        ("userAgent", "VARCHAR"),
+        ("userId", "INT"),
+    ],
+    distkey="song",
+    sortkey=["ts"],
+)
+
+staging_songs_table = table_spec("staging_songs",
+    columns=[
+        ("artist_id", "VARCHAR"),
+        ("artist_latitude", "FLOAT"),
+        ("artist_location", "VARCHAR"),
+        ("artist_longitude", "FLOAT"),
+        ("artist_name", "VARCHAR"),
+        ("duration", "FLOAT"),
+        ("num_songs", "INT"),
+        ("song_id", "VARCHAR"),
+        ("title", "VARCHAR"),
+        ("year", "INT"),
+    ],
+    distkey="title",
+)
+
+# Deduplicated song lookup used by the songplays join: one row per (title, artist_name, rounded duration).
+# It is distributed and sorted like staging_events (on the song title) so the join is co-located
+
+song_lookup_table = table_spec("song_lookup",
+    columns=[
+        ("title", "VARCHAR"),
+        ("artist_name", "VARCHAR"),
+        ("duration", "DECIMAL(10,2)"),
+        ("song_id", "VARCHAR"),
+        ("artist_id", "VARCHAR"),
+    ],
+    distkey="title",
+    sortkey=["title", "artist_name"],
+)
+
+# FINAL TABLES
+# songplays and songs are co-located on song_id, the remaining dimensions are small and replicated
+
+songplay_table = table_spec("songplays",
+    columns=[
+        ("songplay_id", "INT IDENTITY(1,1)"),
+        ("start_time", "TIMESTAMP"),
+        ("user_id", "INT"),
+        ("level", "VARCHAR"),
+        ("song_id", "VARCHAR"),
+        ("artist_id", "VARCHAR"),
+        ("session_id", "INT"),
+        ("location", "VARCHAR"),
+        ("user_agent", "VARCHAR"),
+    ],
+    primary_key="songplay_id",
+    foreign_keys=[
+        ("user_id", "users", "user_id"),
+        ("song_id", "songs", "song_id"),
+        ("artist_id", "artists", "artist_id"),
+        ("start_time", "time", "start_time"),
+    ],
+    distkey="song_id",
+    sortkey=["start_time"],
+)
+
+user_table = table_spec("users",
+    columns=[
+        ("user_id", "INT"),
+        ("first_name", "VARCHAR"),
+        ("last_name", "VARCHAR"),
+        ("gender", "VARCHAR"),
+        ("level", "VARCHAR"),
+    ],
+    primary_key="user_id",
+    sortkey=["user_id"],
+    estimated_rows=10000,
+    cascade=True,
+)
+
+song_table = table_spec("songs",
+    columns=[
+        ("song_id", "VARCHAR"),
+        ("title", "VARCHAR"),
+        ("artist_id", "VARCHAR"),
+        ("year", "INT"),
+        ("duration", "FLOAT"),
+    ],
+    primary_key="song_id",
+    distkey="song_id",
+    sortkey=["song_id"],
+    cascade=True,
+)
+
+artist_table = table_spec("artists",
+    columns=[
+        ("artist_id", "VARCHAR"),
+        ("artist_name", "VARCHAR"),
+        ("artist_location", "VARCHAR"),
+        ("artist_latitude", "INT"),
+        ("artist_longitude", "INT"),
+    ],
+    primary_key="artist_id",
+    sortkey=["artist_id"],
+    estimated_rows=100000,
+    cascade=True,
+)
+
+time_table = table_spec("time",
+    columns=[
+        ("start_time", "TIMESTAMP"),
+        ("hour", "INT"),
+        ("day", "INT"),
+        ("week", "INT"),
+        ("month", "INT"),
+        ("year", "INT"),
+        ("weekday", "INT"),
+    ],
+    primary_key="start_time",
+    sortkey=["start_time"],
+    estimated_rows=1000000,
+    cascade=True,
+)
+
+# SUMMARY TABLES
+# Aggregates of songplays read by the dashboards instead of the fact table. They are refreshed by etl.py
+# for the time buckets of the events transformed in each run (see summaries.py)
+
+song_plays_daily = summary_spec("song_plays_daily", "day",
+    dimensions=[
+        ("song_id", "VARCHAR", "songplays.song_id"),
+        ("title", "VARCHAR", "songs.title"),
+        ("artist_id", "VARCHAR", "songplays.artist_id"),
+    ],
+    measures=[
+        ("plays", "BIGINT", "COUNT(*)", "SUM"),
+        ("listeners", "BIGINT", "COUNT(DISTINCT songplays.user_id)", None),
+    ],
+    joins="LEFT JOIN songs ON songs.song_id = songplays.song_id",
+)
+
+level_users_hourly = summary_spec("level_users_hourly", "hour",
+    dimensions=[
+        ("level", "VARCHAR", "songplays.level"),
+    ],
+    measures=[
+        ("active_users", "BIGINT", "COUNT(DISTINCT songplays.user_id)", None),
+        ("plays", "BIGINT", "COUNT(*)", "SUM"),
+        ("sessions", "BIGINT", "COUNT(DISTINCT songplays.session_id)", None),
+    ],
+    estimated_rows=100000,
+)
+
+artist_plays_weekly = summary_spec("artist_plays_weekly", "week",
+    dimensions=[
+        ("artist_id", "VARCHAR", "songplays.artist_id"),
+        ("artist_name", "VARCHAR", "artists.artist_name"),
+    ],
+    measures=[
+        ("plays", "BIGINT", "COUNT(*)", "SUM"),
+        ("listeners", "BIGINT", "COUNT(DISTINCT songplays.user_id)", None),
+    ],
+    joins="LEFT JOIN artists ON artists.artist_id = songplays.artist_id",
+)
+
+summary_tables = [song_plays_daily, level_users_hourly, artist_plays_weekly]
+
+# CONTROL TABLES
+
+etl_watermark_table = table_spec("etl_watermark",
+    columns=[
+        ("source", "VARCHAR"),
+        ("max_ts", "BIGINT"),
+        ("updated_at", "TIMESTAMP"),
+    ],
+    primary_key="source",
+    estimated_rows=10,
+)
+
+etl_loaded_keys_table = table_spec("etl_loaded_keys",
+    columns=[
+        ("source", "VARCHAR"),
+        ("s3_key", "VARCHAR(1024)"),
+        ("loaded_at", "TIMESTAMP"),
+    ],
+    primary_key="s3_key",
+    sortkey=["s3_key"],
+    estimated_rows=100000,
+)
+
+# Days of LOG_DATA (log_data/YYYY/MM/YYYY-MM-DD-events.json) already copied into staging_events 
+# by the date-range loads of etl.py
+
+etl_partitions_table = table_spec("etl_partitions",
+    columns=[
+        ("partition_date", "DATE"),
+        ("s3_prefix", "VARCHAR(1024)"),
+        ("loaded_at", "TIMESTAMP"),
+    ],
+    primary_key="partition_date",
+    sortkey=["partition_date"],
+    estimated_rows=10000,
+)
+
+# Lines rejected by the COPYs run with MAXERROR (etl.py --max-errors), taken from stl_load_errors 
+# after each COPY. attempt is 1 for the load and 2 for the retry of the normalized records
+
+etl_load_errors_table = table_spec("etl_load_errors",
+    columns=[
+        ("run_id", "VARCHAR(64)"),
+        ("attempt", "SMALLINT"),
+        ("source", "VARCHAR(64)"),
+        ("query", "INT"),
+        ("filename", "VARCHAR(1024)"),
+        ("line_number", "BIGINT"),
+        ("colname", "VARCHAR(127)"),
+        ("err_code", "INT"),
+        ("err_reason", "VARCHAR(100)"),
+        ("loaded_at", "TIMESTAMP"),
+    ],
+    sortkey=["run_id"],
+    estimated_rows=100000,
+)
+
+etl_run_ledger_table = table_spec("etl_run_ledger",
+    columns=[
+        ("run_id", "VARCHAR(64)"),
+        ("stage", "VARCHAR(64)"),
+        ("status", "VARCHAR(16)"),
+        ("fingerprint", "VARCHAR(64)"),
+        ("row_count", "BIGINT"),
+        ("updated_at", "TIMESTAMP"),
+    ],
+    sortkey=["run_id"],
+    estimated_rows=10000,
+)
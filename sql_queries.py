@@ -1,150 +1,332 @@
-import configparser
-from lib import aws_config, aws
+"""
+This script contains the SQL statements of the pipeline.
 
-# CONFIG
-# To be done by the developer/user of this code: 
-# Edit the configuration file ./dwh.cfg according to your use-case
-# REMEMBER TO NOT EXPOSE LIVE TOKENS/PASSWORDS IN GIT/GITHUB!
-config_path = "./dwh.cfg"
-config = aws_config(config_path)
+Importing it does not read the configuration file nor call AWS: the statements that depend on 
+the setup (the COPY commands need the S3 paths and the IAM role ARN) are kept as templates and 
+rendered by a query_catalog object when they are needed, so the DDL and the transforms can be 
+inspected offline.
+"""
+
+from schema import create_table, drop_table, renamed_spec
+from schema import staging_events_table, staging_songs_table, song_lookup_table
+from schema import songplay_table, user_table, song_table, artist_table, time_table
+from schema import etl_watermark_table, etl_loaded_keys_table, etl_partitions_table, etl_load_errors_table
+from schema import etl_run_ledger_table
+from schema import summary_tables
 
 # DROP TABLES
 
-staging_events_table_drop = "DROP TABLE IF EXISTS staging_events"
-staging_songs_table_drop = "DROP TABLE IF EXISTS staging_songs"
-songplay_table_drop = "DROP TABLE IF EXISTS songplays"
-user_table_drop = "DROP TABLE IF EXISTS users CASCADE"
-song_table_drop = "DROP TABLE IF EXISTS songs CASCADE"
-artist_table_drop = "DROP TABLE IF EXISTS artist CASCADE"
-time_table_drop = "DROP TABLE IF EXISTS time CASCADE"
+staging_events_table_drop = drop_table(staging_events_table)
+staging_songs_table_drop = drop_table(staging_songs_table)
+song_lookup_table_drop = drop_table(song_lookup_table)
+songplay_table_drop = drop_table(songplay_table)
+user_table_drop = drop_table(user_table)
+song_table_drop = drop_table(song_table)
+artist_table_drop = drop_table(artist_table)
+time_table_drop = drop_table(time_table)
+etl_watermark_table_drop = drop_table(etl_watermark_table)
+etl_loaded_keys_table_drop = drop_table(etl_loaded_keys_table)
+etl_partitions_table_drop = drop_table(etl_partitions_table)
+etl_load_errors_table_drop = drop_table(etl_load_errors_table)
+etl_run_ledger_table_drop = drop_table(etl_run_ledger_table)
 
 # CREATE TABLES
+# The DDL is rendered from the table specifications in schema.py, 
+# which include the distribution, sort key and compression settings
+
+staging_events_table_create = create_table(staging_events_table)
+staging_songs_table_create = create_table(staging_songs_table)
+song_lookup_table_create = create_table(song_lookup_table)
+songplay_table_create = create_table(songplay_table)
+user_table_create = create_table(user_table)
+song_table_create = create_table(song_table)
+artist_table_create = create_table(artist_table)
+time_table_create = create_table(time_table)
+
+# CONTROL TABLES
+# Bookkeeping of the incremental loads: the high-water mark of the events already 
+# transformed and the S3 objects already ingested into the staging area
+
+etl_watermark_table_create = create_table(etl_watermark_table)
+etl_loaded_keys_table_create = create_table(etl_loaded_keys_table)
+etl_partitions_table_create = create_table(etl_partitions_table)
+etl_load_errors_table_create = create_table(etl_load_errors_table)
+etl_run_ledger_table_create = create_table(etl_run_ledger_table)
+
+watermark_select = ("""
+SELECT COALESCE(MAX(max_ts), 0) FROM etl_watermark WHERE source = 'staging_events'
+""")
+
+watermark_delete = ("""
+DELETE FROM etl_watermark WHERE source = 'staging_events'
+""")
+
+watermark_insert = ("""
+INSERT INTO etl_watermark (source, max_ts, updated_at) 
+SELECT 'staging_events', GREATEST(COALESCE(MAX(ts), 0), {}), GETDATE() 
+FROM staging_events
+""")
+
+# Version of the published data the client-side result cache (result_cache.py) is keyed on. The existence of
+# etl_watermark is checked first, since reading a missing table aborts the transaction
+publish_version_table_select = ("""
+SELECT COUNT(*) FROM pg_tables WHERE tablename = 'etl_watermark'
+""")
+
+publish_version_select = ("""
+SELECT MAX(updated_at) FROM etl_watermark
+""")
+
+publish_version_delete = ("""
+DELETE FROM etl_watermark WHERE source = 'published'
+""")
+
+publish_version_insert = ("""
+INSERT INTO etl_watermark (source, max_ts, updated_at) VALUES ('published', 0, GETDATE())
+""")
+
+loaded_keys_select = ("""
+SELECT s3_key FROM etl_loaded_keys WHERE source = %s
+""")
+
+loaded_keys_insert = ("""
+INSERT INTO etl_loaded_keys (source, s3_key, loaded_at) VALUES (%s, %s, GETDATE())
+""")
+
+# A full load replaces the keys of a source with the objects it copied. Formatted with the source 
+# and with the (source, key, GETDATE()) rows rendered as SQL literals
+loaded_keys_delete = ("""
+DELETE FROM etl_loaded_keys WHERE source = '{}';
+""")
 
-staging_events_table_create= ("""
-CREATE TABLE IF NOT EXISTS staging_events(
-    artist VARCHAR,
-    auth VARCHAR,
-    firstName VARCHAR,
-    gender VARCHAR,
-    itemInSession INT,
-    lastName VARCHAR,
-    length FLOAT,
-    level VARCHAR,
-    location VARCHAR,
-    method VARCHAR,
-    page VARCHAR,
-    registration BIGINT,
-    sessionId INT,
-    song VARCHAR,
-    status INT,
-    ts BIGINT,
-    userAgent VARCHAR,
-    userId INT
-    )
-""")
-
-staging_songs_table_create = ("""
-CREATE TABLE IF NOT EXISTS staging_songs(
-    artist_id VARCHAR,
-    artist_latitude FLOAT,
-    artist_location VARCHAR,
-    artist_longitude FLOAT,
-    artist_name VARCHAR,
-    duration FLOAT,
-    num_songs INT,
-    song_id VARCHAR,
-    title VARCHAR,
-    year INT
-    )
-""")
-
-songplay_table_create = ("""
-CREATE TABLE IF NOT EXISTS songplays (
-    songplay_id INT IDENTITY(1,1),
-    start_time TIMESTAMP, 
-    user_id INT, 
-    level VARCHAR, 
-    song_id VARCHAR, 
-    artist_id VARCHAR, 
-    session_id INT, 
-    location VARCHAR, 
-    user_agent VARCHAR,
-    PRIMARY KEY (songplay_id),
-    FOREIGN KEY (user_id) REFERENCES users(user_id),
-    FOREIGN KEY (song_id) REFERENCES songs(song_id),
-    FOREIGN KEY (artist_id) REFERENCES artists(artist_id),
-    FOREIGN KEY (start_time) REFERENCES time(start_time)
-    ) 
-""")
-
-user_table_create = ("""
-CREATE TABLE IF NOT EXISTS users (
-    user_id INT,
-    first_name VARCHAR,
-    last_name VARCHAR,
-    gender VARCHAR,
-    level VARCHAR,
-    PRIMARY KEY (user_id)
-    )
-""")
-
-song_table_create = ("""
-CREATE TABLE IF NOT EXISTS songs (
-    song_id VARCHAR,
-    title VARCHAR,
-    artist_id VARCHAR,
-    year INT,
-    duration FLOAT,
-    PRIMARY KEY (song_id)
-    )
-""")
-
-artist_table_create = ("""
-CREATE TABLE IF NOT EXISTS artists (
-    artist_id VARCHAR,
-    artist_name VARCHAR,
-    artist_location VARCHAR,
-    artist_latitude INT,
-    artist_longitude INT,
-    PRIMARY KEY (artist_id)
-    )
-""")
-
-time_table_create = ("""
-CREATE TABLE IF NOT EXISTS time (
-    start_time TIMESTAMP,
-    hour INT,
-    day INT,
-    week INT,
-    month INT,
-    year INT,
-    weekday INT,
-    PRIMARY KEY (start_time)
-    )
+loaded_keys_values_insert = ("""
+INSERT INTO etl_loaded_keys (source, s3_key, loaded_at) VALUES {};
+""")
+
+# NextSong events of the staging area at or below the high-water mark, which an incremental load does not transform
+late_events_select = ("""
+SELECT COUNT(*) FROM staging_events WHERE page = 'NextSong' AND ts <= {}
+""")
+
+# Days of the event logs already loaded by the date-range loads, between two dates
+partitions_loaded_select = ("""
+SELECT partition_date FROM etl_partitions WHERE partition_date BETWEEN %s AND %s
+""")
+
+# Formatted with the day (YYYY-MM-DD) and the S3 prefix of its objects
+partition_loaded_insert = ("""
+DELETE FROM etl_partitions WHERE partition_date = '{0}';
+INSERT INTO etl_partitions (partition_date, s3_prefix, loaded_at) VALUES ('{0}', '{1}', GETDATE());
+""")
+
+# Lines rejected by the last COPY of the session (see etl.py --max-errors), formatted with the run id, 
+# the attempt and the staging table. query_catalog appends it to the COPY so both are committed together
+load_errors_capture = ("""
+INSERT INTO etl_load_errors (run_id, attempt, source, query, filename, line_number, colname, err_code, err_reason, loaded_at) 
+SELECT '{0}', {1}, '{2}', query, TRIM(filename), line_number, TRIM(colname), err_code, TRIM(err_reason), GETDATE() 
+FROM stl_load_errors 
+WHERE query = pg_last_copy_id();
+""")
+
+load_errors_select = ("""
+SELECT source, filename, line_number, colname, err_code, err_reason 
+FROM etl_load_errors 
+WHERE run_id = %s AND attempt = %s 
+ORDER BY source, filename, line_number
+""")
+
+# RUN LEDGER
+# Stages completed by each full run, read by ledger.py to resume a failed run. The run itself is the row 
+# of the stage 'run', with the status running, failed or completed
+
+ledger_last_run_select = ("""
+SELECT run_id, status, fingerprint FROM etl_run_ledger WHERE stage = 'run' ORDER BY updated_at DESC LIMIT 1
+""")
+
+ledger_stages_select = ("""
+SELECT stage, row_count, updated_at 
+FROM etl_run_ledger 
+WHERE run_id = %s AND stage <> 'run' AND status = 'completed' AND fingerprint = %s 
+ORDER BY updated_at
+""")
+
+# Formatted with the run id, the stage, the status, the fingerprint and the row count expression (or NULL)
+ledger_stage_upsert = ("""
+DELETE FROM etl_run_ledger WHERE run_id = '{0}' AND stage = '{1}';
+INSERT INTO etl_run_ledger (run_id, stage, status, fingerprint, row_count, updated_at) 
+SELECT '{0}', '{1}', '{2}', '{3}', {4}, GETDATE();
+""")
+
+# MAINTENANCE
+# Unsorted rows and staleness of the statistics (both in percent) of the tables of the current schema, 
+# read by maintenance.py to decide which tables are vacuumed and analyzed after the transforms
+
+table_info_select = ("""
+SELECT "table", unsorted, stats_off, tbl_rows 
+FROM svv_table_info 
+WHERE "schema" = current_schema() AND "table" IN %s
+""")
+
+# VACUUM cannot run inside a transaction block, see maintenance.py
+vacuum_sort_only = "VACUUM SORT ONLY {}"
+
+analyze_table = "ANALYZE {}"
+
+# WORKLOAD MANAGEMENT
+# Session settings of wlm.py: the query group routes the statements to a WLM queue, 
+# the slot count gives the heavy statements the memory of several slots
+
+set_query_group = "SET query_group TO '{}'"
+
+set_slot_count = "SET wlm_query_slot_count TO {}"
+
+reset_query_group = "RESET query_group"
+
+reset_slot_count = "RESET wlm_query_slot_count"
+
+# INSTRUMENTATION
+# Statistics read by instrument.py after each statement: the ids of the last query and of the last COPY
+# of the session and, after a COPY, the files and lines it committed. stl_load_commits is read on
+# another connection, with the id of the COPY
+
+last_query_id_select = "SELECT pg_last_query_id(), pg_last_copy_id()"
+
+load_commits_select = ("""
+SELECT COUNT(DISTINCT TRIM(filename)), COALESCE(SUM(lines_scanned), 0), COALESCE(SUM(errors), 0)
+FROM stl_load_commits
+WHERE query = %s
 """)
 
 # STAGING TABLES
 
-aws_clients = aws(config)
-role_arn_dwhS3 = aws_clients.iam.get_role(RoleName=config.iam_role_name)['Role']['Arn']
+staging_events_table_truncate = "TRUNCATE staging_events"
+staging_songs_table_truncate = "TRUNCATE staging_songs"
+
+# Removes the events of a day (epoch-ms bounds) before the day is loaded again, so reloading a partition 
+# does not duplicate its events
+staging_events_range_delete = ("""
+DELETE FROM staging_events WHERE ts >= {0} AND ts < {1};
+""")
+
+# The COPY templates are rendered by query_catalog with the S3 source, the IAM role ARN 
+# and, for the events, the JSON paths file
 
 staging_events_copy = ("""
 COPY staging_events 
 FROM '{}' 
 iam_role '{}' 
 json '{}';
-""").format(config.log_data, role_arn_dwhS3, config.log_jsonpath)
+""")
 
 staging_songs_copy = ("""
 COPY staging_songs 
 FROM '{}' 
 iam_role '{}' 
 json 'auto';
-""").format(config.song_data, role_arn_dwhS3)
+""")
+
+# The manifest COPY templates are rendered with the S3 URI of the manifest that lists 
+# the objects to be loaded and the data format clause of the objects (see copy_format_clause)
+
+staging_events_manifest_copy = ("""
+COPY staging_events 
+FROM '{}' 
+iam_role '{}' 
+{}
+manifest;
+""")
+
+staging_songs_manifest_copy = ("""
+COPY staging_songs 
+FROM '{}' 
+iam_role '{}' 
+{}
+manifest;
+""")
+
+# Data formats of the staging input: raw JSON, compressed JSON-lines and Parquet
+copy_formats = [None, "gzip", "zstd", "parquet"]
+
+
+def copy_format_clause(data_format, jsonpath):
+    """
+    This method renders the data format clause of a COPY statement.
+    
+    Args:
+        data_format (str): None for raw JSON, gzip or zstd for compressed JSON-lines or parquet
+        jsonpath (str): JSON paths file used to map the JSON fields to columns or 'auto'
+    
+    Returns:
+        clause (str)
+    """
+    
+    if data_format not in copy_formats:
+        raise ValueError("Unknown COPY format {}, expected one of {}".format(data_format, copy_formats))
+    
+    if data_format == "parquet":
+        return "FORMAT AS PARQUET"
+    if data_format is None:
+        return "json '{}'".format(jsonpath)
+    return "json '{}'\n{}".format(jsonpath, data_format)
+
+
+def copy_options(copy, options):
+    """
+    This method adds options, like MAXERROR, at the end of a COPY statement.
+    
+    Args:
+        copy (str): rendered COPY statement
+        options (list): COPY options
+    
+    Returns:
+        copy (str)
+    """
+    
+    if not options:
+        return copy
+    return "{}\n{};\n".format(copy.rstrip().rstrip(";"), "\n".join(options))
 
 # FINAL TABLES
 
-songplay_table_insert = ("""
+# The song lookup holds one row per (title, artist_name, duration rounded to 2 decimals), so the 
+# songplays join cannot fan out when staging_songs has duplicated songs. It is rebuilt on every run 
+# with DELETE (TRUNCATE would commit the transaction)
+
+song_lookup_build = ("""
+DELETE FROM song_lookup;
+INSERT INTO song_lookup (title, artist_name, duration, song_id, artist_id) 
+SELECT
+    title,
+    artist_name,
+    duration,
+    song_id,
+    artist_id
+FROM (
+    SELECT
+        title,
+        artist_name,
+        CAST(duration AS DECIMAL(10,2)) AS duration,
+        song_id,
+        artist_id,
+        ROW_NUMBER() OVER (
+            PARTITION BY title, artist_name, CAST(duration AS DECIMAL(10,2)) 
+            ORDER BY song_id
+        ) AS row_rank
+    FROM
+        staging_songs
+    WHERE
+        title IS NOT NULL AND
+        artist_name IS NOT NULL AND
+        duration IS NOT NULL
+    ) AS ranked
+WHERE
+    row_rank = 1;
+""")
+
+# The NextSong events are filtered before the join. The placeholder takes the extra event 
+# filter of the incremental load
+
+songplay_table_select = ("""
 INSERT INTO songplays (
     start_time, 
     user_id, 
@@ -158,99 +340,411 @@ INSERT INTO songplays (
     TIMESTAMP 'epoch' + events_data.ts/1000 * INTERVAL '1 second' AS start_time, 
     events_data.userId, 
     events_data.level, 
-    events_data.song,
+    songs_data.song_id,
     songs_data.artist_id, 
     events_data.sessionId,
     events_data.location, 
     events_data.userAgent
-FROM 
-    staging_events AS events_data, 
-    staging_songs AS songs_data
-WHERE  
+FROM (
+    SELECT 
+        *
+    FROM 
+        staging_events
+    WHERE 
+        page = 'NextSong'{}
+    ) AS events_data
+JOIN song_lookup AS songs_data ON
     events_data.song = songs_data.title AND 
     events_data.artist = songs_data.artist_name AND 
-    events_data.length = songs_data.duration AND
-    events_data.page = 'NextSong'
+    CAST(events_data.length AS DECIMAL(10,2)) = songs_data.duration
 """)
 
-user_table_insert = ("""
-INSERT INTO users (
+songplay_table_insert = songplay_table_select.format("")
+
+# The dimension tables (and time below) are loaded with idempotent upserts. Redshift does not enforce PRIMARY KEYs 
+# so a plain INSERT ... SELECT adds one row per staging record and per run. Instead, a delta with one 
+# row per key is staged in a temporary table and it replaces the matching rows of the dimension 
+# (DELETE + INSERT). Each upsert is a single multi-statement query so it runs in one transaction.
+
+def upsert_query(table, key, columns, delta_select):
+    """
+    This method builds the delete+insert upsert of a dimension table.
+    
+    Args:
+        table (str): dimension table name
+        key (str): primary key column of the dimension table
+        columns (list): columns of the dimension table
+        delta_select (str): SELECT statement returning one row per key with the given columns
+    
+    Returns:
+        query (str)
+    """
+    
+    return """
+CREATE TEMP TABLE {table}_delta AS {delta_select};
+DELETE FROM {table} USING {table}_delta WHERE {table}.{key} = {table}_delta.{key};
+INSERT INTO {table} ({columns}) SELECT {columns} FROM {table}_delta;
+DROP TABLE {table}_delta;
+""".format(table=table, key=key, columns=", ".join(columns), delta_select=delta_select.strip())
+
+
+user_columns = ["user_id", "first_name", "last_name", "gender", "level"]
+song_columns = ["song_id", "title", "artist_id", "year", "duration"]
+artist_columns = ["artist_id", "artist_name", "artist_location", "artist_latitude", "artist_longitude"]
+
+# The latest event of each user (by ts) provides its current level
+user_delta_select = ("""
+SELECT
     user_id,
     first_name,
     last_name,
     gender,
-    level 
-) SELECT
-    userid,
-    firstName,
-    lastName,
-    gender,
     level
-FROM
-    staging_events
+FROM (
+    SELECT
+        userid AS user_id,
+        firstName AS first_name,
+        lastName AS last_name,
+        gender,
+        level,
+        ROW_NUMBER() OVER (PARTITION BY userid ORDER BY ts DESC) AS row_rank
+    FROM
+        staging_events
+    WHERE
+        userid IS NOT NULL{}
+    ) AS ranked
 WHERE
-    userid IS NOT NULL
+    row_rank = 1
 """)
 
-song_table_insert = ("""
-INSERT INTO songs (
-    song_id,
-    title,
-    artist_id,
-    year,
-    duration 
-) SELECT
+song_delta_select = ("""
+SELECT
     song_id,
     title,
     artist_id,
     year,
     duration
-FROM
-    staging_songs
+FROM (
+    SELECT
+        song_id,
+        title,
+        artist_id,
+        year,
+        duration,
+        ROW_NUMBER() OVER (PARTITION BY song_id ORDER BY year DESC) AS row_rank
+    FROM
+        staging_songs
+    WHERE
+        song_id IS NOT NULL
+    ) AS ranked
+WHERE
+    row_rank = 1
 """)
 
-artist_table_insert = ("""
-INSERT INTO artists (
+# Records with a known location are preferred when an artist appears more than once
+artist_delta_select = ("""
+SELECT
     artist_id,
     artist_name,
     artist_location,
     artist_latitude,
-    artist_longitude 
-) SELECT
-    artist_id, 
-    artist_name, 
-    artist_location, 
-    artist_latitude, 
     artist_longitude
-FROM
-    staging_songs
+FROM (
+    SELECT
+        artist_id, 
+        artist_name, 
+        artist_location, 
+        artist_latitude, 
+        artist_longitude,
+        ROW_NUMBER() OVER (
+            PARTITION BY artist_id 
+            ORDER BY CASE WHEN artist_latitude IS NULL THEN 1 ELSE 0 END, artist_name
+        ) AS row_rank
+    FROM
+        staging_songs
+    WHERE
+        artist_id IS NOT NULL
+    ) AS ranked
+WHERE
+    row_rank = 1
 """)
 
-time_table_insert = ("""
-INSERT INTO time (
-    start_time,
-    hour,
-    day,
-    week,
-    month,
-    year,
-    weekday
-) SELECT  
+user_table_insert = upsert_query("users", "user_id", user_columns, user_delta_select.format(""))
+
+song_table_insert = upsert_query("songs", "song_id", song_columns, song_delta_select)
+
+artist_table_insert = upsert_query("artists", "artist_id", artist_columns, artist_delta_select)
+
+# The time dimension is derived from the distinct timestamps of the NextSong events in staging_events, 
+# the same ones songplays.start_time is computed from. It does not read songplays, so it can be built 
+# in parallel with the fact table, and it keeps one row per timestamp
+
+time_columns = ["start_time", "hour", "day", "week", "month", "year", "weekday"]
+
+time_delta_select = ("""
+SELECT  
     start_time, 
-    EXTRACT(hour FROM start_time),
-    EXTRACT(day FROM start_time),
-    EXTRACT(week FROM start_time),
-    EXTRACT(month FROM start_time),
-    EXTRACT(year FROM start_time),
-    EXTRACT(dayofweek FROM start_time)
-FROM songplays
+    EXTRACT(hour FROM start_time) AS hour,
+    EXTRACT(day FROM start_time) AS day,
+    EXTRACT(week FROM start_time) AS week,
+    EXTRACT(month FROM start_time) AS month,
+    EXTRACT(year FROM start_time) AS year,
+    EXTRACT(dow FROM start_time) AS weekday
+FROM (
+    SELECT DISTINCT
+        TIMESTAMP 'epoch' + ts/1000 * INTERVAL '1 second' AS start_time
+    FROM
+        staging_events
+    WHERE
+        page = 'NextSong' AND
+        ts IS NOT NULL{}
+    ) AS timestamps
+""")
+
+time_table_insert = upsert_query("time", "start_time", time_columns, time_delta_select.format(""))
+
+# SUMMARY TABLES
+# A summary is refreshed by whole time buckets: the buckets between the first and the last start_time 
+# transformed by the run (epoch-ms, formatted into the placeholders) are deleted and computed again from 
+# songplays, so the distinct counts stay exact and a refresh can be repeated
+
+summary_table_creates = [create_table(spec.table) for spec in summary_tables]
+summary_table_drops = [drop_table(spec.table) for spec in summary_tables]
+
+# First and last ts of the events transformed by the run
+staging_events_ts_range = ("""
+SELECT MIN(ts), MAX(ts) FROM staging_events WHERE page = 'NextSong'
+""")
+
+
+def summary_refresh(spec):
+    """
+    This method builds the refresh of a summary table for the time buckets between two epoch-ms timestamps.
+    The query is a template formatted with the first ({0}) and the last ({1}) epoch-ms of the range.
+    
+    Args:
+        spec (schema.summary_spec): summary specification
+    
+    Returns:
+        query (str)
+    """
+    
+    bucket = "DATE_TRUNC('{}', TIMESTAMP 'epoch' + {{}}/1000 * INTERVAL '1 second')".format(spec.grain)
+    first_bucket, last_bucket = bucket.format("{0}"), bucket.format("{1}")
+    
+    columns = [spec.grain] + [column for column, _, _ in spec.dimensions] + [column for column, _, _, _ in spec.measures]
+    expressions = ["DATE_TRUNC('{}', songplays.start_time)".format(spec.grain)] +\
+        [expression for _, _, expression in spec.dimensions] + [expression for _, _, expression, _ in spec.measures]
+    
+    return """
+DELETE FROM {table} WHERE {grain} BETWEEN {first_bucket} AND {last_bucket};
+INSERT INTO {table} ({columns}) 
+SELECT 
+    {expressions} 
+FROM songplays {joins}
+WHERE songplays.start_time >= {first_bucket} AND songplays.start_time < {last_bucket} + INTERVAL '1 {grain}' 
+GROUP BY {group_by};
+""".format(table=spec.name, grain=spec.grain, first_bucket=first_bucket, last_bucket=last_bucket,\
+           columns=", ".join(columns), expressions=",\n    ".join(expressions), joins=spec.joins,\
+           group_by=", ".join(str(i + 1) for i in range(1 + len(spec.dimensions))))
+
+
+summary_refresh_queries = [summary_refresh(spec) for spec in summary_tables]
+
+# BLUE/GREEN PUBLISHING
+# With etl.py --publish swap the tables read by the analysts are rebuilt into shadow tables, which are 
+# renamed into place in a single transaction (see publish.py). The live tables are renamed with the 
+# retired suffix and dropped once the swap is committed
+
+published_tables = [songplay_table, user_table, song_table, artist_table, time_table]
+
+shadow_suffix = "_shadow"
+retired_suffix = "_retired"
+
+shadow_tables = [renamed_spec(spec, shadow_suffix, [table.name for table in published_tables]) for spec in published_tables]
+retired_tables = [renamed_spec(spec, retired_suffix, [table.name for table in published_tables]) for spec in published_tables]
+
+# The shadow tables are empty, so the dimensions are filled with their delta SELECT instead of the upsert
+shadow_insert = ("""
+INSERT INTO {0} ({1}) 
+{2};
+""")
+
+shadow_insert_queries = {
+    "songplays": songplay_table_insert.replace("INSERT INTO songplays (", "INSERT INTO songplays{} (".format(shadow_suffix), 1),
+    "users": shadow_insert.format("users" + shadow_suffix, ", ".join(user_columns), user_delta_select.format("").strip()),
+    "songs": shadow_insert.format("songs" + shadow_suffix, ", ".join(song_columns), song_delta_select.strip()),
+    "artists": shadow_insert.format("artists" + shadow_suffix, ", ".join(artist_columns), artist_delta_select.strip()),
+    "time": shadow_insert.format("time" + shadow_suffix, ", ".join(time_columns), time_delta_select.format("").strip()),
+}
+
+table_rename = ("""
+ALTER TABLE {} RENAME TO {};
+""")
+
+# INCREMENTAL FINAL TABLES
+# These templates are formatted at run time with the high-water mark (epoch-ms) read from etl_watermark
+# so only the events that were not transformed in previous runs are processed.
+# staging_songs keeps the whole song catalog (the songplays join needs it) and the songs and 
+# artists upserts are idempotent, so they are shared with the full load
+
+songplay_table_incremental_insert = songplay_table_select.format(" AND\n        ts > {}")
+
+user_table_incremental_insert = upsert_query("users", "user_id", user_columns, 
+                                             user_delta_select.format(" AND\n        ts > {}"))
+
+time_table_incremental_insert = upsert_query("time", "start_time", time_columns, 
+                                             time_delta_select.format(" AND\n        ts > {}"))
+
+# DATE-RANGE FINAL TABLES
+# These templates are formatted at run time with the epoch-ms bounds of the days loaded with --from/--to, 
+# so only the events of those days are transformed. The songplays of the range are deleted first, 
+# so a range can be transformed again without duplicating the facts
+
+range_event_filter = " AND\n        ts >= {0} AND\n        ts < {1}"
+
+songplay_range_delete = ("""
+DELETE FROM songplays 
+WHERE 
+    start_time >= TIMESTAMP 'epoch' + {0}/1000 * INTERVAL '1 second' AND 
+    start_time < TIMESTAMP 'epoch' + {1}/1000 * INTERVAL '1 second';
+""")
+
+songplay_table_range_insert = songplay_range_delete + songplay_table_select.format(range_event_filter)
+
+user_table_range_insert = upsert_query("users", "user_id", user_columns, user_delta_select.format(range_event_filter))
+
+time_table_range_insert = upsert_query("time", "start_time", time_columns, time_delta_select.format(range_event_filter))
+
+# BULK LOAD OF PRECOMPUTED TABLES
+# Loads the gzip'd CSV files written by local_etl.py, rendered by query_catalog.table_csv_copy
+
+table_csv_copy = ("""
+COPY {} ({}) 
+FROM '{}' 
+iam_role '{}' 
+CSV 
+IGNOREHEADER 1 
+NULL AS '\\\\N' 
+GZIP 
+TIMEFORMAT 'auto';
+""")
+
+# CSV load from the client used by benchmark.py against a local PostgreSQL stand-in of the cluster,
+# formatted with the table and its columns
+
+stdin_csv_copy = ("""
+COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')
+""")
+
+# EXPORT
+# Used by export.py, formatted with the columns and the table exported
+
+table_select = ("""
+SELECT {} FROM {}
+""")
+
+# Formatted with the query (quotes doubled), the S3 prefix and the role ARN. Every slice writes its own files
+unload_parquet = ("""
+UNLOAD ('{}') 
+TO '{}' 
+iam_role '{}' 
+FORMAT AS PARQUET 
+PARALLEL ON 
+ALLOWOVERWRITE;
 """)
 
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create]
+create_table_queries = [staging_events_table_create, staging_songs_table_create, song_lookup_table_create, user_table_create, song_table_create, artist_table_create, time_table_create, songplay_table_create, etl_watermark_table_create, etl_loaded_keys_table_create, etl_partitions_table_create, etl_load_errors_table_create, etl_run_ledger_table_create] + summary_table_creates
+
+# The shadow and retired tables left by a failed blue/green publishing are dropped with the rest
+publish_table_drops = [drop_table(spec) for spec in shadow_tables + retired_tables]
+
+drop_table_queries = publish_table_drops + [staging_events_table_drop, staging_songs_table_drop, song_lookup_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop, etl_watermark_table_drop, etl_loaded_keys_table_drop, etl_partitions_table_drop, etl_load_errors_table_drop, etl_run_ledger_table_drop] + summary_table_drops
+
+insert_table_queries = [song_lookup_build, songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
+incremental_insert_table_queries = [song_lookup_build, songplay_table_incremental_insert, user_table_incremental_insert, song_table_insert, artist_table_insert, time_table_incremental_insert]
+range_insert_table_queries = [song_lookup_build, songplay_table_range_insert, user_table_range_insert, song_table_insert, artist_table_insert, time_table_range_insert]
 
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
 
-copy_table_queries = [staging_songs_copy, staging_events_copy]
-insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
+class query_catalog:
+    """
+    This class renders the statements that depend on the DWH setup. 
+    Nothing is rendered when the object is created, the templates are formatted when a statement is requested.
+    
+    The staging COPYs update the statistics of their table (STATUPDATE ON), so the transforms that read 
+    the staging tables are planned with fresh statistics. With max_errors the staging COPYs skip up to that 
+    many bad lines (MAXERROR) and the rejected lines are recorded in etl_load_errors under run_id in the 
+    same transaction (see repair.py).
+    
+    Attributes:
+        config: object that contains metadata information about the DWH setup (.cfg file)
+        role_arn: ARN role that allows Redshift to read from S3
+        max_errors: number of rejected lines after which a staging COPY fails (optional)
+        run_id: identifier of the run the rejected lines are recorded with
+    """
+    
+    def __init__(self, config, role_arn, max_errors=None, run_id=None):
+        self.config     = config
+        self.role_arn   = role_arn
+        self.max_errors = max_errors
+        self.run_id     = run_id
+    
+    def _resilient(self, copy, source, attempt=1, options=()):
+        options = list(options) + ["statupdate on"]
+        if self.max_errors is None:
+            return copy_options(copy, options)
+        return copy_options(copy, options + ["maxerror {}".format(self.max_errors)]) +\
+            load_errors_capture.format(self.run_id, attempt, source)
+    
+    @property
+    def staging_events_copy(self):
+        return self._resilient(staging_events_copy.format(self.config.log_data, self.role_arn, self.config.log_jsonpath),\
+                               "staging_events")
+    
+    @property
+    def staging_songs_copy(self):
+        return self._resilient(staging_songs_copy.format(self.config.song_data, self.role_arn), "staging_songs")
+    
+    @property
+    def copy_table_queries(self):
+        return [self.staging_songs_copy, self.staging_events_copy]
+    
+    def staging_events_prefix_copy(self, uri):
+        return self._resilient(staging_events_copy.format(uri, self.role_arn, self.config.log_jsonpath), "staging_events")
+    
+    def staging_events_manifest_copy(self, manifest_uri, data_format=None):
+        return self._resilient(staging_events_manifest_copy.format(manifest_uri, self.role_arn,\
+                                                                   copy_format_clause(data_format, self.config.log_jsonpath)),\
+                               "staging_events")
+    
+    def staging_songs_manifest_copy(self, manifest_uri, data_format=None):
+        return self._resilient(staging_songs_manifest_copy.format(manifest_uri, self.role_arn,\
+                                                                  copy_format_clause(data_format, "auto")),\
+                               "staging_songs")
+    
+    def staging_repair_copy(self, source, manifest_uri):
+        """
+        This method renders the COPY of the records normalized by repair.py, listed in a manifest.
+        Values longer than their column are truncated and invalid UTF-8 characters are replaced.
+        The lines rejected again are recorded with attempt 2.
+        
+        Args:
+            source (str): staging table name, staging_events or staging_songs
+            manifest_uri (str): S3 URI of the manifest of the normalized records
+        
+        Returns:
+            copy (str)
+        """
+        
+        copy = {
+            "staging_events": staging_events_manifest_copy.format(manifest_uri, self.role_arn,\
+                                                                  copy_format_clause(None, self.config.log_jsonpath)),
+            "staging_songs": staging_songs_manifest_copy.format(manifest_uri, self.role_arn, copy_format_clause(None, "auto")),
+        }[source]
+        
+        return self._resilient(copy, source, 2, ["truncatecolumns", "acceptinvchars"])
+    
+    def table_csv_copy(self, table, columns, uri):
+        return table_csv_copy.format(table, ", ".join(columns), uri, self.role_arn)
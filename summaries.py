@@ -0,0 +1,165 @@
+"""
+This script contains the refresh of the summary tables of songplays and the lookup that answers
+an aggregate query from a summary table instead of the fact table.
+
+The summary tables are declared in schema.py (summary_tables): a time grain of start_time, the columns
+the plays are grouped by and the measures. At the end of every run etl.py recomputes the time buckets
+of the events it transformed, so the summaries follow songplays without being rebuilt.
+
+A query that groups the plays by some of the columns of a summary can be read from it:
+
+    - as they are stored, when the grain and the columns grouped by are the ones of the summary
+    - combined with the rollup of the measures (SUM of the counts) for a coarser grain, like the weeks
+      of a daily summary, or for fewer columns. The distinct counts cannot be combined
+
+    $ python summaries.py --group-by artist_id,artist_name --measures plays --grain week
+    $ python summaries.py --group-by level --measures plays --grain day
+"""
+
+import argparse
+import time
+
+from schema import summary_tables
+from sql_queries import summary_refresh_queries, staging_events_ts_range
+
+# Time grains a summary grain can be combined into: weeks and months do not contain each other
+ROLLUPS = {
+    "hour": ["hour", "day", "week", "month", "year"],
+    "day": ["day", "week", "month", "year"],
+    "week": ["week"],
+    "month": ["month", "year"],
+}
+
+
+def transformed_range(cur):
+    """
+    This method reads the first and the last ts of the NextSong events of the staging area, the events
+    transformed by a full or an incremental run.
+
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+
+    Returns:
+        start_ms (int): None when there are no events
+        end_ms (int): None when there are no events
+    """
+
+    cur.execute(staging_events_ts_range)
+
+    return cur.fetchone()
+
+
+def refresh_summaries(cur, conn, start_ms, end_ms):
+    """
+    This method is used to recompute the time buckets of the summary tables between two epoch-ms timestamps.
+    All the summaries are refreshed in a single transaction.
+
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        conn (psycopg2.extensions.connection): psycopg2 connection object
+        start_ms (int): first epoch-ms of the range, nothing is refreshed when it is None
+        end_ms (int): last epoch-ms of the range, included
+    """
+
+    if start_ms is None:
+        print("\nNo events transformed, the summary tables are not refreshed")
+        return
+
+    print("\nRefreshing the summary tables {} for the events from ts={} to ts={}".format(\
+        ", ".join(spec.name for spec in summary_tables), start_ms, end_ms))
+
+    start = time.time()
+    try:
+        for query in summary_refresh_queries:
+            cur.execute(query.format(start_ms, end_ms))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+    print("Summary tables refreshed in {:.2f}s".format(time.time() - start))
+
+
+def find_summary(group_by, measures, grain=None, summaries=summary_tables):
+    """
+    This method finds the summary table that covers an aggregate query of songplays. A summary that matches
+    the grain and the columns grouped by is preferred to one whose rows have to be combined.
+
+    Args:
+        group_by (list): columns the plays are grouped by
+        measures (list): measures requested, like plays or active_users
+        grain (str): time grain of start_time (hour, day, week, month or year), None for the whole history
+        summaries (list): schema.summary_spec objects to choose from
+
+    Returns:
+        spec (schema.summary_spec): None when no summary covers the query
+        rollup (bool): whether the rows of the summary have to be combined
+    """
+
+    combined = None
+    for spec in summaries:
+        dimensions = [column for column, _, _ in spec.dimensions]
+        rollups = {column: rollup for column, _, _, rollup in spec.measures}
+        if not set(group_by) <= set(dimensions) or not set(measures) <= set(rollups):
+            continue
+        if grain is not None and grain not in ROLLUPS.get(spec.grain, [spec.grain]):
+            continue
+
+        if grain == spec.grain and set(group_by) == set(dimensions):
+            return spec, False
+        if combined is None and all(rollups[measure] is not None for measure in measures):
+            combined = spec
+
+    return combined, combined is not None
+
+
+def summary_query(group_by, measures, grain=None, summaries=summary_tables):
+    """
+    This method renders an aggregate query of songplays against the summary table that covers it.
+
+    Args:
+        group_by (list): columns the plays are grouped by
+        measures (list): measures requested, like plays or active_users
+        grain (str): time grain of start_time (hour, day, week, month or year), None for the whole history
+        summaries (list): schema.summary_spec objects to choose from
+
+    Returns:
+        query (str): None when no summary covers the query, the fact table has to be queried then
+    """
+
+    spec, rollup = find_summary(group_by, measures, grain, summaries)
+    if spec is None:
+        return None
+
+    if not rollup:
+        columns = [spec.grain] + list(group_by) + list(measures)
+        return "SELECT {} FROM {}".format(", ".join(columns), spec.name)
+
+    rollups = {column: rollup for column, _, _, rollup in spec.measures}
+    keys = ([] if grain is None else ["DATE_TRUNC('{}', {}) AS {}".format(grain, spec.grain, grain)]) + list(group_by)
+    columns = keys + ["{}({}) AS {}".format(rollups[measure], measure, measure) for measure in measures]
+    query = "SELECT {} FROM {}".format(", ".join(columns), spec.name)
+    if keys:
+        query += " GROUP BY {}".format(", ".join(str(i + 1) for i in range(len(keys))))
+
+    return query
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the query of the summary table that covers an aggregate of songplays")
+    parser.add_argument("--group-by", default="", help="comma-separated columns the plays are grouped by")
+    parser.add_argument("--measures", required=True, help="comma-separated measures, like plays or active_users")
+    parser.add_argument("--grain", choices=["hour", "day", "week", "month", "year"], default=None,
+                        help="time grain of start_time, the whole history by default")
+    args = parser.parse_args()
+
+    group_by = [column for column in args.group_by.split(",") if column]
+    query = summary_query(group_by, args.measures.split(","), args.grain)
+    if query is None:
+        print("No summary table covers this query, songplays has to be queried")
+    else:
+        print(query)
+
+
+if __name__ == "__main__":
+    main()
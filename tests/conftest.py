@@ -0,0 +1,66 @@
+import configparser
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The modules of the project live at the root of the repository
+sys.path.insert(0, ROOT)
+
+from lib import aws_config
+from schema import create_table, drop_table
+from schema import staging_events_table, staging_songs_table, song_lookup_table
+from schema import songplay_table, user_table, song_table, artist_table, time_table
+from schema import etl_watermark_table, etl_loaded_keys_table, etl_run_ledger_table
+
+# Tables created in the PostgreSQL stand-in of the cluster, dropped and created again by every test that uses it
+POSTGRES_TABLES = [staging_events_table, staging_songs_table, song_lookup_table, songplay_table, user_table,\
+                   song_table, artist_table, time_table, etl_watermark_table, etl_loaded_keys_table,\
+                   etl_run_ledger_table]
+
+
+@pytest.fixture
+def postgres():
+    """
+    Connection to the local PostgreSQL database used by benchmark.py (BENCHMARK_DSN) with empty tables.
+    The tests that use it are skipped when the database is not reachable.
+    """
+
+    psycopg2 = pytest.importorskip("psycopg2")
+    try:
+        conn = psycopg2.connect(os.environ.get("BENCHMARK_DSN", "dbname=sparkify_bench"))
+    except psycopg2.OperationalError as e:
+        pytest.skip("PostgreSQL stand-in not available: {}".format(e))
+
+    cur = conn.cursor()
+    # GETDATE() of Redshift, used by the bookkeeping statements
+    cur.execute("CREATE OR REPLACE FUNCTION getdate() RETURNS TIMESTAMP AS 'SELECT LOCALTIMESTAMP' LANGUAGE SQL")
+    for spec in POSTGRES_TABLES:
+        cur.execute(drop_table(spec))
+        cur.execute(create_table(spec, dialect="postgres"))
+    conn.commit()
+
+    yield conn
+
+    conn.rollback()
+    conn.close()
+
+
+@pytest.fixture
+def config(tmp_path):
+    """
+    lib.aws_config of the dwh.cfg of the repository, with test credentials and database settings.
+    """
+
+    parser = configparser.ConfigParser()
+    parser.optionxform = str
+    parser.read(os.path.join(ROOT, "dwh.cfg"))
+    parser["AWS_SECURITY"].update(KEY="testing", SECRET="testing")
+    parser["CLUSTER_PROPERTIES"].update(DB_USER="dwhuser", DB_PASSWORD="Passw0rd", DB_PORT="5439")
+    config_path = tmp_path / "dwh.cfg"
+    with open(config_path, "w") as f:
+        parser.write(f)
+
+    return aws_config(str(config_path))
@@ -0,0 +1,108 @@
+"""
+Table-driven tests of the capacity decisions of capacity.py, and of the pending input they are based on.
+"""
+
+from datetime import date
+from types import SimpleNamespace
+
+import pytest
+
+from capacity import elastic_resize_range, pending_input_bytes, plan_capacity, plan_release
+from ingest import local_s3
+
+GB = 2**30
+
+
+def capacity_config(min_nodes=2, max_nodes=8, gb_per_node=1, idle_action="none", dwh_num_nodes="4"):
+    return SimpleNamespace(capacity_min_nodes=min_nodes, capacity_max_nodes=max_nodes,\
+                           capacity_bytes_per_node=gb_per_node * GB, capacity_idle_action=idle_action,\
+                           dwh_num_nodes=dwh_num_nodes)
+
+
+def cluster(status, nodes):
+    return {"ClusterStatus": status, "NumberOfNodes": nodes}
+
+
+@pytest.mark.parametrize("nodes, expected", [(1, (1, 2)), (2, (1, 4)), (3, (2, 6)), (4, (2, 8)), (16, (8, 32))])
+def test_elastic_resize_range(nodes, expected):
+    assert elastic_resize_range(nodes) == expected
+
+
+@pytest.mark.parametrize("status, nodes, pending_gb, config, actions", [
+    # available, the input fits in the current nodes
+    ("available", 4, 0, capacity_config(), []),
+    ("available", 4, 3.5, capacity_config(), []),
+    # never scaled down before a run
+    ("available", 8, 1, capacity_config(), []),
+    # one node per GB_PER_NODE of input
+    ("available", 4, 6, capacity_config(), [("resize", 6)]),
+    ("available", 4, 6, capacity_config(gb_per_node=2), []),
+    # capped by MAX_NODES
+    ("available", 4, 100, capacity_config(max_nodes=6), [("resize", 6)]),
+    # capped by the elastic resize range: at most twice the current nodes
+    ("available", 2, 100, capacity_config(max_nodes=16), [("resize", 4)]),
+    # raised to MIN_NODES
+    ("available", 1, 0, capacity_config(min_nodes=2), [("resize", 2)]),
+    ("available", 2, 0, capacity_config(min_nodes=6), [("resize", 4)]),
+    # paused and pausing clusters are resumed, once paused, before the resize
+    ("paused", 4, 0, capacity_config(), [("resume", None)]),
+    ("paused", 4, 6, capacity_config(), [("resume", None), ("resize", 6)]),
+    ("pausing", 4, 0, capacity_config(), [("wait_paused", None), ("resume", None)]),
+    ("pausing", 2, 100, capacity_config(), [("wait_paused", None), ("resume", None), ("resize", 4)]),
+    # other statuses are left to wait_for_cluster
+    ("resizing", 4, 0, capacity_config(), []),
+])
+def test_plan_capacity(status, nodes, pending_gb, config, actions):
+    assert plan_capacity(cluster(status, nodes), pending_gb * GB, config) == actions
+
+
+@pytest.mark.parametrize("status, nodes, idle_action, dwh_num_nodes, actions", [
+    # none leaves the cluster as it is
+    ("available", 8, "none", "4", []),
+    ("available", 4, "none", "4", []),
+    # resize scales back to DWH_NUM_NODES
+    ("available", 4, "resize", "4", []),
+    ("available", 8, "resize", "4", [("resize", 4)]),
+    ("available", 6, "resize", "4", [("resize", 4)]),
+    # capped by the elastic resize range: at most half of the current nodes
+    ("available", 16, "resize", "4", [("resize", 8)]),
+    # a cluster scaled down by hand is resized back up
+    ("available", 2, "resize", "4", [("resize", 4)]),
+    # pause resizes first, so the cluster resumes with its usual size
+    ("available", 4, "pause", "4", [("pause", None)]),
+    ("available", 8, "pause", "4", [("resize", 4), ("pause", None)]),
+    ("available", 16, "pause", "4", [("resize", 8), ("pause", None)]),
+    # nothing to do on a paused or pausing cluster
+    ("paused", 8, "pause", "4", []),
+    ("pausing", 8, "pause", "4", []),
+    ("paused", 8, "resize", "4", []),
+])
+def test_plan_release(status, nodes, idle_action, dwh_num_nodes, actions):
+    config = capacity_config(idle_action=idle_action, dwh_num_nodes=dwh_num_nodes)
+
+    assert plan_release(cluster(status, nodes), config) == actions
+
+
+def test_plan_release_unknown_idle_action():
+    with pytest.raises(ValueError, match="Unknown IDLE_ACTION stop"):
+        plan_release(cluster("available", 4), capacity_config(idle_action="stop"))
+
+
+def test_pending_input_bytes(tmp_path):
+    s3 = local_s3(str(tmp_path))
+    config = SimpleNamespace(log_data="s3://sparkify/log_data", song_data="s3://sparkify/song_data")
+    sizes = {
+        "log_data/2018/11/2018-11-01-events.json": 100,
+        "log_data/2018/11/2018-11-02-events.json": 200,
+        "log_data/2018/12/2018-12-01-events.json": 400,
+        "song_data/A/song-1.json": 10,
+        "song_data/A/song-2.json": 20,
+    }
+    for key, size in sizes.items():
+        s3.Object("sparkify", key).put(Body=b"x" * size)
+
+    assert pending_input_bytes(s3, config) == 730
+    assert pending_input_bytes(s3, config, date(2018, 11, 2), date(2018, 11, 30)) == 230
+    # an incremental run only counts the objects not loaded yet
+    loaded = {"s3://sparkify/log_data/2018/11/2018-11-01-events.json", "s3://sparkify/song_data/A/song-1.json"}
+    assert pending_input_bytes(s3, config, loaded_keys=loaded) == 620
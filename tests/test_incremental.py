@@ -0,0 +1,114 @@
+"""
+Tests of the bookkeeping shared by the full and the incremental loads of etl.py, against the PostgreSQL stand-in.
+The COPYs from S3 are replaced by a bulk load of the objects of a local_s3 folder.
+"""
+
+import io
+import json
+import os
+from types import SimpleNamespace
+
+import etl
+from benchmark import copy_records
+from convert import stream_json_records
+from ingest import local_s3, read_s3_object
+from schema import staging_events_table, staging_songs_table
+from sql_queries import staging_events_table_truncate
+from validate import event_casters, load_jsonpaths, validate_records
+
+DATA_SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data_sample")
+
+CONFIG = SimpleNamespace(log_data="s3://sparkify/log_data", song_data="s3://sparkify/song_data")
+
+
+def put_records(s3, uri, records):
+    bucket, key = uri[len("s3://"):].split("/", 1)
+    s3.Object(bucket, key).put(Body="".join(json.dumps(record) + "\n" for record in records).encode("utf-8"))
+
+
+def copy_objects(cur, conn, s3, source, uris):
+    records = [record for uri in uris for record in stream_json_records(io.BytesIO(read_s3_object(s3, uri)))]
+    if source == "staging_events":
+        records = [event for event, errors in validate_records(records, event_casters(load_jsonpaths())) if not errors]
+    copy_records(cur, {"staging_events": staging_events_table, "staging_songs": staging_songs_table}[source], records)
+    conn.commit()
+
+
+def songplays_count(cur):
+    cur.execute("SELECT COUNT(*) FROM songplays")
+    return cur.fetchone()[0]
+
+
+def sample_input(tmp_path):
+    """
+    The sample event logs and one song file per NextSong event of the sample, so every play has its song.
+    """
+
+    s3 = local_s3(str(tmp_path))
+    with open(os.path.join(DATA_SAMPLE, "log-events.json")) as f:
+        events = [json.loads(line) for line in f]
+    put_records(s3, CONFIG.log_data + "/2018/11/2018-11-01-events.json", events)
+
+    plays = [event for event in events if event["page"] == "NextSong"]
+    for i, event in enumerate(plays):
+        put_records(s3, CONFIG.song_data + "/A/song-{:03d}.json".format(i),\
+                    [{"artist_id": "AR{:016d}".format(i), "artist_latitude": None, "artist_location": "",\
+                      "artist_longitude": None, "artist_name": event["artist"], "duration": event["length"],\
+                      "num_songs": 1, "song_id": "SO{:016d}".format(i), "title": event["song"], "year": 2018}])
+
+    return s3, events, plays
+
+
+def test_incremental_after_full_load_does_not_duplicate_songplays(tmp_path, postgres):
+    s3, events, plays = sample_input(tmp_path)
+    cur = postgres.cursor()
+
+    # full load
+    loaded_keys = etl.full_load_keys(s3, CONFIG)
+    for source, uris in loaded_keys.items():
+        copy_objects(cur, postgres, s3, source, uris)
+    etl.insert_tables(cur, postgres, CONFIG, loaded_keys=loaded_keys)
+    full_count = songplays_count(cur)
+    assert full_count == len(plays)
+
+    # incremental load without new objects
+    cur.execute(staging_events_table_truncate)
+    new_keys = {source: [uri for uri, _ in etl.new_s3_objects(cur, s3, source, uri)]\
+                for source, uri in [("staging_songs", CONFIG.song_data), ("staging_events", CONFIG.log_data)]}
+    assert new_keys == {"staging_songs": [], "staging_events": []}
+    etl.insert_tables_incremental(cur, postgres, new_keys)
+    assert songplays_count(cur) == full_count
+
+    # incremental load of a new day: only its plays are added
+    new_day = [dict(event, ts=event["ts"] + 86400000) for event in plays[:3]]
+    put_records(s3, CONFIG.log_data + "/2018/11/2018-11-02-events.json", new_day)
+    cur.execute(staging_events_table_truncate)
+    new_objects = etl.new_s3_objects(cur, s3, "staging_events", CONFIG.log_data)
+    assert [uri for uri, _ in new_objects] == [CONFIG.log_data + "/2018/11/2018-11-02-events.json"]
+    copy_objects(cur, postgres, s3, "staging_events", [uri for uri, _ in new_objects])
+    etl.insert_tables_incremental(cur, postgres, {"staging_events": [uri for uri, _ in new_objects]})
+    assert songplays_count(cur) == full_count + len(new_day)
+
+    cur.execute("SELECT max_ts FROM etl_watermark WHERE source = 'staging_events'")
+    assert cur.fetchone()[0] == max(event["ts"] for event in new_day)
+
+
+def test_late_events_are_reported(tmp_path, postgres, capsys):
+    s3, events, plays = sample_input(tmp_path)
+    cur = postgres.cursor()
+
+    loaded_keys = etl.full_load_keys(s3, CONFIG)
+    for source, uris in loaded_keys.items():
+        copy_objects(cur, postgres, s3, source, uris)
+    etl.insert_tables(cur, postgres, CONFIG, loaded_keys=loaded_keys)
+    full_count = songplays_count(cur)
+
+    late_uri = CONFIG.log_data + "/2018/11/2018-11-01-late-events.json"
+    put_records(s3, late_uri, [dict(plays[0], ts=plays[0]["ts"] - 1000)])
+    cur.execute(staging_events_table_truncate)
+    copy_objects(cur, postgres, s3, "staging_events", [late_uri])
+    capsys.readouterr()
+    etl.insert_tables_incremental(cur, postgres, {"staging_events": [late_uri]})
+
+    assert songplays_count(cur) == full_count
+    assert "1 NextSong events of the new objects are not newer than" in capsys.readouterr().out
@@ -0,0 +1,116 @@
+"""
+Tests of the pre-ingest stage of ingest.py against a local_s3 folder: the batch plan, the manifests
+written by copy_in_batches and the compaction of small objects.
+"""
+
+import gzip
+import json
+import random
+from collections import Counter
+from types import SimpleNamespace
+
+import pytest
+
+from ingest import cluster_slices, compact_objects, copy_in_batches, local_s3, plan_batches, read_s3_object
+from lib import list_s3_objects
+
+
+class fake_cursor:
+    """
+    DB-API cursor and connection that log the statements they run and the commits.
+    """
+
+    def __init__(self):
+        self.statements = []
+        self.commits    = 0
+
+    def execute(self, query):
+        self.statements.append(query)
+
+    def commit(self):
+        self.commits += 1
+
+
+def random_objects(n, seed, min_size=100, max_size=10000):
+    rng = random.Random(seed)
+    return [("s3://sparkify/song_data/song-{:05d}.json".format(i), rng.randint(min_size, max_size)) for i in range(n)]
+
+
+@pytest.mark.parametrize("n_objects, slices, batch_bytes", [
+    (1, 4, 10000),
+    (7, 4, 10000),
+    (100, 4, 50000),
+    (1000, 16, 200000),
+    (1000, 2, 10 ** 9),
+    (333, 6, 1),
+])
+def test_plan_batches_are_multiples_of_slices(n_objects, slices, batch_bytes):
+    objects = random_objects(n_objects, seed=n_objects)
+    batches = plan_batches(objects, slices, batch_bytes)
+
+    assert sorted(obj for batch in batches for obj in batch) == sorted(objects)
+    # every batch but the last one holds the same multiple of the slices, the last one the remaining files
+    sizes = [len(batch) for batch in batches]
+    assert all(size == sizes[0] and size % slices == 0 for size in sizes[:-1])
+    assert 0 < sizes[-1] <= sizes[0]
+
+
+def test_plan_batches_slices_of_the_config():
+    slices = cluster_slices(SimpleNamespace(dwh_node_type="ra3.4xlarge", dwh_num_nodes="3"))
+    batches = plan_batches(random_objects(500, seed=1), slices, 100000)
+
+    assert slices == 12
+    assert all(len(batch) % slices == 0 for batch in batches[:-1])
+
+
+def test_plan_batches_balances_sizes():
+    batches = plan_batches(random_objects(960, seed=2), 8, 500000)
+    sizes = [sum(size for _, size in batch) for batch in batches[:-1]]
+
+    assert max(sizes) - min(sizes) <= 10000
+    assert plan_batches([], 8) == []
+
+
+def test_manifests_cover_every_object_once(tmp_path):
+    s3 = local_s3(str(tmp_path))
+    for i in range(50):
+        s3.Object("sparkify", "song_data/A/song-{:03d}.json".format(i)).put(Body=b"{}" + b" " * i)
+    objects = list_s3_objects(s3, "s3://sparkify/song_data")
+    cur = fake_cursor()
+
+    manifests = copy_in_batches(cur, cur, s3, objects, "s3://sparkify/manifests/songs",\
+                                lambda manifest: "COPY staging_songs FROM '{}' MANIFEST".format(manifest), 4, 400)
+
+    assert len(manifests) > 1
+    assert cur.statements == ["COPY staging_songs FROM '{}' MANIFEST".format(manifest) for manifest in manifests]
+    assert cur.commits == len(manifests)
+
+    entries = [entry for manifest in manifests for entry in json.loads(read_s3_object(s3, manifest))["entries"]]
+    assert Counter(entry["url"] for entry in entries) == Counter(uri for uri, _ in objects)
+    assert sorted((entry["url"], entry["meta"]["content_length"]) for entry in entries) == objects
+    assert all(entry["mandatory"] for entry in entries)
+
+
+def test_compaction_keeps_every_record(tmp_path):
+    s3 = local_s3(str(tmp_path))
+    records = []
+    for i in range(120):
+        song = {"song_id": "SO{:016d}".format(i), "title": "Song {}".format(i), "duration": i * 1.5, "year": 2018}
+        if i % 10 == 0:
+            # a JSON-lines file of three songs next to the single JSON documents
+            songs = [dict(song, song_id=song["song_id"] + str(j)) for j in range(3)]
+            body = "".join(json.dumps(s) + "\n" for s in songs)
+        else:
+            songs = [song]
+            body = json.dumps(song)
+        s3.Object("sparkify", "song_data/A/song-{:03d}.json".format(i)).put(Body=body.encode("utf-8"))
+        records.extend(songs)
+    objects = list_s3_objects(s3, "s3://sparkify/song_data")
+
+    compacted = compact_objects(s3, objects, "s3://sparkify/compacted/songs", compacted_bytes=2000, max_workers=3)
+
+    assert len(compacted) > 1
+    assert compacted == list_s3_objects(s3, "s3://sparkify/compacted/songs")
+    read_back = [json.loads(line) for uri, _ in compacted\
+                 for line in gzip.decompress(read_s3_object(s3, uri)).decode("utf-8").splitlines()]
+    assert read_back == records
@@ -0,0 +1,68 @@
+"""
+Tests of the statement splitting and labelling of instrument.py, and of the instrumented cursor against
+the PostgreSQL stand-in, which does not have pg_last_query_id.
+"""
+
+import pytest
+
+from instrument import instrumented_cursor, recorder, split_statements, sql_tokens, statement_label
+from sql_queries import song_lookup_build, user_table_insert
+
+
+class list_exporter:
+    def __init__(self):
+        self.records = []
+
+    def export(self, record):
+        self.records.append(record)
+
+    def close(self):
+        pass
+
+
+@pytest.mark.parametrize("query, statements", [
+    ("SELECT 1", ["SELECT 1"]),
+    ("DELETE FROM t; INSERT INTO t VALUES (1);", ["DELETE FROM t", " INSERT INTO t VALUES (1)"]),
+    ("INSERT INTO t VALUES ('a;b', 'it''s; ok')", ["INSERT INTO t VALUES ('a;b', 'it''s; ok')"]),
+    ('SELECT "odd;name" FROM t; SELECT 2', ['SELECT "odd;name" FROM t', " SELECT 2"]),
+    ("-- the users; don't\nDELETE FROM users; INSERT INTO users SELECT 1",\
+     [" \nDELETE FROM users", " INSERT INTO users SELECT 1"]),
+    ("/* a quote ' and a ; */ DELETE FROM t; /* trailing */", ["  DELETE FROM t"]),
+    ("SELECT '--not a comment;' FROM t", ["SELECT '--not a comment;' FROM t"]),
+    ("SELECT 10 - 2 / 1; SELECT 3", ["SELECT 10 - 2 / 1", " SELECT 3"]),
+])
+def test_split_statements(query, statements):
+    assert split_statements(query) == statements
+
+
+@pytest.mark.parametrize("query", ["SELECT 'open; DELETE FROM t", "SELECT 1; /* open", 'SELECT "open; x'])
+def test_split_statements_unterminated(query):
+    with pytest.raises(ValueError):
+        sql_tokens(query)
+    assert split_statements(query) == [query]
+
+
+def test_split_statements_of_the_queries():
+    assert [statement.split()[0] for statement in split_statements(song_lookup_build)] == ["DELETE", "INSERT"]
+    assert statement_label(song_lookup_build) == "UPSERT song_lookup"
+    assert statement_label("-- the delta\n" + user_table_insert) == "UPSERT users"
+    assert statement_label("/* INSERT INTO x; */ TRUNCATE staging_events") == "TRUNCATE staging_events"
+
+
+def test_query_ids_do_not_abort_the_transaction(postgres, capsys):
+    exporter = list_exporter()
+    cur = instrumented_cursor(postgres.cursor(), recorder("test", [exporter]))
+
+    cur.execute("INSERT INTO etl_watermark (source, max_ts, updated_at) VALUES ('staging_events', 1, GETDATE())")
+    cur.execute("DELETE FROM staging_events; INSERT INTO staging_events (ts, page) VALUES (2, 'NextSong')")
+    postgres.commit()
+    assert capsys.readouterr().out.count("Query ids not available") == 1
+
+    cur.execute("SELECT COUNT(*) FROM staging_events")
+    assert cur.fetchone()[0] == 1
+    cur.execute("SELECT max_ts FROM etl_watermark")
+    assert cur.fetchone()[0] == 1
+    assert [record["status"] for record in exporter.records] == ["ok"] * 4
+    assert all(record["query_id"] is None for record in exporter.records)
+    assert exporter.records[1]["label"] == "UPSERT staging_events"
+    assert exporter.records[1]["rowcount"] == 1
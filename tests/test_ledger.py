@@ -0,0 +1,109 @@
+"""
+Tests of the run ledger of ledger.py against the PostgreSQL stand-in: the fingerprint of the input,
+the resume of a failed run and the load stage run again after a partial load.
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from etl import load_staging_tables
+from ingest import local_s3
+from ledger import input_fingerprint, run_ledger
+
+CONFIG = SimpleNamespace(log_data="s3://sparkify/log_data", song_data="s3://sparkify/song_data",\
+                         log_jsonpath="s3://sparkify/log_json_path.json")
+
+OPTIONS = {"from": None, "to": None, "incremental": False}
+
+# COPYs of the staging tables, replaced by INSERTs on PostgreSQL
+COPIES = SimpleNamespace(copy_table_queries=[
+    "INSERT INTO staging_songs (song_id, title) VALUES ('SO1', 'Scream'), ('SO2', 'Home')",
+    "INSERT INTO staging_events (ts, page) VALUES (1, 'NextSong'), (2, 'NextSong'), (3, 'Home')",
+])
+
+
+def count(cur, table):
+    cur.execute("SELECT COUNT(*) FROM {}".format(table))
+    return cur.fetchone()[0]
+
+
+def test_input_fingerprint(tmp_path):
+    s3 = local_s3(str(tmp_path))
+    s3.Object("sparkify", "log_data/2018-11-01-events.json").put(Body=b"{}")
+    s3.Object("sparkify", "song_data/A/song.json").put(Body=b"{}")
+    fingerprint = input_fingerprint(s3, CONFIG, OPTIONS)
+
+    assert input_fingerprint(s3, CONFIG, OPTIONS) == fingerprint
+    assert input_fingerprint(s3, CONFIG, dict(OPTIONS, incremental=True)) != fingerprint
+
+    s3.Object("sparkify", "song_data/A/song.json").put(Body=b"{ }")
+    assert input_fingerprint(s3, CONFIG, OPTIONS) != fingerprint
+    # without the listing only the options count
+    assert input_fingerprint(s3, CONFIG, OPTIONS, list_input=False) == input_fingerprint(None, CONFIG, OPTIONS, False)
+
+
+def test_failed_run_is_resumed(postgres):
+    cur = postgres.cursor()
+    ledger = run_ledger(cur, postgres, "run-1", "abc")
+    ledger.complete(cur, postgres, "load")
+    ledger.complete(cur, postgres, "song_lookup")
+    ledger.finish(cur, postgres, "failed")
+
+    # same input: the completed stages are skipped
+    resumed = run_ledger(cur, postgres, "run-2", "abc")
+    assert resumed.run_id == "run-1"
+    assert sorted(resumed.completed) == ["load", "song_lookup"]
+    assert resumed.done("load") and not resumed.done("songplays")
+    resumed.finish(cur, postgres)
+
+    # the last run completed: nothing is resumed
+    assert run_ledger(cur, postgres, "run-3", "abc").completed == {}
+
+
+@pytest.mark.parametrize("fingerprint, resume", [("other", True), ("abc", False)])
+def test_run_is_not_resumed(postgres, fingerprint, resume):
+    cur = postgres.cursor()
+    ledger = run_ledger(cur, postgres, "run-1", "abc")
+    ledger.complete(cur, postgres, "load")
+    ledger.finish(cur, postgres, "failed")
+
+    restarted = run_ledger(cur, postgres, "run-2", fingerprint, resume=resume)
+    assert restarted.run_id == "run-2"
+    assert restarted.completed == {}
+
+
+def test_restarted_run_can_be_resumed(postgres):
+    cur = postgres.cursor()
+    run_ledger(cur, postgres, "run-1", "abc").finish(cur, postgres, "failed")
+
+    # a run with --restart records the fingerprint of its input, so the next run resumes it
+    restarted = run_ledger(cur, postgres, "run-2", "abc", resume=False)
+    restarted.complete(cur, postgres, "load")
+    restarted.finish(cur, postgres, "failed")
+
+    resumed = run_ledger(cur, postgres, "run-3", "abc")
+    assert resumed.run_id == "run-2"
+    assert list(resumed.completed) == ["load"]
+
+
+def test_partial_load_is_run_again_from_empty_staging_tables(postgres):
+    cur = postgres.cursor()
+    ledger = run_ledger(cur, postgres, "run-1", "abc")
+    failing = SimpleNamespace(copy_table_queries=[COPIES.copy_table_queries[0], "INSERT INTO missing_table VALUES (1)"])
+    with pytest.raises(Exception):
+        load_staging_tables(cur, postgres, CONFIG, failing)
+    ledger.finish(cur, postgres, "failed")
+    # the first COPY committed before the load failed
+    assert count(cur, "staging_songs") == 2
+
+    resumed = run_ledger(cur, postgres, "run-2", "abc")
+    assert not resumed.done("load")
+    load_staging_tables(cur, postgres, CONFIG, COPIES)
+    resumed.complete(cur, postgres, "load")
+
+    assert count(cur, "staging_songs") == 2
+    assert count(cur, "staging_events") == 3
+    assert resumed.completed == {}
+    cur.execute("SELECT row_count FROM etl_run_ledger WHERE run_id = 'run-1' AND stage = 'load'")
+    assert cur.fetchone()[0] == 5
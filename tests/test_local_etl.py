@@ -0,0 +1,57 @@
+"""
+Tests of the local ETL engine on the sample data of data_sample.
+"""
+
+import csv
+import gzip
+import json
+import os
+import shutil
+
+import local_etl
+
+DATA_SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data_sample")
+
+
+def read_table(output_dir, table):
+    with gzip.open(os.path.join(output_dir, "{}.csv.gz".format(table)), "rt", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def write_records(path, records):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def test_duplicated_song_files_do_not_fan_out_songplays(tmp_path):
+    log_data = str(tmp_path / "log_data")
+    song_data = str(tmp_path / "song_data")
+    os.makedirs(log_data)
+    shutil.copy(os.path.join(DATA_SAMPLE, "log-events.json"), log_data)
+
+    with open(os.path.join(DATA_SAMPLE, "song-data.json")) as f:
+        song = json.loads(f.read())
+    # the same song file listed twice, and a second song_id for the same (title, artist_name, duration)
+    write_records(os.path.join(song_data, "A", "song-data.json"), [song])
+    write_records(os.path.join(song_data, "B", "song-data.json"), [song])
+    write_records(os.path.join(song_data, "C", "song-data.json"), [dict(song, song_id=song["song_id"][:-1] + "Z")])
+
+    # two plays of the song on top of the sample events, which do not match any song of the sample
+    with open(os.path.join(DATA_SAMPLE, "log-events.json")) as f:
+        event = next(record for record in map(json.loads, f) if record["page"] == "NextSong")
+    plays = [dict(event, song=song["title"], artist=song["artist_name"], length=song["duration"], ts=event["ts"] + i * 1000)\
+             for i in range(2)]
+    write_records(os.path.join(log_data, "plays.json"), plays)
+
+    output_dir = str(tmp_path / "star")
+    counts = local_etl.run(log_data, song_data, output_dir, processes=2)
+
+    songplays = read_table(output_dir, "songplays")
+    assert counts["songplays"] == len(plays)
+    assert len(songplays) == len(plays)
+    # the lookup keeps the lowest song_id of the duplicated key, like song_lookup_build
+    assert {row["song_id"] for row in songplays} == {song["song_id"]}
+    assert counts["songs"] == 2
+    assert counts["artists"] == 1
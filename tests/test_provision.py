@@ -0,0 +1,182 @@
+"""
+Tests of the provisioning coroutines of provision.py with boto3 clients stubbed by botocore.stub.Stubber.
+The sleeps of the backoff and the clock are replaced so the tests do not wait.
+"""
+
+import asyncio
+from datetime import datetime
+from types import SimpleNamespace
+
+import boto3
+import pytest
+from botocore.stub import ANY, Stubber
+
+import lib
+import provision
+
+ROLE_ARN = "arn:aws:iam::123456789012:role/dwhRole"
+
+
+class fake_clock:
+    """
+    Clock of provision.py that only moves forward when the coroutines sleep.
+    """
+
+    def __init__(self):
+        self.now    = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = fake_clock()
+    monkeypatch.setattr(provision, "time", clock)
+    monkeypatch.setattr(provision, "asyncio", SimpleNamespace(sleep=clock.sleep, to_thread=asyncio.to_thread,\
+                                                              gather=asyncio.gather))
+    monkeypatch.setattr(lib, "_endpoint_cache", {})
+    return clock
+
+
+@pytest.fixture
+def aws_clients(config):
+    """
+    Stubbed IAM, Redshift and EC2 clients and the log of the operations they are called with, in order.
+    """
+
+    calls = []
+    clients = {}
+    for service in ("iam", "redshift", "ec2"):
+        client = boto3.client(service, region_name=config.region_name, aws_access_key_id="testing",\
+                              aws_secret_access_key="testing")
+        client.meta.events.register("before-parameter-build", lambda model, **kwargs: calls.append(model.name))
+        clients[service] = client
+
+    stubbers = {service: Stubber(client) for service, client in clients.items()}
+    for stubber in stubbers.values():
+        stubber.activate()
+    yield SimpleNamespace(calls=calls, stubbers=SimpleNamespace(**stubbers), **clients)
+    for stubber in stubbers.values():
+        stubber.deactivate()
+
+
+def describe(config, status, **cluster):
+    return {"Clusters": [dict(ClusterIdentifier=config.dwh_cluster_identifier, ClusterStatus=status,\
+                              NumberOfNodes=int(config.dwh_num_nodes), **cluster)]}
+
+
+def available(config):
+    return describe(config, "available", Endpoint={"Address": "dwhcluster.example.com", "Port": 5439},\
+                    VpcSecurityGroups=[{"VpcSecurityGroupId": "sg-0123", "Status": "active"}])
+
+
+def test_wait_for_cluster_backs_off_until_available(config, clock, aws_clients):
+    config.poll_initial_delay, config.poll_max_delay = 10, 60
+    for _ in range(5):
+        aws_clients.stubbers.redshift.add_response("describe_clusters", describe(config, "creating"),\
+                                                   {"ClusterIdentifier": config.dwh_cluster_identifier})
+    # available without an endpoint yet
+    aws_clients.stubbers.redshift.add_response("describe_clusters", describe(config, "available"))
+    aws_clients.stubbers.redshift.add_response("describe_clusters", available(config))
+
+    cluster = asyncio.run(provision.wait_for_cluster(aws_clients.redshift, config, "available"))
+
+    assert cluster["Endpoint"]["Address"] == "dwhcluster.example.com"
+    assert clock.sleeps == [10, 20, 40, 60, 60, 60]
+    aws_clients.stubbers.redshift.assert_no_pending_responses()
+
+
+def test_wait_for_cluster_timeout(config, clock, aws_clients):
+    config.poll_initial_delay, config.poll_max_delay, config.provisioning_timeout = 10, 60, 100
+    for _ in range(4):
+        aws_clients.stubbers.redshift.add_response("describe_clusters", describe(config, "creating"))
+
+    with pytest.raises(TimeoutError, match="dwhCluster is still creating after 100s"):
+        asyncio.run(provision.wait_for_cluster(aws_clients.redshift, config, "available"))
+
+    # the fourth check would end after the deadline
+    assert clock.sleeps == [10, 20, 40]
+    aws_clients.stubbers.redshift.assert_no_pending_responses()
+
+
+def test_wait_for_cluster_failed_status(config, clock, aws_clients):
+    aws_clients.stubbers.redshift.add_response("describe_clusters", describe(config, "creating"))
+    aws_clients.stubbers.redshift.add_response("describe_clusters", describe(config, "incompatible-network"))
+
+    with pytest.raises(RuntimeError, match="incompatible-network"):
+        asyncio.run(provision.wait_for_cluster(aws_clients.redshift, config, "available"))
+
+
+def test_wait_for_cluster_deleted(config, clock, aws_clients):
+    aws_clients.stubbers.redshift.add_response("describe_clusters", describe(config, "deleting"))
+    aws_clients.stubbers.redshift.add_client_error("describe_clusters", service_error_code="ClusterNotFound")
+
+    assert asyncio.run(provision.wait_for_cluster(aws_clients.redshift, config, "deleted")) is None
+    assert clock.sleeps == [config.poll_initial_delay]
+
+
+def test_provision_order(config, clock, aws_clients):
+    role = {"Path": "/", "RoleName": config.iam_role_name, "RoleId": "AROA0123456789ABCDEFG", "Arn": ROLE_ARN,\
+            "CreateDate": datetime(2024, 1, 1)}
+    aws_clients.stubbers.iam.add_response("create_role", {"Role": role}, {"Path": "/", "RoleName": config.iam_role_name,\
+                                          "Description": ANY, "AssumeRolePolicyDocument": ANY})
+    aws_clients.stubbers.iam.add_response("attach_role_policy", {"ResponseMetadata": {"HTTPStatusCode": 200}},\
+                                          {"RoleName": config.iam_role_name, "PolicyArn": config.iam_arn})
+    aws_clients.stubbers.iam.add_response("get_role", {"Role": role}, {"RoleName": config.iam_role_name})
+
+    aws_clients.stubbers.redshift.add_response("create_cluster_parameter_group", {},\
+                                               {"ParameterGroupName": config.wlm_parameter_group,\
+                                                "ParameterGroupFamily": "redshift-1.0", "Description": ANY})
+    aws_clients.stubbers.redshift.add_response("modify_cluster_parameter_group", {},\
+                                               {"ParameterGroupName": config.wlm_parameter_group, "Parameters": ANY})
+    aws_clients.stubbers.redshift.add_response("create_cluster", {},\
+                                               {"ClusterType": config.dwh_cluster_type, "NodeType": config.dwh_node_type,\
+                                                "NumberOfNodes": int(config.dwh_num_nodes), "DBName": config.db_name,\
+                                                "ClusterIdentifier": config.dwh_cluster_identifier,\
+                                                "MasterUsername": config.db_user, "MasterUserPassword": config.db_password,\
+                                                "IamRoles": [ROLE_ARN],\
+                                                "ClusterParameterGroupName": config.wlm_parameter_group})
+    aws_clients.stubbers.redshift.add_response("describe_clusters", describe(config, "creating"))
+    aws_clients.stubbers.redshift.add_response("describe_clusters", available(config))
+
+    aws_clients.stubbers.ec2.add_response("authorize_security_group_ingress", {"Return": True},\
+                                          {"GroupId": "sg-0123", "IpPermissions": [{"IpProtocol": "tcp",\
+                                           "FromPort": 5439, "ToPort": 5439, "IpRanges": [{"CidrIp": config.ingress_cidr}]}]})
+
+    endpoint = asyncio.run(provision.provision(aws_clients, config))
+
+    assert endpoint == "dwhcluster.example.com"
+    assert lib._endpoint_cache == {config.dwh_cluster_identifier: endpoint}
+    for stubber in vars(aws_clients.stubbers).values():
+        stubber.assert_no_pending_responses()
+
+    # the role and the parameter group are created at the same time, both before the cluster that uses them,
+    # and the port is opened once the cluster is available
+    calls = aws_clients.calls
+    assert calls.index("CreateRole") < calls.index("AttachRolePolicy") < calls.index("GetRole")
+    assert calls.index("CreateClusterParameterGroup") < calls.index("ModifyClusterParameterGroup")
+    assert calls[-4:] == ["CreateCluster", "DescribeClusters", "DescribeClusters", "AuthorizeSecurityGroupIngress"]
+
+
+def test_provision_reuses_existing_resources(config, clock, aws_clients):
+    config.wlm_parameter_group = None
+    role = {"Path": "/", "RoleName": config.iam_role_name, "RoleId": "AROA0123456789ABCDEFG", "Arn": ROLE_ARN,\
+            "CreateDate": datetime(2024, 1, 1)}
+    aws_clients.stubbers.iam.add_client_error("create_role", service_error_code="EntityAlreadyExists")
+    aws_clients.stubbers.iam.add_response("attach_role_policy", {})
+    aws_clients.stubbers.iam.add_response("get_role", {"Role": role})
+    aws_clients.stubbers.redshift.add_client_error("create_cluster", service_error_code="ClusterAlreadyExists")
+    aws_clients.stubbers.redshift.add_response("describe_clusters", available(config))
+    aws_clients.stubbers.ec2.add_client_error("authorize_security_group_ingress",\
+                                              service_error_code="InvalidPermission.Duplicate")
+
+    assert asyncio.run(provision.provision(aws_clients, config)) == "dwhcluster.example.com"
+    assert aws_clients.calls == ["CreateRole", "AttachRolePolicy", "GetRole", "CreateCluster", "DescribeClusters",\
+                                 "AuthorizeSecurityGroupIngress"]
+    assert clock.sleeps == []
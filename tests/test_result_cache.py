@@ -0,0 +1,130 @@
+"""
+Tests of result_cache.py: the normalization of the cache keys, the LRU with its Parquet spill, and the
+cached cursor against the PostgreSQL stand-in with and without a version of the published data.
+"""
+
+import os
+
+import pytest
+
+from result_cache import cached_cursor, normalize_sql, publish_version, result_cache
+
+
+@pytest.mark.parametrize("query, normalized", [
+    ("SELECT 1", "select 1"),
+    ("  SELECT\n\t*   FROM songplays ;  ", "select * from songplays"),
+    ("SELECT * FROM users WHERE level = 'Paid  Level'", "select * from users where level = 'Paid  Level'"),
+    ("SELECT 'it''s -- not a comment' FROM t", "select 'it''s -- not a comment' from t"),
+    ("SELECT '/* not a comment */' FROM t", "select '/* not a comment */' from t"),
+    ("SELECT a -- don't\nFROM t", "select a from t"),
+    ("SELECT a /* it's; a comment */ FROM t", "select a from t"),
+    ("/* header */ SELECT COUNT(*) -- total\n FROM songplays;", "select count(*) from songplays"),
+    ('SELECT "Mixed Case" FROM T', 'select "Mixed Case" from t'),
+    ("SELECT 10 - 2 / 1", "select 10 - 2 / 1"),
+])
+def test_normalize_sql(query, normalized):
+    assert normalize_sql(query) == normalized
+
+
+def test_normalize_sql_equivalent_spellings():
+    assert normalize_sql("select *\nfrom SONGPLAYS -- all\n") == normalize_sql("SELECT * FROM songplays;")
+    assert normalize_sql("SELECT 'A'") != normalize_sql("SELECT 'a'")
+
+
+@pytest.mark.parametrize("query", ["SELECT 'open", "SELECT 1 /* open", 'SELECT "open'])
+def test_normalize_sql_raw_text_fallback(query):
+    assert normalize_sql(query) == query
+
+
+def result(n, width=10):
+    return ((("value", 23, None, None, None, None, None),), [("x" * width,) for _ in range(n)])
+
+
+def test_lru_max_entries():
+    cache = result_cache(max_entries=2)
+    cache.put("a", result(1))
+    cache.put("b", result(2))
+    assert cache.get("a") == result(1)
+    cache.put("c", result(3))
+
+    # b was the least recently used
+    assert cache.get("b") is None
+    assert cache.get("a") == result(1)
+    assert cache.get("c") == result(3)
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_lru_max_bytes():
+    cache = result_cache(max_bytes=3000)
+    for key in "abc":
+        cache.put(key, result(1, width=1000))
+
+    assert cache.get("a") is None
+    assert cache.get("b") is not None and cache.get("c") is not None
+    assert cache._bytes <= 3000
+
+
+def test_spill(tmp_path):
+    pytest.importorskip("pyarrow")
+    cache = result_cache(max_entries=1, spill_dir=str(tmp_path))
+    other = result_cache(max_entries=1, spill_dir=str(tmp_path))
+    description = (("user_id", 23, None, None, None, None, None), ("user_id", 23, None, None, None, None, None))
+    rows = [(1, "free"), (2, None)]
+    cache.put("a", (description, rows))
+    cache.put("b", result(1))
+    other.put("a", result(2))
+    other.put("b", result(3))
+
+    # a was spilled into the folder of the cache and is read back, with the repeated column names
+    assert os.listdir(cache.spill_dir) == ["a.parquet"]
+    assert os.path.dirname(cache.spill_dir) == str(tmp_path)
+    assert cache.get("a") == (description, rows)
+    assert cache.get("b") == result(1)
+
+    # clearing a cache only deletes the files it spilled
+    cache.invalidate()
+    assert cache.get("a") is None and cache.get("b") is None
+    assert os.listdir(cache.spill_dir) == []
+    assert other.get("a") == result(2)
+
+
+def test_cached_cursor(postgres):
+    cur = postgres.cursor()
+    cur.execute("INSERT INTO users (user_id, first_name, level) VALUES (1, 'Walter', 'free')")
+    postgres.commit()
+    cache = result_cache(version_check_interval=0)
+
+    # no published data yet: the queries run and nothing is cached
+    cached = cached_cursor(postgres.cursor(), cache)
+    cached.execute("SELECT user_id, level FROM users")
+    assert cached.fetchall() == [(1, "free")]
+    assert (cache.hits, cache.misses) == (0, 0)
+
+    publish_version(cur, postgres)
+    cached.execute("SELECT user_id, level FROM users")
+    cached.execute("select user_id, level\nfrom users -- again")
+    assert cached.fetchall() == [(1, "free")]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # the other statements clear the cache
+    cached.execute("UPDATE users SET level = 'paid'")
+    cached.execute("SELECT user_id, level FROM users")
+    assert cached.fetchall() == [(1, "paid")]
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_cached_cursor_without_etl_watermark(postgres, capsys):
+    cur = postgres.cursor()
+    cur.execute("DROP TABLE etl_watermark")
+    cur.execute("INSERT INTO users (user_id, first_name, level) VALUES (1, 'Walter', 'free')")
+    cache = result_cache(version_check_interval=0)
+    cached = cached_cursor(postgres.cursor(), cache)
+
+    cached.execute("SELECT user_id, level FROM users")
+    cached.execute("SELECT user_id, level FROM users")
+
+    # the query ran in the transaction of the insert, which is still usable
+    assert cached.fetchall() == [(1, "free")]
+    assert (cache.hits, cache.misses) == (0, 0)
+    postgres.commit()
+    assert "not cached" not in capsys.readouterr().out
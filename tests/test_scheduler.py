@@ -0,0 +1,120 @@
+"""
+Tests of the DAG runner of scheduler.py against mocked DB-API connections.
+"""
+
+import time
+
+import pytest
+
+from scheduler import step, validate_dag, run_step, run_dag, critical_path
+
+
+class fake_connection:
+    """
+    DB-API connection that logs the queries it runs. A query listed in fail raises when it is executed.
+    """
+
+    def __init__(self, log, fail=(), delay=0.0):
+        self.log       = log
+        self.fail      = fail
+        self.delay     = delay
+        self.commits   = 0
+        self.rollbacks = 0
+
+    def cursor(self):
+        return self
+
+    def execute(self, query):
+        self.log.append(("start", query))
+        time.sleep(self.delay)
+        if query in self.fail:
+            raise RuntimeError("{} failed".format(query))
+        self.log.append(("end", query))
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def test_validate_dag_order():
+    steps = [step("c", "C", depends_on=["a", "b"]), step("b", "B", depends_on=["a"]), step("a", "A")]
+
+    assert validate_dag(steps) == ["a", "b", "c"]
+
+
+def test_validate_dag_unknown_dependency():
+    with pytest.raises(ValueError, match="unknown step z"):
+        validate_dag([step("a", "A", depends_on=["z"])])
+
+
+def test_validate_dag_cycle():
+    with pytest.raises(ValueError, match="Cyclic"):
+        validate_dag([step("a", "A", depends_on=["b"]), step("b", "B", depends_on=["a"]), step("c", "C")])
+
+
+def test_validate_dag_duplicated_names():
+    with pytest.raises(ValueError, match="Duplicated"):
+        validate_dag([step("a", "A"), step("a", "B")])
+
+
+def test_run_dag_respects_dependencies():
+    log = []
+    released = []
+    steps = [step("lookup", "LOOKUP"), step("songplays", "SONGPLAYS", depends_on=["lookup"]),\
+             step("users", "USERS"), step("time", "TIME"), step("report", "REPORT", depends_on=["songplays", "users"])]
+    timings = run_dag(steps, lambda: fake_connection(log, delay=0.01), released.append, max_workers=3)
+
+    assert sorted(timings) == sorted(s.name for s in steps)
+    assert len(released) == len(steps)
+    assert all(conn.commits == 1 for conn in released)
+    for s in steps:
+        for dependency in s.depends_on:
+            assert log.index(("end", dependency.upper())) < log.index(("start", s.query))
+            assert timings[dependency][1] <= timings[s.name][0]
+
+
+def test_run_dag_failed_step_skips_dependents():
+    log = []
+    released = []
+    steps = [step("lookup", "LOOKUP"), step("songplays", "SONGPLAYS", depends_on=["lookup"]), step("users", "USERS")]
+
+    with pytest.raises(RuntimeError, match=r"Steps \['lookup'\] failed, steps \['songplays'\] were not run") as error:
+        run_dag(steps, lambda: fake_connection(log, fail=("LOOKUP",)), released.append, max_workers=2)
+
+    assert str(error.value.__cause__) == "LOOKUP failed"
+    assert ("start", "SONGPLAYS") not in log
+    assert ("end", "USERS") in log
+    assert len(released) == 2
+    assert sum(conn.rollbacks for conn in released) == 1
+
+
+def test_run_step_release_failure_does_not_hide_the_error():
+    def release(conn):
+        raise OSError("pool closed")
+
+    conn = fake_connection([], fail=("SONGPLAYS",))
+    with pytest.raises(RuntimeError, match="SONGPLAYS failed"):
+        run_step(step("songplays", "SONGPLAYS"), lambda: conn, release)
+    assert conn.rollbacks == 1
+
+
+def test_run_step_release_failure_after_success():
+    def release(conn):
+        raise OSError("pool closed")
+
+    conn = fake_connection([])
+    start, end = run_step(step("users", "USERS"), lambda: conn, release)
+
+    assert start <= end
+    assert conn.commits == 1
+
+
+def test_critical_path():
+    steps = [step("lookup", "LOOKUP"), step("songplays", "SONGPLAYS", depends_on=["lookup"]),\
+             step("users", "USERS"), step("time", "TIME")]
+    timings = {"lookup": (0.0, 2.0), "songplays": (2.0, 5.0), "users": (0.0, 4.0), "time": (0.0, 1.0)}
+
+    assert critical_path(steps, timings) == (["lookup", "songplays"], 5.0)
+    assert critical_path([], {}) == ([], 0.0)
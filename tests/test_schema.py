@@ -0,0 +1,74 @@
+"""
+Tests of the physical design rendered by schema.py: distribution style and key, sort key and column encodings.
+"""
+
+import re
+
+import pytest
+
+import schema
+from schema import table_spec, create_table, column_encoding, plan_diststyle
+
+# Every table specification of the DWH, including the ones of the summary tables
+ALL_SPECS = [value for value in vars(schema).values() if isinstance(value, table_spec)] +\
+            [summary.table for summary in schema.summary_tables]
+
+
+def column_encodings(query):
+    return dict(re.findall(r"^\s+(\w+) .* ENCODE (\w+),?$", query, re.MULTILINE))
+
+
+@pytest.mark.parametrize("spec", ALL_SPECS, ids=lambda spec: spec.name)
+def test_rendered_design(spec):
+    query = create_table(spec)
+    diststyle = plan_diststyle(spec)
+
+    assert "DISTSTYLE {}\n".format(diststyle) in query
+    if spec.distkey is not None:
+        assert "DISTKEY ({})\n".format(spec.distkey) in query
+    else:
+        assert "DISTKEY" not in query
+    if spec.sortkey:
+        assert "SORTKEY ({})\n".format(", ".join(spec.sortkey)) in query
+    else:
+        assert "SORTKEY" not in query
+
+    encodings = column_encodings(query)
+    assert encodings == {column: column_encoding(spec, column, column_type) for column, column_type in spec.columns}
+    for column in spec.sortkey:
+        assert encodings[column] == "RAW"
+    for column, column_type in spec.columns:
+        if column not in spec.sortkey:
+            assert encodings[column] in ("AZ64", "ZSTD")
+
+
+def test_songplays_design():
+    query = create_table(schema.songplay_table)
+
+    assert "DISTSTYLE KEY\n" in query
+    assert "DISTKEY (song_id)\n" in query
+    assert "SORTKEY (start_time)\n" in query
+    assert column_encodings(query)["start_time"] == "RAW"
+
+
+@pytest.mark.parametrize("spec", [schema.user_table, schema.artist_table, schema.time_table], ids=lambda spec: spec.name)
+def test_small_dimensions_replicated(spec):
+    query = create_table(spec)
+
+    assert "DISTSTYLE ALL\n" in query
+    assert "DISTKEY" not in query
+
+
+def test_column_encodings():
+    encodings = column_encodings(create_table(schema.time_table))
+
+    assert encodings["start_time"] == "RAW"
+    assert encodings["hour"] == "AZ64"
+    assert column_encodings(create_table(schema.user_table))["first_name"] == "ZSTD"
+
+
+def test_postgres_dialect_has_no_physical_design():
+    query = create_table(schema.songplay_table, dialect="postgres")
+
+    for clause in ("DISTSTYLE", "DISTKEY", "SORTKEY", "ENCODE", "IDENTITY(", "FOREIGN KEY"):
+        assert clause not in query
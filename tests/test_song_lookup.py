@@ -0,0 +1,49 @@
+"""
+Tests of the SQL path of the songplays load (song_lookup_build and the songplays JOIN) against the
+PostgreSQL stand-in, with a staging_songs table that holds duplicated songs.
+"""
+
+import json
+import os
+
+from benchmark import copy_records
+from schema import staging_events_table, staging_songs_table
+from sql_queries import song_lookup_build, songplay_table_insert
+
+DATA_SAMPLE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data_sample")
+
+
+def test_duplicated_songs_do_not_fan_out_songplays(postgres):
+    with open(os.path.join(DATA_SAMPLE, "log-events.json")) as f:
+        events = [json.loads(line) for line in f]
+    plays = [event for event in events if event["page"] == "NextSong"]
+
+    songs = []
+    for i, event in enumerate(plays):
+        song = {"artist_id": "AR{:016d}".format(i), "artist_name": event["artist"], "duration": event["length"],\
+                "num_songs": 1, "song_id": "SO{:016d}B".format(i), "title": event["song"], "year": 2018}
+        songs += [
+            song,
+            # the same song file loaded twice
+            song,
+            # another song_id for the same song
+            dict(song, song_id="SO{:016d}A".format(i)),
+            # a duration that only differs after the second decimal
+            dict(song, song_id="SO{:016d}C".format(i), duration=round(event["length"], 2) + 0.001),
+        ]
+
+    cur = postgres.cursor()
+    copy_records(cur, staging_events_table, events)
+    copy_records(cur, staging_songs_table, songs)
+    cur.execute(song_lookup_build)
+    cur.execute(songplay_table_insert)
+
+    cur.execute("SELECT COUNT(*) FROM song_lookup")
+    assert cur.fetchone()[0] == len(plays)
+    cur.execute("SELECT COUNT(*) FROM songplays")
+    assert cur.fetchone()[0] == len(plays)
+    # one row per NextSong event, matched with the lowest song_id of its duplicates
+    cur.execute("SELECT song_id, session_id, start_time FROM songplays ORDER BY song_id")
+    rows = cur.fetchall()
+    assert [song_id for song_id, _, _ in rows] == ["SO{:016d}A".format(i) for i in range(len(plays))]
+    assert len(set(rows)) == len(plays)
@@ -0,0 +1,62 @@
+"""
+Tests of the derivation of the time dimension: the hour, day, week, month, year and weekday of a start_time
+computed by local_etl.time_row and by the EXTRACT functions of sql_queries.time_delta_select.
+"""
+
+import re
+from datetime import datetime, timedelta
+
+import pytest
+
+from local_etl import start_time, time_row
+from sql_queries import time_columns, time_delta_select
+
+# Value of EXTRACT(<unit> FROM timestamp) in Redshift: week is the ISO week and dow is 0 for Sunday
+EXTRACT_UNITS = {
+    "hour": lambda t: t.hour,
+    "day": lambda t: t.day,
+    "week": lambda t: t.isocalendar()[1],
+    "month": lambda t: t.month,
+    "year": lambda t: t.year,
+    "dow": lambda t: int(t.strftime("%w")),
+}
+
+
+def extract_row(start):
+    extracts = re.findall(r"EXTRACT\((\w+) FROM start_time\) AS (\w+)", time_delta_select)
+    return (start,) + tuple(EXTRACT_UNITS[unit](start) for unit, _ in extracts)
+
+
+def test_time_delta_select_columns():
+    extracts = re.findall(r"EXTRACT\((\w+) FROM start_time\) AS (\w+)", time_delta_select)
+
+    assert ["start_time"] + [alias for _, alias in extracts] == time_columns
+    assert dict((alias, unit) for unit, alias in extracts)["weekday"] == "dow"
+
+
+@pytest.mark.parametrize("start, week, weekday", [
+    (datetime(2018, 12, 30, 23, 59, 59), 52, 0),  # Sunday, last day of the ISO week 52 of 2018
+    (datetime(2018, 12, 31, 0, 0, 0), 1, 1),      # Monday, the ISO week 1 of 2019 starts in 2018
+    (datetime(2019, 1, 6, 12, 0, 0), 1, 0),       # Sunday, last day of the ISO week 1 of 2019
+    (datetime(2021, 1, 1, 8, 0, 0), 53, 5),       # Friday, the ISO week 53 of 2020 ends in 2021
+    (datetime(2018, 11, 4, 17, 30, 0), 44, 0),    # Sunday of the sample event logs
+])
+def test_week_and_weekday(start, week, weekday):
+    row = time_row(start)
+
+    assert row == (start, start.hour, start.day, week, start.month, start.year, weekday)
+    assert row == extract_row(start)
+
+
+def test_time_row_matches_datetime():
+    start = datetime(2018, 12, 20)
+    while start < datetime(2019, 1, 20):
+        assert time_row(start) == (start, start.hour, start.day, start.isocalendar()[1], start.month, start.year,\
+                                   int(start.strftime("%w")))
+        assert time_row(start) == extract_row(start)
+        start += timedelta(minutes=37)
+
+
+def test_start_time_truncates_milliseconds():
+    assert start_time(1541105830796) == datetime(2018, 11, 1, 20, 57, 10)
+    assert start_time(None) is None
@@ -0,0 +1,61 @@
+"""
+Tests of the WLM slot counts of wlm.py and of the sessions tagged by workload.
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from wlm import slot_count, workload
+
+
+class fake_connection:
+    """
+    DB-API connection that doubles as its cursor and logs the statements it runs.
+    """
+
+    def __init__(self):
+        self.statements = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, query):
+        self.statements.append(query)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def wlm_config(etl_concurrency=3, transform_slots=2):
+    return SimpleNamespace(wlm_etl_concurrency=etl_concurrency, wlm_transform_slots=transform_slots)
+
+
+@pytest.mark.parametrize("stage, workers, etl_concurrency, transform_slots, slots", [
+    ("load", 1, 3, 2, 1),
+    ("ddl", 4, 3, 2, 1),
+    ("transform", 1, 3, 2, 2),
+    ("transform", 2, 3, 2, 1),
+    ("transform", 2, 8, 3, 3),
+    ("maintenance", 4, 8, 3, 2),
+    ("transform", 5, 3, 2, 1),
+])
+def test_slot_count(stage, workers, etl_concurrency, transform_slots, slots):
+    assert slot_count(wlm_config(etl_concurrency, transform_slots), stage, workers) == slots
+
+
+def test_sessions_share_the_queue():
+    config = wlm_config(etl_concurrency=6, transform_slots=4)
+    stages = workload(config, workers=3)
+    main = fake_connection()
+    stages.enter(main.cursor(), main, "transform")
+    workers = [stages.tagged(fake_connection)() for _ in range(stages.workers)]
+
+    for conn in [main] + workers:
+        assert conn.statements == ["SET query_group TO 'etl_transform'", "SET wlm_query_slot_count TO 2"]
+
+    stages.untagged(lambda conn: None)(workers[0])
+    assert workers[0].statements[-2:] == ["RESET query_group", "RESET wlm_query_slot_count"]
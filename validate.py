@@ -0,0 +1,294 @@
+"""
+This script contains a streaming validator and normalizer of the event logs loaded into staging_events.
+
+The fields of a record are the ones listed in the JSON paths file used by COPY (data_sample/log_json_path.json)
+and their types are the ones of the staging_events columns in schema.py. Values that can be converted
+losslessly are normalized (userId "39" -> 39, an empty userId -> null, registration 1540919166796.0 ->
+1540919166796) and records with values that cannot be converted are rejected together with the reason.
+
+The records are processed one at a time with generators, so files of any size are validated in constant memory.
+The clean records are written as JSON-lines batches ready for COPY and the rejects into a separate file:
+
+    $ python validate.py data_sample/log-events.json /tmp/validated
+    $ python validate.py data_sample/log-events.json /tmp/validated --benchmark 100000
+"""
+
+import argparse
+import itertools
+import json
+import math
+import os
+import re
+import tempfile
+import time
+from decimal import Decimal, InvalidOperation
+
+from convert import stream_json_records
+from schema import staging_events_table
+
+JSONPATHS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data_sample", "log_json_path.json")
+
+# Number of clean records written in each output file
+BATCH_RECORDS = 100000
+
+# Range of the integer column types, values outside of them are rejected by COPY
+INTEGER_RANGES = {
+    "SMALLINT": (-2**15, 2**15 - 1),
+    "INT": (-2**31, 2**31 - 1),
+    "INTEGER": (-2**31, 2**31 - 1),
+    "BIGINT": (-2**63, 2**63 - 1),
+}
+
+
+def load_jsonpaths(path=JSONPATHS_PATH):
+    """
+    This method reads the field names from a COPY JSON paths file like data_sample/log_json_path.json.
+
+    Args:
+        path (str): path of the JSON paths file
+
+    Returns:
+        fields (list): field names in the order of the JSON paths
+    """
+
+    with open(path) as f:
+        jsonpaths = json.load(f)["jsonpaths"]
+
+    fields = []
+    for jsonpath in jsonpaths:
+        match = re.fullmatch(r"\$\['(.+)'\]|\$\.(\w+)", jsonpath)
+        if match is None:
+            raise ValueError("Unsupported JSON path {}".format(jsonpath))
+        fields.append(match.group(1) or match.group(2))
+
+    return fields
+
+
+def strict_caster(column_type):
+    """
+    This method returns the function that normalizes a JSON value into the type of a staging column.
+    The function returns a (value, error) tuple: error is None when the value could be normalized.
+
+    Args:
+        column_type (str): column type as declared in schema.py
+
+    Returns:
+        cast (callable)
+    """
+
+    base_type = column_type.split("(")[0].split(" ")[0].upper()
+
+    if base_type in INTEGER_RANGES:
+        low, high = INTEGER_RANGES[base_type]
+
+        def cast(value):
+            if value is None or value == "":
+                return None, None
+            if isinstance(value, bool):
+                return None, "boolean value for an integer column"
+            # the value is parsed exactly, a float() round trip would change the integers above 2**53
+            if isinstance(value, int):
+                number = Decimal(value)
+            else:
+                try:
+                    number = Decimal(value.strip() if isinstance(value, str) else value)
+                except (TypeError, ValueError, InvalidOperation):
+                    return None, "not a number: {!r}".format(value)
+            if not number.is_finite():
+                return None, "not a number: {!r}".format(value)
+            if number != number.to_integral_value():
+                return None, "not an integer: {!r}".format(value)
+            if not low <= number <= high:
+                return None, "out of range for {}: {!r}".format(base_type, value)
+            return int(number), None
+    elif base_type in ("FLOAT", "REAL", "DOUBLE"):
+        def cast(value):
+            if value is None or value == "":
+                return None, None
+            if isinstance(value, bool):
+                return None, "boolean value for a float column"
+            try:
+                number = float(value)
+            except (TypeError, ValueError):
+                return None, "not a number: {!r}".format(value)
+            if not math.isfinite(number):
+                return None, "not a finite number: {!r}".format(value)
+            return number, None
+    else:
+        def cast(value):
+            if value is None:
+                return None, None
+            if isinstance(value, (dict, list)):
+                return None, "nested value for a text column"
+            return str(value), None
+
+    return cast
+
+
+def event_casters(fields, spec=staging_events_table):
+    """
+    This method returns the normalization function of each field. The type of a field is the type of the
+    staging column with the same name (case insensitive), like COPY does when it maps the JSON paths.
+
+    Args:
+        fields (list): field names read from the JSON paths file
+        spec (schema.table_spec): staging table specification
+
+    Returns:
+        casters (list): (field name, cast function) tuples
+    """
+
+    column_types = {column.lower(): column_type for column, column_type in spec.columns}
+
+    return [(field, strict_caster(column_types.get(field.lower(), "VARCHAR"))) for field in fields]
+
+
+def validate_records(records, casters):
+    """
+    This method validates and normalizes a stream of records.
+
+    Args:
+        records (iterable): raw records
+        casters (list): (field name, cast function) tuples, as returned by event_casters
+
+    Yields:
+        (record, errors) (tuple): the normalized record and an empty list, or the raw record and the list of errors
+    """
+
+    for record in records:
+        if not isinstance(record, dict):
+            yield record, ["not a JSON object"]
+            continue
+
+        clean = {}
+        errors = []
+        for field, cast in casters:
+            value, error = cast(record.get(field))
+            if error is not None:
+                errors.append("{}: {}".format(field, error))
+            clean[field] = value
+
+        if errors:
+            yield record, errors
+        else:
+            yield clean, errors
+
+
+def write_batches(results, output_dir, batch_records=BATCH_RECORDS):
+    """
+    This method writes the clean records as JSON-lines batches (clean-00000.json, clean-00001.json, ...)
+    and the rejected records with their errors into rejects.json.
+
+    Args:
+        results (iterable): (record, errors) tuples, as yielded by validate_records
+        output_dir (str): folder where the batches and the rejects are written
+        batch_records (int): number of clean records of each batch
+
+    Returns:
+        summary (dict): number of clean and rejected records and paths of the batches
+    """
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    batches = []
+    n_clean = 0
+    n_rejected = 0
+    batch = None
+
+    with open(os.path.join(output_dir, "rejects.json"), "w") as rejects:
+        try:
+            for record, errors in results:
+                if errors:
+                    rejects.write(json.dumps({"record": record, "errors": errors}) + "\n")
+                    n_rejected += 1
+                    continue
+
+                if n_clean % batch_records == 0:
+                    if batch is not None:
+                        batch.close()
+                    batches.append(os.path.join(output_dir, "clean-{:05d}.json".format(len(batches))))
+                    batch = open(batches[-1], "w")
+                batch.write(json.dumps(record) + "\n")
+                n_clean += 1
+        finally:
+            if batch is not None:
+                batch.close()
+
+    return {"clean": n_clean, "rejected": n_rejected, "batches": batches}
+
+
+def validate_file(input_path, output_dir, jsonpaths_path=JSONPATHS_PATH, batch_records=BATCH_RECORDS):
+    """
+    This method validates a log file and writes the clean batches and the rejects into output_dir.
+
+    Args:
+        input_path (str): path of the event log file
+        output_dir (str): folder where the batches and the rejects are written
+        jsonpaths_path (str): path of the JSON paths file that defines the fields
+        batch_records (int): number of clean records of each batch
+
+    Returns:
+        summary (dict): number of clean and rejected records and paths of the batches
+    """
+
+    casters = event_casters(load_jsonpaths(jsonpaths_path))
+
+    with open(input_path, "rb") as f:
+        return write_batches(validate_records(stream_json_records(f), casters), output_dir, batch_records)
+
+
+def benchmark(sample_path, n_records, jsonpaths_path=JSONPATHS_PATH):
+    """
+    This method measures the throughput of the validator. The sample log file is repeated until the input
+    has n_records records, the input is written to a temporary file and then validated.
+
+    Args:
+        sample_path (str): path of the sample event log file, like data_sample/log-events.json
+        n_records (int): number of records of the scaled-up input
+        jsonpaths_path (str): path of the JSON paths file that defines the fields
+
+    Returns:
+        records_per_second (float)
+    """
+
+    with open(sample_path, "rb") as f:
+        sample = [json.dumps(record) for record in stream_json_records(f)]
+
+    with tempfile.TemporaryDirectory() as folder:
+        input_path = os.path.join(folder, "events.json")
+        with open(input_path, "w") as f:
+            for line in itertools.islice(itertools.cycle(sample), n_records):
+                f.write(line + "\n")
+
+        start = time.perf_counter()
+        summary = validate_file(input_path, os.path.join(folder, "output"), jsonpaths_path)
+        elapsed = time.perf_counter() - start
+
+    records_per_second = n_records / elapsed
+    print("{} records validated in {:.2f}s: {:.0f} records/s ({} clean, {} rejected)".format(\
+        n_records, elapsed, records_per_second, summary["clean"], summary["rejected"]))
+
+    return records_per_second
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate and normalize event logs before loading them into staging_events")
+    parser.add_argument("input", help="event log file")
+    parser.add_argument("output", help="folder where the clean batches and the rejects are written")
+    parser.add_argument("--jsonpaths", default=JSONPATHS_PATH, help="JSON paths file that defines the fields")
+    parser.add_argument("--batch-records", type=int, default=BATCH_RECORDS)
+    parser.add_argument("--benchmark", type=int, default=None, metavar="N",
+                        help="measure the records/s on the input repeated up to N records")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.input, args.benchmark, args.jsonpaths)
+        return
+
+    summary = validate_file(args.input, args.output, args.jsonpaths, args.batch_records)
+    print("{} clean records written in {} batches, {} records rejected".format(\
+        summary["clean"], len(summary["batches"]), summary["rejected"]))
+
+
+if __name__ == "__main__":
+    main()
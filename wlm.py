@@ -0,0 +1,195 @@
+"""
+This script contains the workload management (WLM) of the cluster: the ETL statements are routed to their
+own queue so the heavy COPYs and INSERT ... SELECTs do not take the slots of the analysts' queries.
+
+The sessions of create_tables.py and etl.py are tagged with the query group of the stage they run
+(SET query_group), including the worker connections of the parallel steps:
+
+    etl_ddl:         drop and create of the tables
+    etl_load:        COPYs into the staging area and repair of the rejected lines
+    etl_transform:   inserts into the reporting tables, shadow tables and summary tables
+    etl_maintenance: VACUUM and ANALYZE
+
+The transform and maintenance statements also claim TRANSFORM_SLOTS slots of the queue
+(SET wlm_query_slot_count) to get more memory, shared between the workers when they run in parallel.
+
+The queues are declared by the WLM parameter group of the [WLM] section of dwh.cfg, which lib.create_redshift
+attaches to the cluster: an ETL queue for the etl_* query groups, a default queue for the analysts with
+concurrency scaling and short query acceleration. Without PARAMETER_GROUP the query groups only label
+the statements in the system tables (stl_query.label).
+"""
+
+import json
+
+from sql_queries import set_query_group, set_slot_count, reset_query_group, reset_slot_count
+
+# Query group of the ETL queue, the query group of a stage is <ETL_QUERY_GROUP>_<stage>
+ETL_QUERY_GROUP = "etl"
+
+# Stages whose statements claim TRANSFORM_SLOTS slots, the other stages run with one slot
+HEAVY_STAGES = ("transform", "maintenance")
+
+
+def query_group(stage):
+    return "{}_{}".format(ETL_QUERY_GROUP, stage)
+
+
+def slot_count(config, stage, workers=1):
+    """
+    This method returns the number of slots a statement of a stage claims. The workers running in parallel
+    share the concurrency of the ETL queue, a statement cannot claim more slots than the queue has.
+
+    Args:
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        stage (str): ddl, load, transform or maintenance
+        workers (int): number of connections running the stage at the same time
+
+    Returns:
+        slots (int)
+    """
+
+    if stage not in HEAVY_STAGES:
+        return 1
+
+    return max(1, min(config.wlm_transform_slots, config.wlm_etl_concurrency // max(1, workers)))
+
+
+def tag_session(cur, conn, config, stage, workers=1):
+    """
+    This method is used to route the next statements of a session to the ETL queue with the query group
+    of a stage. The settings are committed, so they last until the session is tagged again or reset.
+
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        conn (psycopg2.extensions.connection): psycopg2 connection object
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+        stage (str): ddl, load, transform or maintenance
+        workers (int): number of connections running the stage at the same time
+    """
+
+    cur.execute(set_query_group.format(query_group(stage)))
+    cur.execute(set_slot_count.format(slot_count(config, stage, workers)))
+    conn.commit()
+
+
+def reset_session(cur, conn):
+    """
+    This method removes the query group and the slot count of a session, for example before
+    the connection is given back to the pool.
+
+    Args:
+        cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+        conn (psycopg2.extensions.connection): psycopg2 connection object
+    """
+
+    conn.rollback()
+    cur.execute(reset_query_group)
+    cur.execute(reset_slot_count)
+    conn.commit()
+
+
+class workload:
+    """
+    This class tags the session of etl.py with the stage being run and the worker connections
+    of the parallel steps with the same stage.
+
+    Attributes:
+        config: object that contains metadata information about the DWH setup (.cfg file)
+        workers: number of worker connections running at the same time
+        stage: stage the sessions are tagged with, None before the first stage
+    """
+
+    def __init__(self, config, workers=1):
+        self.config  = config
+        self.workers = workers
+        self.stage   = None
+
+    def enter(self, cur, conn, stage):
+        """
+        This method tags the main session with a stage. The worker connections acquired afterwards
+        are tagged with the same stage. The main session claims the slots of one of the workers, so
+        the sessions never claim more slots than the ETL queue has.
+
+        Args:
+            cur (psycopg2.extensions.cursor): psycopg2 cursor object used to run queries against a database
+            conn (psycopg2.extensions.connection): psycopg2 connection object
+            stage (str): ddl, load, transform or maintenance
+        """
+
+        print("\nWLM query group {}, {} slot(s)".format(query_group(stage),\
+                                                      slot_count(self.config, stage, self.workers)))
+        self.stage = stage
+        tag_session(cur, conn, self.config, stage, self.workers)
+
+    def tagged(self, acquire):
+        """
+        This method wraps the function that acquires the worker connections so they are tagged with the current stage.
+
+        Args:
+            acquire (callable): returns a DB-API connection
+
+        Returns:
+            acquire (callable)
+        """
+
+        def acquire_tagged():
+            conn = acquire()
+            if self.stage is not None:
+                tag_session(conn.cursor(), conn, self.config, self.stage, self.workers)
+            return conn
+
+        return acquire_tagged
+
+    def untagged(self, release):
+        """
+        This method wraps the function that gives the worker connections back so they are reset first.
+
+        Args:
+            release (callable): gives a DB-API connection back
+
+        Returns:
+            release (callable)
+        """
+
+        def release_untagged(conn):
+            try:
+                reset_session(conn.cursor(), conn)
+            finally:
+                release(conn)
+
+        return release_untagged
+
+
+def wlm_configuration(config):
+    """
+    This method renders the wlm_json_configuration parameter of the WLM parameter group (manual WLM):
+
+        1. the ETL queue of the etl_* query groups, with ETL_CONCURRENCY slots and ETL_MEMORY_PCT of the memory
+        2. the default queue of the analysts, with ANALYTICS_CONCURRENCY slots and concurrency scaling
+        3. short query acceleration, when SHORT_QUERY_ACCELERATION is enabled
+
+    Args:
+        config (lib.aws_config): object that contains metadata information about the DWH setup (.cfg file)
+
+    Returns:
+        configuration (str): JSON document
+    """
+
+    queues = [
+        {
+            "query_group": ["{}_*".format(ETL_QUERY_GROUP)],
+            "query_group_wild_card": 1,
+            "query_concurrency": config.wlm_etl_concurrency,
+            "memory_percent_to_use": config.wlm_etl_memory_pct,
+            "concurrency_scaling": "off",
+        },
+        {
+            "query_concurrency": config.wlm_analytics_concurrency,
+            "memory_percent_to_use": 100 - config.wlm_etl_memory_pct,
+            "concurrency_scaling": config.wlm_concurrency_scaling,
+        },
+    ]
+    if config.wlm_short_query_acceleration:
+        queues.append({"short_query_queue": True})
+
+    return json.dumps(queues)